@@ -5,25 +5,34 @@ from . import config
 
 parser = argparse.ArgumentParser(description='Yet another chat bot', prog='michiru')
 parser.add_argument('-c', '--config-dir', help='Configuration directory.')
+parser.add_argument('-s', '--shards', type=int, default=1, help='Amount of processes to split servers over.')
 args = parser.parse_args()
 
 # Load config.
 config.load(args.config_dir)
-# Connect to database.
-from . import db
-db.connect()
 
-# Load rest.
-from . import events, chat, personalities, modules, transports
+def main():
+    # Connect to database.
+    from . import db
+    db.connect()
 
-# The only hardcoded module.
-modules.load('core')
-# Load all other modules.
-for module in config.current['modules']:
-    modules.load(module)
+    # Load rest.
+    from . import events, chat, personalities, modules, transports
 
-# And do the chat.
-chat.run_forever()
+    # The only hardcoded module.
+    modules.load('core')
+    # Load all other modules.
+    for module in config.current['modules']:
+        modules.load(module)
 
-# Clean up.
-modules.unload_all()
+    # And do the chat.
+    chat.run_forever()
+
+    # Clean up.
+    modules.unload_all()
+
+if args.shards > 1:
+    from . import shards
+    shards.supervise(args.shards, main)
+else:
+    main()
@@ -5,7 +5,10 @@ from . import version as michiru, \
               config, \
               db, \
               personalities, \
-              modules
+              modules, \
+              outbound, \
+              presence, \
+              shards
 
 _ = personalities.localize
 
@@ -37,12 +40,30 @@ personalities.messages('tsun', {
 
 
 class Transport:
+    # Outbound flood control defaults, can be overridden per server.
+    FLOOD_RATE = 1.0
+    FLOOD_BURST = 5
+    # Maximum message length, and separator to merge messages with if the protocol allows it.
+    MESSAGE_LIMIT = 400
+    MESSAGE_SEPARATOR = None
+    ENCODING = None
+
     def __init__(self, loop, server, info):
         self.loop = loop
         self.server = server
         self.info = info
         self.ignores = []
         self.highlight_pattern = None
+        self.outbound = outbound.OutboundQueue(
+            loop,
+            self.send,
+            rate=info.get('flood_rate', self.FLOOD_RATE),
+            burst=info.get('flood_burst', self.FLOOD_BURST),
+            limit=info.get('message_limit', self.MESSAGE_LIMIT),
+            separator=self.MESSAGE_SEPARATOR,
+            encoding=info.get('encoding', self.ENCODING)
+        )
+        self.presence = presence.Presence(self.normalize)
 
         # Fill ignore list from database.
         res = db.from_('_ignores').where('server', self.server).get('channel', 'nickname')
@@ -152,6 +173,46 @@ class Transport:
     def highlight(self, nickname):
         return nickname
 
+    def normalize(self, name):
+        """ Normalize nickname or channel name for comparison. """
+        return name
+
+    @asyncio.coroutine
+    def whois(self, nick):
+        """ Get information about user, or None if not supported. """
+        return None
+
+    @property
+    def connected(self):
+        """ Check if we can currently send messages. """
+        return True
+
+    @asyncio.coroutine
+    def message(self, target, message, urgent=False, track=False):
+        """
+        Queue message to be sent to `target`. Urgent messages skip flood control, and are waited on until they are sent.
+        With `track` set, returns a future that resolves once the message has been sent.
+        """
+        sent = self.outbound.put(target, message, urgent=urgent, track=track)
+        if urgent:
+            yield from sent
+        return sent
+
+    @asyncio.coroutine
+    def send(self, target, message):
+        """ Actually send message to `target`. Should only be used by the outbound queue. """
+        raise EnvironmentError('{} transport for server {} does not support sending messages.'.format(type(self).__name__, self.server))
+
+    @asyncio.coroutine
+    def join(self, channel, password=None):
+        """ Join channel. """
+        raise EnvironmentError('{} transport for server {} does not support joining channels.'.format(type(self).__name__, self.server))
+
+    @asyncio.coroutine
+    def part(self, channel, reason=None):
+        """ Leave channel. """
+        raise EnvironmentError('{} transport for server {} does not support leaving channels.'.format(type(self).__name__, self.server))
+
     @asyncio.coroutine
     def is_admin(self, nick, chan=None):
         """ Check if given nickname is admin or channel admin. """
@@ -216,7 +277,49 @@ def connect(loop, tag, info):
 def setup(loop):
     """ Setup the bots. """
     for tag, info in config.get('servers').items():
-        bots[tag] = connect(loop, tag, info)
+        if shards.owns(tag):
+            bots[tag] = connect(loop, tag, info)
+
+@shards.action('connect')
+def add(tag, info):
+    """ Add server to configuration, and connect to it if it's ours to run. """
+    config.current['servers'][tag] = info
+    if not shards.owns(tag):
+        return
+
+    loop = asyncio.get_event_loop()
+    bots[tag] = connect(loop, tag, info)
+    asyncio.ensure_future(bots[tag].run(), loop=loop)
+
+@shards.action('message')
+def relay(server, target, message, localize=False):
+    """ Send message through server, if we run it. """
+    if server not in bots:
+        return
+    bot = bots[server]
+    if localize:
+        message = _(bot, message)
+    return bot.message(target, message)
+
+# Transport actions that can be relayed to the shard running a server.
+ACTIONS = ('join', 'part', 'quit')
+
+@asyncio.coroutine
+def perform(action, server, *args):
+    """ Perform transport action on server, or have the shard running it do so. """
+    if action not in ACTIONS:
+        raise ValueError('Unknown transport action: {}'.format(action))
+    if server in bots:
+        yield from getattr(bots[server], action)(*args)
+    else:
+        shards.broadcast('perform', action, server, *args)
+
+@shards.action('perform')
+def relay_perform(action, server, *args):
+    """ Perform transport action on server, if we run it. """
+    if action not in ACTIONS or server not in bots:
+        return
+    return getattr(bots[server], action)(*args)
 
 def run_forever():
     """ Run the main loop. Should not return unless all bots died. """
@@ -224,4 +327,5 @@ def run_forever():
     setup(loop)
     for b in bots.values():
         asyncio.ensure_future(b.run(), loop=loop)
+    shards.attach(loop)
     loop.run_forever()
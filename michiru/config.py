@@ -11,6 +11,8 @@ from . import version as michiru
 
 # Current configuration.
 current = None
+# Bumped on every change, so users can cache configuration values until it changes.
+generation = 0
 
 # Configuration file name.
 CONFIG_FILE = 'config.json'
@@ -130,11 +132,18 @@ def dict(item, server=None, channel=None):
         res.update(_get(item, parent))
     return res
 
+def changed():
+    """ Mark configuration as changed. """
+    global generation
+    generation += 1
+
 def set(item, value, server=None, channel=None):
     parent = _override(server, channel)
     _set(item, value, parent)
+    changed()
 
 def delete(item, key, server=None, channel=None):
+    changed()
     v = get(item, server, channel)
     if isinstance(v, builtins.dict):
         for parent in _overrides(item, server, channel):
@@ -154,17 +163,20 @@ def add(item, value, server=None, channel=None):
     if not _has(item, parent):
         _set(item, [], parent)
     _get(item, parent).append(value)
+    changed()
 
 def setitem(item, key, value, server=None, channel=None):
     parent = _override(server, channel)
     if not _has(item, parent):
         _set(item, {}, parent)
     _get(item, parent)[key] = value
+    changed()
 
 def item(item, default):
     """ Ensure configuration item exists. Will initialize it to `default` if it doesn't. """
     if not _has(item):
         _set(item, default)
+        changed()
 
 def ensure_structure():
     """ Ensure a proper configuration structure is in place. """
@@ -264,6 +276,7 @@ def load(dir=None):
     item('_overrides', {})
     item('_overrides.servers', {})
     item('_overrides.channels', {})
+    changed()
 
 def save():
     """ Save configuration to CONFIG_FILE. """
@@ -2,7 +2,10 @@
 import time
 import datetime
 import sqlite3
+import inspect
 import threading
+import contextlib
+import fcntl
 
 from . import version as michiru, \
               config
@@ -31,20 +34,51 @@ TIME_FORMAT = '%H:%M:%S'
 
 handle = None
 mutex = threading.RLock()
+# Schema changes are serialized across shards through a lock file next to the database.
+schema_file = None
+schema_depth = 0
 
 config.ensure_file(DB_FILE, writable=True)
 
 
-def table(name, structure):
-    """ Ensure a data entry with given structure exists. """
+def index(*columns, unique=False, where=None, covering=(), name=None):
+    """
+    Declare an index on `columns` for use with table().
+    `where` makes it a partial index, like '`time` IS NULL'.
+    `covering` columns are appended to the key, so lookups that only need them never touch the table.
+    """
+    return {
+        'name': name,
+        'columns': tuple(columns) + tuple(covering),
+        'unique': unique,
+        'where': where
+    }
+
+def index_statement(table, idx):
+    """ Get name and creation statement of index `idx` on `table`. Index names are global, so they get prefixed with the table name. """
+    name = idx['name'] or '_'.join((table,) + idx['columns'])
+    statement = 'CREATE {unique}INDEX `{name}` ON `{table}` ({columns})'.format(
+        unique='UNIQUE ' if idx['unique'] else '',
+        name=name,
+        table=table,
+        columns=', '.join('`{}`'.format(c) for c in idx['columns'])
+    )
+    if idx['where']:
+        statement += ' WHERE ' + idx['where']
+    return name, statement
+
+def table(name, structure, indices=(), migrations=()):
+    """
+    Ensure a data entry with given structure and indices exists.
+    `migrations` is the ordered list of steps that bring an older version of the table up to date, see migrate().
+    """
     global handle, INDEX, UNIQUE
 
     # Base query.
     query  = 'CREATE TABLE IF NOT EXISTS `{name}` ('.format(name=name)
 
     struct = []
-    indices = []
-    unique_indices = []
+    indices = list(indices)
     # Set up structure.
     for n, val in structure.items():
         if isinstance(val, tuple):
@@ -56,34 +90,188 @@ def table(name, structure):
         # Store indices for later use.
         if UNIQUE in attributes:
             attributes.remove(UNIQUE)
-            unique_indices.append(n)
+            indices.append(index(n, unique=True))
         if INDEX in attributes:
             attributes.remove(INDEX)
-            indices.append(n)
+            indices.append(index(n))
         struct.append((n, type, attributes))
 
     # Add structure to query and finalize it.
     query += ', '.join('`{}` {} {}'.format(n, type, ' '.join(attributes)) for n, type, attributes in struct)
     query += ')'
 
-    # Create table.
-    cursor = handle.cursor()
-    cursor.execute(query)
+    # Create table, or bring the existing one up to date.
+    with schema_lock():
+        if exists(name):
+            migrate(name, migrations)
+        else:
+            mutex.acquire()
+            handle.execute(query)
+            set_version(name, len(migrations))
+            mutex.release()
+
+    # Drop indices that are no longer declared or changed, and create missing ones.
+    # Other shards may be doing the same, so look and change in one write transaction.
+    wanted = dict(index_statement(name, idx) for idx in indices)
+    mutex.acquire()
+    level = handle.isolation_level
+    # Take over transaction handling, so the sqlite3 module doesn't commit before our DDL.
+    handle.isolation_level = None
+    try:
+        cursor = handle.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('SELECT `name`, `sql` FROM `sqlite_master` WHERE `type` = \'index\' AND `tbl_name` = ? AND `sql` IS NOT NULL', (name,))
+            existing = {row[0]: row[1] for row in cursor.fetchall()}
+            for idx_name, statement in existing.items():
+                if wanted.get(idx_name) != statement:
+                    cursor.execute('DROP INDEX IF EXISTS `{}`'.format(idx_name))
+            for idx_name, statement in wanted.items():
+                if existing.get(idx_name) != statement:
+                    cursor.execute(statement.replace('INDEX', 'INDEX IF NOT EXISTS', 1))
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+    finally:
+        handle.isolation_level = level
+        mutex.release()
 
-    # Create indices.
-    for idx in indices:
-        cursor.execute('CREATE INDEX IF NOT EXISTS `{name}` ON `{table}` (`{name}`)'.format(table=name, name=idx))
-    for idx in unique_indices:
-        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS `{name}` ON `{table}` (`{name}`)'.format(table=name, name=idx))
-    handle.commit()
+def exists(name):
+    """ Check if table exists. """
+    return bool(query(name, 'SELECT `name` FROM `sqlite_master` WHERE `type` = \'table\' AND `name` = ?', name))
+
+
+## Migrations.
+
+@contextlib.contextmanager
+def schema_lock():
+    """
+    Hold the schema lock, so only one shard at a time creates or migrates tables.
+    A transaction can't do here, as migration steps commit in batches.
+    """
+    global schema_file, schema_depth
+
+    mutex.acquire()
+    try:
+        if not schema_depth:
+            schema_file = open(config.ensure_file(DB_FILE + '.lock', writable=True), 'a')
+            fcntl.flock(schema_file, fcntl.LOCK_EX)
+        schema_depth += 1
+        try:
+            yield
+        finally:
+            schema_depth -= 1
+            if not schema_depth:
+                fcntl.flock(schema_file, fcntl.LOCK_UN)
+                schema_file.close()
+                schema_file = None
+    finally:
+        mutex.release()
+
+def version(name):
+    """ Get schema version of table. Tables from before versioning are at version 0. """
+    row = query('_schema', 'SELECT `version` FROM `_schema` WHERE `table` = ?', name)
+    return row[0]['version'] if row else 0
+
+def set_version(name, version):
+    """ Record schema version of table. """
+    query('_schema', 'INSERT OR REPLACE INTO `_schema` (`table`, `version`, `time`) VALUES (?, ?, ?)', name, version, val2db(datetime.datetime.utcnow()))
+
+def migrate(name, migrations):
+    """
+    Run the migration steps table `name` hasn't had yet, recording the new version after each.
+    A step is called with the table name. Steps that handle many rows should be generators:
+    they're expected to commit in batches and yield the amount of rows handled after each one.
+    """
+    # Only look at the version once we have the lock: another shard may have just migrated the table.
+    with schema_lock():
+        current = version(name)
+        for number, step in enumerate(migrations[current:], start=current + 1):
+            print('db: migrating {} to version {}...'.format(name, number))
+            res = step(name)
+
+            if inspect.isgenerator(res):
+                done = 0
+                reported = time.monotonic()
+                for amount in res:
+                    done += amount or 0
+                    if time.monotonic() - reported >= 5:
+                        print('db: migrating {} to version {}: {} rows done...'.format(name, number, done))
+                        reported = time.monotonic()
+                print('db: migrated {} to version {} ({} rows).'.format(name, number, done))
+
+            set_version(name, number)
+
+def batches(table, *fields, size=1000):
+    """ Iterate over all rows of table in `id` order, a batch of `size` rows at a time. """
+    fields = ('id',) + tuple(f for f in fields if f != 'id')
+    last = 0
+    while True:
+        rows = query(table, 'SELECT `{fields}` FROM `{table}` WHERE `id` > ? ORDER BY `id` LIMIT {size}'.format(
+            fields='`, `'.join(fields), table=table, size=int(size)), last)
+        if not rows:
+            break
+        yield rows
+        last = rows[-1]['id']
+
+def add_column(column, type, *attributes):
+    """ Migration step adding a column, unless it's already there. """
+    def step(table):
+        if column in (row['name'] for row in query(table, 'PRAGMA table_info(`{}`)'.format(table))):
+            return
+        try:
+            query(table, 'ALTER TABLE `{}` ADD COLUMN `{}` {} {}'.format(table, column, type, ' '.join(attributes)))
+        except sqlite3.OperationalError as e:
+            # Someone beat us to it after all.
+            if 'duplicate column name' not in str(e):
+                raise
+    return step
+
+def add_index(idx):
+    """ Migration step creating index `idx` early, for steps that need it. """
+    def step(table):
+        name, statement = index_statement(table, idx)
+        query(table, statement.replace('INDEX', 'INDEX IF NOT EXISTS', 1))
+    return step
+
+
+## Inspection.
+
+def explain(query, *fields):
+    """ Print and return the query plan for retrieving `fields` using Query `query`. """
+    global handle, mutex
+
+    statement, vals = query.select(*fields)
+    mutex.acquire()
+    try:
+        cursor = handle.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, vals)
+        plan = [row[-1] for row in cursor.fetchall()]
+    finally:
+        mutex.release()
+
+    print('query plan for: {}'.format(statement))
+    for step in plan:
+        print('  ' + step)
+    return plan
 
 
 def connect():
     """ Connect to the database. """
     global handle
 
-    handle = sqlite3.connect(config.filename(DB_FILE, writable=True), check_same_thread=False)
+    # Wait for other processes to finish writing instead of failing right away.
+    handle = sqlite3.connect(config.filename(DB_FILE, writable=True), timeout=30, check_same_thread=False)
     handle.row_factory = sqlite3.Row
+    # Let maintenance give free pages back. Only has effect on new databases, older ones need maintenance.vacuum().
+    # This has to come before switching to WAL, which already counts as creating the database.
+    handle.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    # Write-ahead logging lets readers in other shards carry on while one of them writes.
+    handle.execute('PRAGMA journal_mode=WAL')
+    # Schema versions of tables, for migrations.
+    handle.execute('CREATE TABLE IF NOT EXISTS `_schema` (`table` text PRIMARY KEY, `version` integer, `time` datetime)')
+    handle.commit()
 
 def disconnect():
     """ Disconnect from the database. """
@@ -111,7 +299,7 @@ class Query:
         # Special case since None never compares to None using '='.
         if val is None and comparator == '=':
             comparator = 'is'
-        self.constraints.append((name, comparator, val, 'or' if or_ else 'and'))
+        self.constraints.append((name, comparator, value, 'or' if or_ else 'and'))
         return self
 
     def or_(self, name, val):
@@ -132,25 +320,31 @@ class Query:
         self.order_ = 'RANDOM()'
         return self
 
-    def get(self, *fields):
-        """ Perform data retrieval query for `fields`. """
-        global mutex
+    def where_clause(self):
+        """ Build WHERE clause and its values. """
+        if not self.constraints:
+            return '', []
 
-        # Build query.
-        query  = 'SELECT {fields} FROM `{table}`'.format(fields='`' + '`, `'.join(fields) + '`' if fields else '*', table=self.table)
-
-        # Build where.
         vals = []
-        if self.constraints:
-            query += ' WHERE '
-            first = True
-            constraint_statements = []
-
-            for name, comparator, value, connector in self.constraints:
+        constraint_statements = []
+        first = True
+        for name, comparator, value, connector in self.constraints:
+            # Spell out NULL checks so partial indices on them can be used.
+            if value is None and comparator.lower() in ('is', 'is not'):
+                constraint_statements.append('{conn} `{field}` {cmp} NULL'.format(field=name, cmp=comparator.upper(), conn='' if first else connector))
+            else:
                 constraint_statements.append('{conn} `{field}` {cmp} ?'.format(field=name, cmp=comparator, conn='' if first else connector))
                 vals.append(val2db(value))
-                first = False
-            query += ' '.join(constraint_statements)
+            first = False
+        return ' WHERE ' + ' '.join(constraint_statements), vals
+
+    def select(self, *fields):
+        """ Build data retrieval query for `fields` and its values. """
+        query  = 'SELECT {fields} FROM `{table}`'.format(fields='`' + '`, `'.join(fields) + '`' if fields else '*', table=self.table)
+
+        # Build where.
+        where, vals = self.where_clause()
+        query += where
 
         # Build order.
         if self.order_ is not None:
@@ -159,10 +353,17 @@ class Query:
         if self.limit_ is not None:
             query += ' LIMIT ' + str(self.limit_)
 
+        return query, tuple(vals)
+
+    def get(self, *fields):
+        """ Perform data retrieval query for `fields`. """
+        global mutex
+
         # Perform query.
+        query, vals = self.select(*fields)
         mutex.acquire()
         cursor = self.handle.cursor()
-        cursor.execute(query, tuple(vals))
+        cursor.execute(query, vals)
         data = cursor.fetchall()
         mutex.release()
 
@@ -200,17 +401,8 @@ class Query:
         query = 'DELETE FROM `{table}`'.format(table=self.table)
 
         # Build where.
-        vals = []
-        if self.constraints:
-            query += ' WHERE '
-            first = True
-            constraint_statements = []
-
-            for name, comparator, value, connector in self.constraints:
-                constraint_statements.append('{conn} `{field}` {cmp} ?'.format(field=name, cmp=comparator, conn='' if first else connector))
-                vals.append(val2db(value))
-                first = False
-            query += ' '.join(constraint_statements)
+        where, vals = self.where_clause()
+        query += where
 
         # Execute.
         mutex.acquire()
@@ -234,20 +426,13 @@ class Query:
 
             for field, value in values.items():
                 value_statements.append('`{field}` = ?'.format(field=field))
-                vals.append(value)
+                vals.append(val2db(value))
             query += ', '.join(value_statements)
 
         # Build where.
-        if self.constraints:
-            query += ' WHERE '
-            first = True
-            constraint_statements = []
-
-            for name, comparator, value, connector in self.constraints:
-                constraint_statements.append('{conn} `{field}` {cmp} ?'.format(field=name, cmp=comparator, conn='' if first else connector))
-                vals.append(val2db(value))
-                first = False
-            query += ' '.join(constraint_statements)
+        where, where_vals = self.where_clause()
+        query += where
+        vals.extend(where_vals)
 
         # Execute.
         mutex.acquire()
@@ -282,14 +467,38 @@ def query(table, query, *vals):
 
     # Perform query, commit results, receive data.
     mutex.acquire()
-    cursor = handle.cursor()
-    cursor.execute(query, tuple(vals))
-    data = cursur.fetchall()
-    cursor.commit()
-    mutex.release()
+    try:
+        cursor = handle.cursor()
+        cursor.execute(query, tuple(vals))
+        data = cursor.fetchall()
+        handle.commit()
+    except:
+        # Don't leave a half-done transaction for the next commit to pick up.
+        handle.rollback()
+        raise
+    finally:
+        mutex.release()
 
     return data
 
+def query_many(table, query, vals):
+    """ Perform a raw query on data for every set of values in `vals`, in a single transaction. """
+    global handle, mutex
+
+    mutex.acquire()
+    try:
+        cursor = handle.cursor()
+        cursor.executemany(query, (tuple(v) for v in vals))
+        handle.commit()
+    except:
+        # All or nothing.
+        handle.rollback()
+        raise
+    finally:
+        mutex.release()
+
+    return cursor.rowcount
+
 
 def val2db(val, raw=True):
     """
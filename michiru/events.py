@@ -1,25 +1,62 @@
 # Event bus.
+import time
 import traceback
 import asyncio
+
+from . import config
+
+# Event -> list of (module name, hook).
 hooks = {}
+# Bumped whenever hooks or modules change.
+generation = 0
+# (event, server, channel) -> enabled hooks, valid for (`generation`, configuration generation) `index_generation`.
+index = {}
+index_generation = None
+# Don't let the index grow without bounds from private message targets.
+INDEX_LIMIT = 4096
+# When the last event was emitted, to tell when we're idle.
+last_event = 0
 
-def register_hook(event, cmd):
-    """ Register hook for `event`. """
+def changed():
+    """ Mark registered hooks or module state as changed. """
+    global generation
+    generation += 1
+
+def register_hook(event, cmd, module=None):
+    """ Register hook for `event`, owned by `module`. """
     if event not in hooks:
         hooks[event] = []
-    hooks[event].append(cmd)
+    hooks[event].append((module, cmd))
+    changed()
 
-def unregister_hook(event, cmd):
+def unregister_hook(event, cmd, module=None):
     """ Unregister hook for `event`. """
-    if event in hooks and cmd in hooks[event]:
-        hooks[event].remove(cmd)
+    if event in hooks:
+        hooks[event] = [(m, c) for m, c in hooks[event] if c != cmd]
+    changed()
+
+def hooks_for(event, server=None, channel=None):
+    """ Get hooks for `event` whose modules are enabled for given server and channel. """
+    from . import modules
+    global index_generation
+
+    current = (generation, config.generation)
+    if index_generation != current or len(index) > INDEX_LIMIT:
+        index.clear()
+        index_generation = current
+
+    key = event, server, channel
+    if key not in index:
+        index[key] = [cmd for module, cmd in hooks.get(event, ()) if module is None or modules.module_enabled(module, server, channel)]
+    return index[key]
 
 @asyncio.coroutine
-def emit(event, *args, **kwargs):
-    """ Emit event. """
-    if event in hooks:
-        for hook in hooks[event]:
-            try:
-                yield from hook(*args, **kwargs)
-            except:
-                traceback.print_exc()
+def emit(event, *args, _server=None, _channel=None, **kwargs):
+    """ Emit event. Pass `_server` and `_channel` to only run hooks of modules enabled there. """
+    global last_event
+    last_event = time.monotonic()
+    for hook in hooks_for(event, _server, _channel):
+        try:
+            yield from hook(*args, **kwargs)
+        except:
+            traceback.print_exc()
@@ -0,0 +1,226 @@
+# Retention and compaction of module tables.
+import time
+import datetime
+import sqlite3
+import traceback
+import asyncio
+
+from . import config, db, events, shards
+
+config.item('maintenance.interval', 3600)
+config.item('maintenance.idle_time', 30)
+config.item('maintenance.batch_size', 500)
+config.item('maintenance.pause', 0.5)
+config.item('maintenance.vacuum_pages', 1000)
+config.item('maintenance.report_interval', 5)
+# Table -> {'max_age': seconds, 'max_rows': amount}, overriding what modules register.
+config.item('maintenance.policies', {})
+
+db.table('_maintenance', {
+    'id': db.ID,
+    'table': (db.STRING, db.UNIQUE),
+    'deleted': db.INT,
+    'time': db.DATETIME
+})
+
+# Table -> retention policy.
+policies = {}
+task = None
+# Shard index -> (when it reported, seconds since its last event at the time, whether it had messages waiting).
+activity = {}
+
+
+## Policies.
+
+def register(table, max_age=None, max_rows=None, key=(), column='time'):
+    """
+    Register retention policy for `table`: rows with `column` older than `max_age` seconds get deleted,
+    as do all but the newest `max_rows` rows for every distinct value of the `key` columns.
+    """
+    policies[table] = {
+        'max_age': max_age,
+        'max_rows': max_rows,
+        'key': tuple(key),
+        'column': column
+    }
+
+def unregister(table):
+    """ Unregister retention policy for `table`. """
+    policies.pop(table, None)
+
+def policy(table):
+    """ Get retention policy for `table`, with configured overrides. """
+    res = dict(policies[table])
+    res.update(config.get('maintenance.policies').get(table, {}))
+    return res
+
+
+## Pruning.
+
+def prune(table):
+    """ Delete rows of `table` outside its retention policy, a batch at a time. Yields the amount of rows deleted per batch. """
+    rules = policy(table)
+    size = config.get('maintenance.batch_size')
+
+    if rules['max_age']:
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=rules['max_age'])
+        query = 'DELETE FROM `{table}` WHERE `id` IN (SELECT `id` FROM `{table}` WHERE `{column}` < ? LIMIT ?)'.format(table=table, column=rules['column'])
+        while True:
+            deleted = db.query_many(table, query, [(db.val2db(cutoff), size)])
+            if not deleted:
+                break
+            yield deleted
+
+    if rules['max_rows']:
+        key = rules['key']
+        if key:
+            columns = ', '.join('`{}`'.format(k) for k in key)
+            groups = db.query(table, 'SELECT {columns}, COUNT(*) AS `amount` FROM `{table}` GROUP BY {columns} HAVING COUNT(*) > ?'.format(
+                columns=columns, table=table), rules['max_rows'])
+        else:
+            groups = [row for row in db.query(table, 'SELECT COUNT(*) AS `amount` FROM `{}`'.format(table)) if row['amount'] > rules['max_rows']]
+
+        match = ' AND '.join('`{}` IS ?'.format(k) for k in key) or '1'
+        query = 'DELETE FROM `{table}` WHERE `id` IN (SELECT `id` FROM `{table}` WHERE {match} ORDER BY `id` LIMIT ?)'.format(table=table, match=match)
+        for group in groups:
+            excess = group['amount'] - rules['max_rows']
+            while excess > 0:
+                deleted = db.query_many(table, query, [tuple(group[k] for k in key) + (min(excess, size),)])
+                if not deleted:
+                    break
+                excess -= deleted
+                yield deleted
+
+def compact():
+    """ Give some free pages back to the file system and let SQLite update its statistics. """
+    # Databases from before incremental vacuuming need a full vacuum() first, which is up to an administrator.
+    if incremental():
+        db.query(None, 'PRAGMA incremental_vacuum({})'.format(int(config.get('maintenance.vacuum_pages'))))
+    db.query(None, 'PRAGMA optimize')
+
+def incremental():
+    """ Check if the database supports incremental vacuuming. """
+    return db.query(None, 'PRAGMA auto_vacuum')[0][0] == 2
+
+def vacuum():
+    """ Rebuild the database, giving back all free pages and enabling incremental vacuuming. Blocks all database access while it runs. """
+    db.query(None, 'PRAGMA auto_vacuum = INCREMENTAL')
+    db.query(None, 'VACUUM')
+
+def record(table, deleted):
+    """ Record maintenance run for `table`. """
+    db.query('_maintenance', 'INSERT OR REPLACE INTO `_maintenance` (`table`, `deleted`, `time`) VALUES (?, ?, ?)',
+        table, deleted, db.val2db(datetime.datetime.now()))
+
+
+## Scheduling.
+
+def local_activity():
+    """ Get seconds since the last event in this shard, and whether it has messages waiting to be sent. """
+    from . import chat
+    return time.monotonic() - events.last_event, any(bot.outbound.depth() for bot in chat.bots.values())
+
+def idle():
+    """ Check if nothing happened for a while and nothing is waiting to be sent, in any shard. """
+    now = time.monotonic()
+    reports = [local_activity()]
+    # Ignore shards that stopped reporting, they might be gone.
+    for stamp, ago, queued in activity.values():
+        if now - stamp < 3 * config.get('maintenance.report_interval'):
+            reports.append((ago + now - stamp, queued))
+    return all(ago >= config.get('maintenance.idle_time') and not queued for ago, queued in reports)
+
+@shards.action('maintenance_activity')
+def receive_activity(index, ago, queued):
+    activity[index] = (time.monotonic(), ago, queued)
+
+@asyncio.coroutine
+def report(loop):
+    """ Tell the primary shard how busy we are every so often, so it knows when everyone is idle. """
+    while True:
+        ago, queued = local_activity()
+        shards.broadcast('maintenance_activity', shards.index, ago, queued)
+        yield from asyncio.sleep(config.get('maintenance.report_interval'), loop=loop)
+
+@asyncio.coroutine
+def wait_idle(loop):
+    """ Wait until we're idle. """
+    while not idle():
+        yield from asyncio.sleep(config.get('maintenance.idle_time'), loop=loop)
+
+@asyncio.coroutine
+def run(loop):
+    """ Prune all tables with a retention policy and compact the database, backing off whenever we get busy. """
+    for table in sorted(policies):
+        deleted = 0
+        try:
+            yield from wait_idle(loop)
+            for amount in prune(table):
+                deleted += amount
+                yield from asyncio.sleep(config.get('maintenance.pause'), loop=loop)
+                yield from wait_idle(loop)
+        except sqlite3.Error:
+            traceback.print_exc()
+        record(table, deleted)
+
+    yield from wait_idle(loop)
+    compact()
+
+@asyncio.coroutine
+def scheduler(loop):
+    """ Run maintenance every interval. """
+    while True:
+        yield from asyncio.sleep(config.get('maintenance.interval'), loop=loop)
+        try:
+            yield from run(loop)
+        except:
+            traceback.print_exc()
+
+def start(loop):
+    """ Start the maintenance scheduler on the primary shard, and activity reports to it on the others. """
+    global task
+    if task is None:
+        task = asyncio.ensure_future(scheduler(loop) if shards.primary() else report(loop), loop=loop)
+
+def stop():
+    """ Stop the maintenance scheduler or activity reports. """
+    global task
+    if task is not None:
+        task.cancel()
+        task = None
+
+
+## Inspection.
+
+def stats():
+    """ Get row count, size on disk and last run of every table with a retention policy. """
+    # Sizes need SQLite to be built with the dbstat table.
+    try:
+        sizes = {row['table']: row['size'] for row in db.query(None, '''
+            SELECT m.`tbl_name` AS `table`, SUM(s.`pgsize`) AS `size`
+            FROM `dbstat` AS s JOIN `sqlite_master` AS m ON m.`name` = s.`name`
+            GROUP BY m.`tbl_name`
+        ''')}
+    except sqlite3.Error:
+        sizes = {}
+    runs = {row['table']: row for row in db.from_('_maintenance').get('table', 'deleted', 'time')}
+
+    res = []
+    for table in sorted(policies):
+        run = runs.get(table)
+        res.append({
+            'table': table,
+            'rows': db.query(table, 'SELECT COUNT(*) FROM `{}`'.format(table))[0][0],
+            'size': sizes.get(table),
+            'deleted': run['deleted'] if run else None,
+            'time': run['time'] if run else None
+        })
+    return res
+
+def file_stats():
+    """ Get size of the database and amount of free space in it, in bytes. """
+    page_size = db.query(None, 'PRAGMA page_size')[0][0]
+    return {
+        'size': db.query(None, 'PRAGMA page_count')[0][0] * page_size,
+        'free': db.query(None, 'PRAGMA freelist_count')[0][0] * page_size
+    }
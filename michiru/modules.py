@@ -9,7 +9,8 @@ import asyncio
 
 from . import config, \
               events, \
-              personalities
+              personalities, \
+              shards
 _ = personalities.localize
 
 config.item('modules', [])
@@ -57,6 +58,14 @@ def unregister_command(name, pattern, cmd, bare=False, case_sensitive=False, fal
 
     commands.remove((name, pattern, cmd, bare, fallback))
 
+def module_enabled(name, server=None, channel=None):
+    """ Check if module is loaded and enabled for given server and channel. """
+    if name not in modules.keys():
+        return False
+
+    module, initialized, enabled = modules[name]
+    return config.dict('modules', server, channel).get(name, enabled)
+
 def commands_for(server, channel):
     """ Get all enabled commands for given server and channel. """
     enabledcmds = []
@@ -85,10 +94,12 @@ def commands_for(server, channel):
 
 ## Module enabling/disabling.
 
+@shards.action('enable')
 def enable(name, server=None, channel=None):
     """ Enable module for given server and/or channel, or globally. """
     config.setitem('modules', name, True, server, channel)
 
+@shards.action('disable')
 def disable(name, server=None, channel=None):
     """ Disable module for given server and/or channel, or globally. """
     config.setitem('modules', name, False, server, channel)
@@ -114,9 +125,20 @@ def hook(event):
         return func
     return inner
 
+def restricted(func):
+    """ Decorator a module can use for commands only administrators may use. """
+    @functools.wraps(func)
+    def inner(bot, server, target, source, message, parsed, private, admin):
+        if not admin:
+            raise EnvironmentError(_(bot, 'This command is restricted to administrators.', cmd=func.__name__))
+        else:
+            return func(bot, server, target, source, message, parsed, private=private, admin=admin)
+    return inner
+
 
 # Module loading/unloading.
 
+@shards.action('load')
 def load(name, soft=True, reload=False):
     """
     Load the given module. If doing a soft load, will not try to load the module from disk again,
@@ -159,7 +181,7 @@ def load(name, soft=True, reload=False):
                 for pattern, cmd, bare, case_sensitive, fallback in module_cmds:
                     register_command(module_name, pattern, cmd, bare, case_sensitive, fallback)
                 for event, cmd in module_hks:
-                    events.register_hook(event, cmd)
+                    events.register_hook(event, cmd, module_name)
                 return module_load()
 
             @functools.wraps(module_unload)
@@ -167,7 +189,7 @@ def load(name, soft=True, reload=False):
                 for pattern, cmd, bare, case_sensitive, fallback in module_cmds:
                     unregister_command(module_name, pattern, cmd, bare, case_sensitive, fallback)
                 for event, cmd in module_hks:
-                    events.unregister_hook(event, cmd)
+                    events.unregister_hook(event, cmd, module_name)
                 return module_unload()
 
             module.load = overridden_load
@@ -198,12 +220,14 @@ def load(name, soft=True, reload=False):
             raise EnvironmentError('Error while loading module {mod}: {err}'.format(mod=name, err=e))
 
         modules[name] = module, True, enabled
+        events.changed()
 
     # And reload depending modules.
     if reload:
         for dep in dependencies.get(name, []):
             load(dep, soft=soft, reload=True)
 
+@shards.action('unload')
 def unload(name, soft=True):
     """
     Unload the given module. If doing a soft unload, will not remove the module from memory,
@@ -233,6 +257,7 @@ def unload(name, soft=True):
         del modules[name]
         if name in config.list('modules'):
             config.delete('modules', name)
+    events.changed()
 
 def unload_all(soft=True):
     """ Unload all modules. """
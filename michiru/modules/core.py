@@ -3,10 +3,10 @@ import os
 import sys
 import io
 import math
-import functools
+import asyncio
 
-from michiru import config, db, chat, modules, personalities, version
-from michiru.modules import command
+from michiru import config, db, chat, maintenance, modules, personalities, shards, version, workers
+from michiru.modules import command, restricted
 _ = personalities.localize
 
 
@@ -21,7 +21,7 @@ __desc__ = 'Core functionality.'
 
 personalities.messages('fancy', {
     'This command is restricted to administrators.':
-        '{b}{msg}{/b} is restricted to administrators.',
+        '{b}{cmd}{/b} is restricted to administrators.',
     'Administrator {nick} added.':
         'Administrator {b}[{nick}]{/b} added.',
     'Administrator {nick} removed.':
@@ -140,14 +140,14 @@ personalities.messages('tsun', {
 
 ## Helper functions.
 
-def restricted(func):
-    @functools.wraps(func)
-    def inner(bot, server, target, source, message, parsed, private, admin):
-        if not admin:
-            raise EnvironmentError(_(bot, 'This command is restricted to administrators.', cmd=func.__name__))
-        else:
-            return func(bot, server, target, source, message, parsed, private=private, admin=admin)
-    return inner
+def si_ify(n):
+    """ Turn amount of bytes into readable string including binary prefix. """
+    orders = ['k', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y']
+    order = math.floor(math.log(n, 2) / 10) if n else 0
+    n /= math.pow(2, order * 10)
+    if order:
+        return '{n} {u}iB'.format(n=round(n, 2), u=orders[order - 1])
+    return '{n} B'.format(n=n)
 
 
 ## Admin commands.
@@ -194,6 +194,7 @@ def enable(bot, server, target, source, message, parsed, private, admin):
         server = parsed.group(2)
         channel = parsed.group(3)
         modules.enable(module, server, channel)
+        shards.broadcast('enable', module, server, channel)
 
         yield from bot.message(target, _(bot, 'Module {mod} enabled for channel {chan}.', mod=module, srv=server, chan=channel))
     elif parsed.group(2):
@@ -201,12 +202,15 @@ def enable(bot, server, target, source, message, parsed, private, admin):
 
         if server != 'global' and server != 'globally':
             modules.enable(module, server)
+            shards.broadcast('enable', module, server)
             yield from bot.message(target, _(bot, 'Module {mod} enabled for server {srv}.', mod=module, srv=server))
         else:
             modules.enable(module)
+            shards.broadcast('enable', module)
             yield from bot.message(target, _(bot, 'Module {mod} globally enabled.', mod=module))
     else:
         modules.enable(module, server, target)
+        shards.broadcast('enable', module, server, target)
 
         yield from bot.message(target, _(bot, 'Module {mod} enabled for channel {chan}.', mod=module, srv=server, chan=target))
 
@@ -218,6 +222,7 @@ def disable(bot, server, target, source, message, parsed, private, admin):
         server = parsed.group(2)
         channel = parsed.group(3)
         modules.disable(module, server, channel)
+        shards.broadcast('disable', module, server, channel)
 
         yield from bot.message(target, _(bot, 'Module {mod} disabled for channel {chan}.', mod=module, srv=server, chan=channel))
     elif parsed.group(2):
@@ -225,12 +230,15 @@ def disable(bot, server, target, source, message, parsed, private, admin):
 
         if server != 'global' and server != 'globally':
             modules.disable(module, server)
+            shards.broadcast('disable', module, server)
             yield from bot.message(target, _(bot, 'Module {mod} disabled for server {srv}.', mod=module, srv=server))
         else:
             modules.disable(module)
+            shards.broadcast('disable', module)
             yield from bot.message(target, _(bot, 'Module {mod} globally disabled.', mod=module))
     else:
         modules.disable(module, server, target)
+        shards.broadcast('disable', module, server, target)
 
         yield from bot.message(target, _(bot, 'Module {mod} disabled for channel {chan}.', mod=module, srv=server, chan=target))
 
@@ -240,6 +248,7 @@ def disable(bot, server, target, source, message, parsed, private, admin):
 def load(bot, server, target, source, message, parsed, private, admin):
     module = parsed.group(1)
     modules.load(module)
+    shards.broadcast('load', module)
     yield from bot.message(target, _(bot, 'Module {mod} loaded.', mod=module))
 
 @command(r'unload (?:the )?(\S+)(?: module)?(?:(?:the )?hard(?: way)?)?\.?')
@@ -247,6 +256,7 @@ def load(bot, server, target, source, message, parsed, private, admin):
 def unload(bot, server, target, source, message, parsed, private, admin):
     module = parsed.group(1)
     modules.unload(module)
+    shards.broadcast('unload', module)
     yield from bot.message(target, _(bot, 'Module {mod} unloaded.', mod=module))
 
 @command(r'reload (?:the )?(\S+)(?: module)?\.?')
@@ -254,6 +264,7 @@ def unload(bot, server, target, source, message, parsed, private, admin):
 def reload(bot, server, target, source, message, parsed, private, admin):
     module = parsed.group(1)
     modules.load(module, reload=True)
+    shards.broadcast('load', module, reload=True)
     yield from bot.message(target, _(bot, 'Module {mod} reloaded.', mod=module))
 
 @command(r'loaded')
@@ -273,9 +284,9 @@ def join(bot, server, target, source, message, parsed, private, admin):
         target_serv = server
         target_chan = parsed.group(1)
 
-    if not target_serv in chat.bots.keys():
-        raise EnvironmentError(_('Unknown server {srv}.', srv=target_serv))
-    chat.bots[target_serv].join_(target_chan, parsed.group(3))
+    if not target_serv in config.get('servers'):
+        raise EnvironmentError(_(bot, 'Unknown server {srv}.', srv=target_serv))
+    yield from chat.perform('join', target_serv, target_chan, parsed.group(3))
 
 @command(r'part(?: (\S+)(?: (\S+)(?: (\S+))?)?)?\.?$')
 @restricted
@@ -290,15 +301,15 @@ def part(bot, server, target, source, message, parsed, private, admin):
         target_serv = server
         target_chan = target
 
-    if not target_serv in chat.bots.keys():
-        raise EnvironmentError(_('Unknown server {srv}.', srv=target_serv))
-    chat.bots[target_serv].part(target_chan, parsed.group(3) or _(bot, 'Parted.'))
+    if not target_serv in config.get('servers'):
+        raise EnvironmentError(_(bot, 'Unknown server {srv}.', srv=target_serv))
+    yield from chat.perform('part', target_serv, target_chan, parsed.group(3) or _(bot, 'Parted.'))
 
 @command(r'connect (\S+)(?: ([0-9]+)(?: (true|false))?)?')
 @command(r'connect to (\S+)(?: with port ([0-9]+)(?: and TLS set to (true|false))?)?\.?$')
 @restricted
 def connect(bot, server, target, source, message, parsed, private, admin):
-    info = bot.michiru_config.copy()
+    info = bot.info.copy()
     info['channels'] = []
     info['host'] = parsed.group(1)
     if parsed.group(3):
@@ -307,13 +318,12 @@ def connect(bot, server, target, source, message, parsed, private, admin):
         info['port'] = int(parsed.group(2))
 
     tag = info['host'].rsplit('.', 2)[1]
-    if tag in chat.bots:
+    if tag in config.get('servers'):
         raise EnvironmentError(_('Already connected to {tag}.', tag=tag))
 
     yield from bot.message(target, _(bot, 'Connecting to {tag}... this might take a while.', tag=tag, host=info['host'], port=info['port']))
-    config.current['servers'][tag] = info
-
-    chat.connect(tag, info)
+    chat.add(tag, info)
+    shards.broadcast('connect', tag, info)
 
     yield from bot.message(target, _(bot, 'Connected to {tag} successfully.', tag=tag, host=info['host'], port=info['port']))
 
@@ -322,13 +332,14 @@ def connect(bot, server, target, source, message, parsed, private, admin):
 def quit(bot, server, target, source, message, parsed, private, admin):
     if parsed.group(1):
         serv = parsed.group(1)
-        if not serv in chat.bots.keys():
-            raise EnvironmentError(_('Unknown server {srv}.', srv=serv))
+        if not serv in config.get('servers'):
+            raise EnvironmentError(_(bot, 'Unknown server {srv}.', srv=serv))
 
-        chat.bots[parsed.group(1)].quit(_('Quit'))
+        yield from chat.perform('quit', serv, _(bot, 'Quit'))
     else:
-        for bot in chat.bots.values():
-            bot.quit(_('Quit'))
+        reason = _(bot, 'Quit')
+        for serv in list(config.get('servers')):
+            yield from chat.perform('quit', serv, reason)
 
 
 ## Ignore/unignore commands.
@@ -568,15 +579,6 @@ def stats(bot, server, target, source, message, parsed, private, admin):
     except:
         raise EnvironmentError(_('"psutil" module not found.'))
 
-    # Helper function. Turn amount into readable string including SI prefix.
-    def si_ify(n):
-        orders = ['k', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y']
-        order = math.floor(math.log(n, 2) / 10)
-        n /= math.pow(2, order * 10)
-        if order:
-            return '{n} {u}iB'.format(n=round(n, 2), u=orders[order - 1])
-        return '{n} B'.format(n=n)
-
     # And dump info.
     proc = psutil.Process(os.getpid())
     try:
@@ -591,11 +593,64 @@ def stats(bot, server, target, source, message, parsed, private, admin):
         threadcount=proc.num_threads(),
         conncount=conncount))
 
+@command(r'queues')
+@command(r'how busy are you\??')
+def queues(bot, server, target, source, message, parsed, private, admin):
+    stats = []
+    for tag, b in sorted(chat.bots.items()):
+        info = b.outbound.stats()
+        stats.append(_(bot, '{tag}: {depth} queued, {sent} sent, {latency}ms latency (max {max_latency}ms)',
+            tag=tag,
+            depth=info['depth'],
+            sent=info['sent'],
+            latency=round(info['latency'] * 1000),
+            max_latency=round(info['max_latency'] * 1000)))
+
+    # Other shards keep their own queues.
+    if shards.active():
+        yield from bot.message(target, _(bot, 'Outbound queues on shard {index}/{count}: {queues}', index=shards.index + 1, count=shards.count, queues='; '.join(stats)))
+    else:
+        yield from bot.message(target, _(bot, 'Outbound queues: {queues}', queues='; '.join(stats)))
+
+@command(r'(?:db|database) stats')
+@command(r'how (?:big|fat) is your database\??')
+@restricted
+def dbstats(bot, server, target, source, message, parsed, private, admin):
+    stats = []
+    for info in maintenance.stats():
+        stats.append(_(bot, '{table}: {rows} rows, {size}, last pruned {time} ({deleted} deleted)',
+            table=info['table'],
+            rows=info['rows'],
+            size=si_ify(info['size']) if info['size'] is not None else '?',
+            time=info['time'] or _(bot, 'never'),
+            deleted=info['deleted'] or 0))
+
+    info = maintenance.file_stats()
+    yield from bot.message(target, _(bot, 'Database: {size} ({free} free); {tables}',
+        size=si_ify(info['size']),
+        free=si_ify(info['free']),
+        tables='; '.join(stats)))
+
+@command(r'vacuum (?:the )?(?:db|database)\.?$')
+@restricted
+def vacuum(bot, server, target, source, message, parsed, private, admin):
+    before = maintenance.file_stats()
+    # Make sure the message is out before everything stalls.
+    yield from bot.message(target, _(bot, 'Vacuuming database... this might take a while.'), urgent=True)
+    maintenance.vacuum()
+
+    after = maintenance.file_stats()
+    yield from bot.message(target, _(bot, 'Database vacuumed: {before} to {after}.', before=si_ify(before['size']), after=si_ify(after['size'])))
+
 
 ## Boilerplate.
 
 def load():
+    # Maintenance works on the shared database, so the primary shard does it for everyone while the others report how busy they are.
+    maintenance.start(asyncio.get_event_loop())
     return True
 
 def unload():
-    pass
+    maintenance.stop()
+    # Stop whatever workers other modules left running.
+    workers.shutdown()
@@ -2,9 +2,10 @@
 import re
 import functools
 import asyncio
+from datetime import datetime
 
-from michiru import config, db, personalities
-from michiru.modules import command, hook
+from michiru import config, db, maintenance, personalities
+from michiru.modules import command, hook, restricted
 _ = personalities.localize
 
 
@@ -19,22 +20,51 @@ __desc__ = '3-2-1... Anime!'
 
 config.item('countdown.ready_messages', [r'(^|\s+)(r+|q+)($|\s+)'])
 
+def date_countdowns(table):
+    """ Pretend countdowns from before we kept track of their age were just started. """
+    db.query(table, 'UPDATE `{}` SET `time` = ? WHERE `time` IS NULL'.format(table), db.val2db(datetime.now()))
+
 db.table('countdowns', {
     'id': db.ID,
     'server': (db.STRING, db.INDEX),
     'channel': (db.STRING, db.INDEX),
     'people': db.STRING,
     'count': db.UINT,
-    'message': db.BINARY
-})
+    'message': db.BINARY,
+    'time': db.DATETIME
+}, migrations=[
+    db.add_column('time', db.DATETIME),
+    date_countdowns
+])
+# Nobody is getting ready for a countdown started a day ago.
+maintenance.register('countdowns', max_age=24 * 60 * 60)
+
+# (server, channel) -> pending countdown. The database only mirrors this so countdowns survive restarts.
+ACTIVE = {}
+# (server, channel) -> running countdown task.
+RUNNING = {}
+# (server, channel) -> compiled ready messages, valid for configuration generation `ready_generation`.
+ready_patterns = {}
+ready_generation = None
+
+def ready_messages(server, channel):
+    """ Get compiled ready messages for channel, only compiling them again when the configuration changed. """
+    global ready_generation
+
+    if ready_generation != config.generation:
+        ready_patterns.clear()
+        ready_generation = config.generation
+    if (server, channel) not in ready_patterns:
+        ready_patterns[server, channel] = [re.compile(ready, re.IGNORECASE) for ready in config.list('countdown.ready_messages', server, channel)]
+    return ready_patterns[server, channel]
 
 @asyncio.coroutine
 def check_countdown(bot, server, channel, person=None):
-    current = db.from_('countdowns').where('server', server).and_('channel', channel).single()
+    current = ACTIVE.get((server, channel))
     if not current:
         return
 
-    people = current['people'].split(',') if current['people'] else []
+    people = current['people']
     if person and person.lower() in people:
         people.remove(person.lower())
         db.on('countdowns').where('id', current['id']).update({
@@ -42,12 +72,41 @@ def check_countdown(bot, server, channel, person=None):
         })
 
     if not people:
+        del ACTIVE[server, channel]
         db.from_('countdowns').where('id', current['id']).delete()
-        # Start countdown.
-        for count in range(current['count']):
-            yield from bot.message(channel, _(bot, '{count}'.format(count=current['count'] - count)))
-            yield from asyncio.sleep(1)
-        yield from bot.message(channel, _(bot, '{countmessage}!', countmessage=current['message'].decode('utf-8')))
+        start_countdown(bot, server, channel, current['count'], current['message'])
+
+def start_countdown(bot, server, channel, count, message):
+    """ Start countdown in the background, so we don't hold up other hooks. """
+    key = server, channel
+    if key in RUNNING:
+        RUNNING[key].cancel()
+
+    task = asyncio.ensure_future(run_countdown(bot, channel, count, message), loop=bot.loop)
+    RUNNING[key] = task
+
+    def finished(t):
+        if RUNNING.get(key) is t:
+            del RUNNING[key]
+    task.add_done_callback(finished)
+
+@asyncio.coroutine
+def run_countdown(bot, channel, count, message):
+    """ Count down, keeping ticks a second apart no matter how long sending them takes. """
+    # Ticks skip the outbound queue and flood control, and we wait for them to go out, so they actually leave a second apart.
+    try:
+        start = bot.loop.time()
+        for tick in range(count):
+            yield from bot.message(channel, _(bot, '{count}'.format(count=count - tick)), urgent=True)
+            # Sleep until the next tick is due instead of a full second.
+            delay = start + tick + 1 - bot.loop.time()
+            if delay > 0:
+                yield from asyncio.sleep(delay, loop=bot.loop)
+        yield from bot.message(channel, _(bot, '{countmessage}!', countmessage=message), urgent=True)
+    except asyncio.CancelledError:
+        # Don't let ticks of a cancelled countdown trickle out.
+        bot.outbound.discard(channel)
+        raise
 
 
 ## Commands.
@@ -58,30 +117,90 @@ def countdown(bot, server, target, source, message, parsed, private, admin):
 
     if parsed.group('people'):
         people = re.split(r'(?:,\s*|\s*and\s*)', parsed.group('people'))
-        people = ','.join(people).lower()
+        people = [person.lower() for person in people]
     else:
-        people = ''
+        people = []
 
-    db.to('countdowns').add({
-        'server': server,
-        'channel': target,
+    current = {
         'people': people,
         'count': max(0, min(10, int(parsed.group('count')) if parsed.group('count') else 5)),
-        'message': (parsed.group('msg') or 'Go').encode('utf-8')
+        'message': parsed.group('msg') or 'Go'
+    }
+    current['id'] = db.to('countdowns').add({
+        'server': server,
+        'channel': target,
+        'people': ','.join(people),
+        'count': current['count'],
+        'message': current['message'].encode('utf-8'),
+        'time': datetime.now()
     })
+    ACTIVE[server, target] = current
     yield from check_countdown(bot, server, target)
 
+@command(r'(?:list )?countdowns\??$')
+@restricted
+def list_countdowns(bot, server, target, source, message, parsed, private, admin):
+    countdowns = []
+    for srv, chan in sorted(RUNNING):
+        if srv != server:
+            continue
+        countdowns.append(_(bot, '{srv}:{chan} (running)', srv=srv, chan=chan))
+    for (srv, chan), current in sorted(ACTIVE.items()):
+        if srv != server:
+            continue
+        countdowns.append(_(bot, '{srv}:{chan} (waiting for {people})', srv=srv, chan=chan, people=', '.join(current['people'])))
+
+    if countdowns:
+        yield from bot.message(target, _(bot, 'Countdowns: {countdowns}', countdowns='; '.join(countdowns)))
+    else:
+        yield from bot.message(target, _(bot, 'No countdowns.'))
+
+@command(r'cancel countdown(?: (?:in|on) (\S+))?\.?$')
+@restricted
+def cancel_countdown(bot, server, target, source, message, parsed, private, admin):
+    chan = parsed.group(1) or target
+    found = False
+    if (server, chan) in RUNNING:
+        RUNNING.pop((server, chan)).cancel()
+        found = True
+    if (server, chan) in ACTIVE:
+        del ACTIVE[server, chan]
+        db.from_('countdowns').where('server', server).and_('channel', chan).delete()
+        found = True
+
+    if found:
+        yield from bot.message(target, _(bot, 'Countdown for {chan} cancelled.', chan=chan))
+    else:
+        yield from bot.message(target, _(bot, 'No countdown for {chan}.', chan=chan))
+
 @hook('chat.message')
 def message(bot, server, target, who, message, private, admin):
-    for ready in config.list('countdown.ready_messages', server, target):
-        if re.search(ready, message, re.IGNORECASE):
+    if (server, target) not in ACTIVE:
+        return
+
+    for ready in ready_messages(server, target):
+        if ready.search(message):
             yield from check_countdown(bot, server, target, who)
 
 
 ## Module stuff.
 
 def load():
+    # Shards still running older code might have added countdowns without a time since the migration.
+    date_countdowns('countdowns')
+    # Pick up countdowns that were pending before we went down.
+    for row in db.from_('countdowns').get():
+        ACTIVE[row['server'], row['channel']] = {
+            'id': row['id'],
+            'people': row['people'].split(',') if row['people'] else [],
+            'count': row['count'],
+            'message': row['message'].decode('utf-8')
+        }
     return True
 
 def unload():
-    pass
+    for task in RUNNING.values():
+        task.cancel()
+    RUNNING.clear()
+    ACTIVE.clear()
+    ready_patterns.clear()
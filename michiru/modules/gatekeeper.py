@@ -28,13 +28,22 @@ def join(bot, server, channel, who):
     if who in config.list('gatekeeper.whitelist', server, channel):
         return
 
-    # Get channel list and strip status info.
-    info = bot.whois(who)
-    channels = [ chan.lstrip('!~@%+') for chan in info['CHANNELS'] ]
     blacklist = config.list('gatekeeper.channels', server, channel)
 
+    # Check the channels we can see ourselves first.
+    bad = [chan for chan in blacklist if bot.presence.present(who, chan)]
+    unseen = [chan for chan in blacklist if not bot.presence.present(bot.nickname, chan)]
+
+    # Only ask the server about the channels we're not in.
+    if not bad and unseen:
+        info = yield from bot.whois(who)
+        if info:
+            # Get channel list and strip status info.
+            channels = [ chan.lstrip('!~@%+') for chan in info.get('channels', []) ]
+            bad = set(channels).intersection(set(unseen))
+
     # User is in a bad channel?
-    if set(channels).intersection(set(blacklist)):
+    if bad:
         method = config.get('gatekeeper.ban.method', server, channel)
         message = config.get('gatekeeper.ban.message', server, channel)
 
@@ -45,7 +54,7 @@ def join(bot, server, channel, who):
         elif method == 'proxy':
             proxy = config.get('gatekeeper.ban.proxy', server, channel)
             msg = config.get('gatekeeper.ban.proxy_format', server, channel)
-            bot.message(proxy, msg.format(nick=who, server=server, channel=channel, message=message))
+            yield from bot.message(proxy, msg.format(nick=who, server=server, channel=channel, message=message))
 
 
 ## Boilerplate.
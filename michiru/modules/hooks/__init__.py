@@ -1,11 +1,14 @@
 # Service hooks module.
-import traceback
+import time
+import json
 import functools
-import threading
+import collections
+import traceback
+import http.client
+import urllib.parse
 import asyncio
-import flask
 
-from michiru import config, chat, personalities
+from michiru import config, chat, db, personalities, shards
 _ = personalities.localize
 
 
@@ -19,45 +22,347 @@ __desc__ = 'Web hook collection.'
 config.item('hooks.host', '0.0.0.0')
 config.item('hooks.port', 8081)
 config.item('hooks.services', {})
+config.item('hooks.max_body_size', 1024 * 1024)
+config.item('hooks.max_headers', 100)
+config.item('hooks.keepalive_timeout', 15)
+config.item('hooks.digest_window', 5)
+config.item('hooks.digest_threshold', 4)
+config.item('hooks.max_outbound_depth', 10)
+config.item('hooks.retry_interval', 30)
+config.item('hooks.max_age', 24 * 60 * 60)
+
+db.table('hooks_queue', {
+    'id': db.ID,
+    'service': db.STRING,
+    'ident': db.STRING,
+    'server': db.STRING,
+    'channel': db.STRING,
+    'kind': db.STRING,
+    'message': db.STRING,
+    'time': db.INT
+})
+
+personalities.messages('fancy', {
+    '{count} {kind}s, latest: {message}':
+        '{b}[{count} {kind}s]{/b} latest: {message}'
+})
+
+
+## HTTP stuff.
+
+class HTTPError(Exception):
+    """ Error that should be answered with HTTP status `status`. """
+    def __init__(self, status):
+        super().__init__(http.client.responses.get(status, 'Error'))
+        self.status = status
+
+class MissingHeader(HTTPError, KeyError):
+    """ A header a hook handler relies on is missing from the request. """
+    def __init__(self, name):
+        super().__init__(400)
+        self.name = name
+
+class Headers(dict):
+    """ Case-insensitive HTTP header dict. Missing headers are answered with 400, like Flask does. """
+    def __setitem__(self, name, value):
+        super().__setitem__(name.lower(), value)
+
+    def __getitem__(self, name):
+        try:
+            return super().__getitem__(name.lower())
+        except KeyError:
+            raise MissingHeader(name)
+
+    def __contains__(self, name):
+        return super().__contains__(name.lower())
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+class Request:
+    """ An incoming HTTP request, with the parts of the Flask request interface hook handlers use. """
+    def __init__(self, method, target, version, headers, data, remote_addr):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.data = data
+        self.remote_addr = remote_addr
+
+        url = urllib.parse.urlsplit(target)
+        self.path = url.path
+        self.args = dict(urllib.parse.parse_qsl(url.query))
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def get_json(self, force=False):
+        if not force and self.headers.get('content-type', '').split(';')[0].strip() != 'application/json':
+            return None
+        try:
+            return json.loads(self.data.decode('utf-8'))
+        except ValueError:
+            raise HTTPError(400)
+
+@asyncio.coroutine
+def read_request(reader, writer, remote_addr):
+    """ Read a single request from connection, or return None if it was closed. """
+    try:
+        line = yield from reader.readline()
+        if not line:
+            return None
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(400)
+
+    # Read headers.
+    headers = Headers()
+    while True:
+        try:
+            line = yield from reader.readline()
+        except ValueError:
+            raise HTTPError(431)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= config.get('hooks.max_headers'):
+            raise HTTPError(431)
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip()] = value.strip()
+
+    # Read body. Refuse oversized ones before telling the client to go ahead and send it.
+    limit = config.get('hooks.max_body_size')
+    chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+    if not chunked:
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HTTPError(400)
+        if length > limit:
+            raise HTTPError(413)
+    if headers.get('expect', '').lower() == '100-continue':
+        writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+    if chunked:
+        data = b''
+        while True:
+            try:
+                size = int((yield from reader.readline()).split(b';')[0], 16)
+            except ValueError:
+                raise HTTPError(400)
+            if not size:
+                break
+            if len(data) + size > limit:
+                raise HTTPError(413)
+            data += yield from reader.readexactly(size)
+            yield from reader.readexactly(2)
+        # Skip trailers, which count towards the header limit.
+        count = len(headers)
+        while True:
+            try:
+                line = yield from reader.readline()
+            except ValueError:
+                raise HTTPError(431)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            count += 1
+            if count > config.get('hooks.max_headers'):
+                raise HTTPError(431)
+    else:
+        data = yield from reader.readexactly(length)
+
+    return Request(method, target, version, headers, data, remote_addr)
+
+def respond(writer, status, keep_alive):
+    """ Write an empty response with HTTP status `status`. """
+    writer.write('HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: {}\r\n\r\n'.format(
+        status, http.client.responses.get(status, ''), 'keep-alive' if keep_alive else 'close'
+    ).encode('latin-1'))
+
+@asyncio.coroutine
+def serve(reader, writer):
+    """ Serve requests on a connection until the client is done with it. """
+    peer = writer.get_extra_info('peername')
+    remote_addr = peer[0] if peer else None
+    loop = asyncio.get_event_loop()
+
+    try:
+        while True:
+            try:
+                request = yield from asyncio.wait_for(read_request(reader, writer, remote_addr), config.get('hooks.keepalive_timeout'), loop=loop)
+            except HTTPError as e:
+                respond(writer, e.status, False)
+                break
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                break
+            if not request:
+                break
+
+            try:
+                yield from handle(request)
+                status = 204
+            except HTTPError as e:
+                status = e.status
+            except:
+                traceback.print_exc()
+                status = 500
+
+            respond(writer, status, request.keep_alive)
+            yield from writer.drain()
+            if not request.keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
 
 
 ## Server stuff.
 
-SERVER = flask.Flask('michiru.modules.hooks')
-THREAD = None
+SERVER = None
+SERVER_TASK = None
 
-@SERVER.route('/<name>', methods=['GET', 'POST', 'PUT', 'DELETE'])
-def handle(name):
-    if name not in HOOKS:
-        flask.abort(404)
+@asyncio.coroutine
+def handle(request):
+    if request.method not in ('GET', 'POST', 'PUT', 'DELETE'):
+        raise HTTPError(405)
+    name = request.path.strip('/')
+    if '/' in name or name not in HOOKS:
+        raise HTTPError(404)
 
     # Get hook information.
     name, handler = HOOKS[name]
     cfg = config.get('hooks.services.' + name)
 
     # Filter.
-    if 'allowed_ips' in cfg and cfg['allowed_ips'] and flask.request.remote_addr not in cfg['allowed_ips']:
-        flask.abort(403)
+    if 'allowed_ips' in cfg and cfg['allowed_ips'] and request.remote_addr not in cfg['allowed_ips']:
+        raise HTTPError(403)
 
     # Process.
+    res = handler(cfg, request)
+    if asyncio.iscoroutine(res):
+        res = yield from res
+    ident, messages = res
+
+    # Queue messages for delivery. Handlers can tag messages with a kind as (kind, message), so bursts can be digested.
+    stamp = int(time.time())
+    rows = []
+    for server in cfg['targets'].get(ident, {}):
+        for channel in cfg['targets'][ident][server]:
+            for message in messages:
+                kind, message = message if isinstance(message, tuple) else (None, message)
+                rows.append((name, ident, server, channel, kind, message, stamp))
+
+    if rows:
+        db.query_many('hooks_queue', 'INSERT INTO `hooks_queue` (`service`, `ident`, `server`, `channel`, `kind`, `message`, `time`) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        # Every shard delivers messages for its own servers.
+        wake()
+        shards.broadcast('hooks_wake')
+
+def escape(text):
+    """ Escape user-supplied `text` for use in hook messages, which get formatted on delivery. """
+    return str(text).replace('{', '{{').replace('}', '}}')
+
+
+## Delivery.
+
+WAKE = None
+CONSUMER = None
+# IDs of rows queued for sending, but not sent yet.
+PENDING = set()
+
+@shards.action('hooks_wake')
+def wake():
+    """ Deliver new messages soon. """
+    if WAKE:
+        WAKE.set()
+
+def digest(bot, kind, messages):
+    """ Turn a burst of messages of the same kind into something that won't flood the channel. """
+    if not kind or len(messages) < config.get('hooks.digest_threshold'):
+        return [_(bot, message) for message in messages]
+    return [_(bot, '{count} {kind}s, latest: {message}', count=len(messages), kind=kind, message=_(bot, messages[-1]))]
+
+def remove(ids):
+    """ Remove rows `ids` from the queue. """
+    db.query_many('hooks_queue', 'DELETE FROM `hooks_queue` WHERE `id` = ?', ((id,) for id in ids))
+
+def sent(ids, future):
+    """ Remove rows once their messages went out, or have them retried if sending failed. """
+    PENDING.difference_update(ids)
+    if future.cancelled() or future.exception():
+        return
     try:
-        ident, messages = handler(cfg, flask.request)
+        remove(ids)
     except:
         traceback.print_exc()
-        flask.abort(500)
 
-    # Message.
-    for server in cfg['targets'].get(ident, {}):
+@asyncio.coroutine
+def deliver():
+    """ Deliver queued messages for servers this shard runs where possible, leaving the rest for later. """
+    db.query('hooks_queue', 'DELETE FROM `hooks_queue` WHERE `time` < ?', int(time.time()) - config.get('hooks.max_age'))
+    rows = db.query('hooks_queue', 'SELECT * FROM `hooks_queue` ORDER BY `id`')
+
+    # Group by target and kind, keeping the order messages came in.
+    groups = collections.OrderedDict()
+    for row in rows:
+        if not shards.owns(row['server']) or row['id'] in PENDING:
+            continue
+        key = row['server'], row['channel'], row['ident'], row['kind'] or row['id']
+        groups.setdefault(key, []).append(row)
+
+    for (server, channel, ident, kind), group in groups.items():
+        ids = [row['id'] for row in group]
+
         if server not in chat.bots:
+            # Servers that are merely offline get their messages later.
+            if server not in config.get('servers'):
+                print('hooks: dropping messages for unknown server {}'.format(server))
+                remove(ids)
             continue
+
+        # Leave messages for later if the server is gone or has enough on its plate.
         bot = chat.bots[server]
+        if not bot.connected or bot.outbound.depth() > config.get('hooks.max_outbound_depth'):
+            continue
 
-        for channel in cfg['targets'][ident][server]:
-            for message in messages:
-                asyncio.ensure_future(bot.message(channel, _(bot, message)), loop=bot.loop)
+        try:
+            for message in digest(bot, group[0]['kind'], [row['message'] for row in group]):
+                future = yield from bot.message(channel, message, track=True)
+        except:
+            # Don't let one bad group hold up the rest forever.
+            print('hooks: dropping undeliverable messages for {}/{}'.format(server, channel))
+            traceback.print_exc()
+            remove(ids)
+            continue
+
+        # Lines for a channel go out in order, so once the last one is sent, all of them are.
+        PENDING.update(ids)
+        future.add_done_callback(functools.partial(sent, ids))
+
+@asyncio.coroutine
+def consume(loop):
+    """ Deliver queued messages whenever new ones come in, and retry undelivered ones periodically. """
+    while True:
+        try:
+            yield from asyncio.wait_for(WAKE.wait(), config.get('hooks.retry_interval'), loop=loop)
+        except asyncio.TimeoutError:
+            pass
+        WAKE.clear()
 
-    return ('', 204)
+        # Give bursts some time to pile up, so they can be digested.
+        yield from asyncio.sleep(config.get('hooks.digest_window'), loop=loop)
+        try:
+            yield from deliver()
+        except:
+            traceback.print_exc()
 
+@asyncio.coroutine
+def start(loop):
+    global SERVER
+    SERVER = yield from asyncio.start_server(serve, config.get('hooks.host'), config.get('hooks.port'), loop=loop)
 
 
 ## Boilerplate
@@ -65,16 +370,30 @@ def handle(name):
 HOOKS = {}
 
 def load():
-    global THREAD
-    THREAD = threading.Thread(target=functools.partial(SERVER.run, host=config.get('hooks.host'), port=config.get('hooks.port')))
-    THREAD.start()
+    global SERVER_TASK, WAKE, CONSUMER
+    loop = asyncio.get_event_loop()
+    # Only one shard can listen on the port, but every shard delivers messages for its servers.
+    if shards.primary():
+        SERVER_TASK = asyncio.ensure_future(start(loop), loop=loop)
+    # Pick up whatever was left in the queue last time, too.
+    WAKE = asyncio.Event(loop=loop)
+    WAKE.set()
+    CONSUMER = asyncio.ensure_future(consume(loop), loop=loop)
     return True
 
 def register(name, endpoint, func):
     HOOKS[endpoint] = (name, func)
 
 def unload():
-    pass
+    global SERVER, SERVER_TASK, WAKE, CONSUMER
+    if SERVER_TASK and not SERVER_TASK.done():
+        SERVER_TASK.cancel()
+    if SERVER:
+        SERVER.close()
+    if CONSUMER:
+        CONSUMER.cancel()
+    SERVER = SERVER_TASK = WAKE = CONSUMER = None
+    PENDING.clear()
 
 def unregister(name, endpoint, func):
     del HOOKS[endpoint]
@@ -1,8 +1,12 @@
 # GitLab hook.
 import operator
 import json
+import hashlib
 import datetime
-from michiru import config, db
+import collections
+import traceback
+import asyncio
+from michiru import config, db, maintenance
 
 
 ## Module information.
@@ -17,17 +21,121 @@ config.item('hooks.services.gitlab', {
     'allowed_ips': [],
     'targets': {}
 })
+config.item('hooks.gitlab.cache_size', 1024)
+config.item('hooks.gitlab.flush_interval', 10)
+
+## Issue snapshots.
+
+# Issue fields we report changes on.
+SNAPSHOT_FIELDS = ('state', 'assignee_id', 'title', 'milestone_id')
+# (project, issue ID) -> snapshot, in least recently used order.
+SNAPSHOTS = collections.OrderedDict()
+# (project, issue ID) -> snapshot not written to the database yet.
+DIRTY = {}
+FLUSHER = None
+
+def snapshot(data, stored=False):
+    """ Take snapshot of issue data, keeping only what we diff against. """
+    snap = {field: data.get(field) for field in SNAPSHOT_FIELDS}
+    snap['digest'] = data['digest'] if 'digest' in data else hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+    snap['stored'] = stored
+    return snap
+
+def dump_snapshot(snap):
+    """ Serialize snapshot for storage. """
+    return json.dumps({k: v for k, v in snap.items() if k != 'stored'})
+
+def compact_issues(table):
+    """ Replace full issue data stored before snapshots with snapshots. """
+    for rows in db.batches(table, 'data'):
+        updates = []
+        for row in rows:
+            data = json.loads(row['data'])
+            if 'digest' not in data:
+                updates.append((dump_snapshot(snapshot(data)), row['id']))
+        db.query_many(table, 'UPDATE `hooks_gitlab_issues` SET `data` = ? WHERE `id` = ?', updates)
+        yield len(rows)
 
 db.table('hooks_gitlab_issues', {
     'id': db.ID,
-    'project': (db.STRING, db.INDEX),
-    'issue_id': (db.INT, db.INDEX),
+    'project': db.STRING,
+    'issue_id': db.INT,
     'data': db.STRING,
     'time': db.DATETIME
-})
+}, indices=[
+    db.index('project', 'issue_id')
+], migrations=[
+    compact_issues
+])
+maintenance.register('hooks_gitlab_issues', max_age=180 * 24 * 60 * 60)
+
+def get_snapshot(project, issue_id):
+    """ Get last known snapshot of issue, or None. """
+    key = project, issue_id
+    if key in DIRTY:
+        return DIRTY[key]
+    if key in SNAPSHOTS:
+        SNAPSHOTS.move_to_end(key)
+        return SNAPSHOTS[key]
+
+    try:
+        entry = db.from_('hooks_gitlab_issues').where('project', project).and_('issue_id', issue_id).single('data')
+        snap = snapshot(json.loads(entry['data']), stored=True) if entry else None
+    except:
+        snap = None
+    if snap:
+        cache_snapshot(key, snap)
+    return snap
+
+def cache_snapshot(key, snap):
+    SNAPSHOTS[key] = snap
+    SNAPSHOTS.move_to_end(key)
+    while len(SNAPSHOTS) > config.get('hooks.gitlab.cache_size'):
+        SNAPSHOTS.popitem(last=False)
+
+def put_snapshot(project, issue_id, snap):
+    """ Store new snapshot of issue. It gets written to the database on the next flush. """
+    key = project, issue_id
+    old = DIRTY.get(key) or SNAPSHOTS.get(key)
+    snap['stored'] = bool(old and old['stored'])
+    cache_snapshot(key, snap)
+    DIRTY[key] = snap
+
+def flush():
+    """ Write changed snapshots to the database in one go. """
+    if not DIRTY:
+        return
+
+    now = db.val2db(datetime.datetime.utcnow())
+    updates = []
+    inserts = []
+    for (project, issue_id), snap in DIRTY.items():
+        data = dump_snapshot(snap)
+        if snap['stored']:
+            updates.append((data, now, project, issue_id))
+        else:
+            inserts.append((project, issue_id, data, now))
+            snap['stored'] = True
+    DIRTY.clear()
+
+    if updates:
+        db.query_many('hooks_gitlab_issues', 'UPDATE `hooks_gitlab_issues` SET `data` = ?, `time` = ? WHERE `project` = ? AND `issue_id` = ?', updates)
+    if inserts:
+        db.query_many('hooks_gitlab_issues', 'INSERT INTO `hooks_gitlab_issues` (`project`, `issue_id`, `data`, `time`) VALUES (?, ?, ?, ?)', inserts)
+
+@asyncio.coroutine
+def flusher(loop):
+    """ Periodically write changed snapshots. """
+    while True:
+        yield from asyncio.sleep(config.get('hooks.gitlab.flush_interval'), loop=loop)
+        try:
+            flush()
+        except:
+            traceback.print_exc()
 
 
 def handler(config, request):
+    from michiru.modules import hooks
     messages = []
     message = request.get_json(force=True)
     repo = message['project']['homepage']
@@ -35,96 +143,80 @@ def handler(config, request):
     # An issue update.
     if message['object_kind'] == 'issue':
         data = message['object_attributes']
-        try:
-            entry = db.from_('hooks_gitlab_issues').where('project', repo).and_('issue_id', data['iid']).single('id', 'data')
-            if entry:
-                old_data = json.loads(entry['data'])
-            else:
-                old_data = None
-        except:
-            old_data = None
+        old_data = get_snapshot(repo, data['iid'])
+        new_data = snapshot(data)
 
         # An issue we don't know about.
         if not old_data:
             if data['created_at'] == data['updated_at']:
                 messages = ['{{b}}New issue on {}:{{/b}} {} - {{u}}{}{{/u}}'.format(
-                    message['project']['name'],
-                    data['title'],
-                    data['url']
+                    hooks.escape(message['project']['name']),
+                    hooks.escape(data['title']),
+                    hooks.escape(data['url'])
                 )]
             else:
                 messages = ['{{b}}Issue on {} updated:{{/b}} {} - {{u}}{}{{/u}}'.format(
-                    message['project']['name'],
-                    data['title'],
-                    data['url']
+                    hooks.escape(message['project']['name']),
+                    hooks.escape(data['title']),
+                    hooks.escape(data['url'])
                 )]
         # An issue we have info about.
         else:
             if old_data['state'] != data['state']:
                 messages.append('{{b}}Issue on {} {}:{{/b}} {} - {{u}}{}{{/u}}'.format(
-                    message['project']['name'],
-                    data['state'],
-                    data['title'],
-                    data['url']
+                    hooks.escape(message['project']['name']),
+                    hooks.escape(data['state']),
+                    hooks.escape(data['title']),
+                    hooks.escape(data['url'])
                 ))
             if old_data['assignee_id'] != data['assignee_id']:
                 messages.append('{{b}}Issue on {} reassigned:{{/b}} {} - {{u}}{}{{/u}}'.format(
-                    message['project']['name'],
-                    data['title'],
-                    data['url']
+                    hooks.escape(message['project']['name']),
+                    hooks.escape(data['title']),
+                    hooks.escape(data['url'])
                 ))
             if old_data['title'] != data['title']:
                 messages.append('{{b}}Issue on {} renamed:{{/b}} {} -> {} - {{u}}{}{{/u}}'.format(
-                    message['project']['name'],
-                    old_data['title'],
-                    data['title'],
-                    data['url']
+                    hooks.escape(message['project']['name']),
+                    hooks.escape(old_data['title']),
+                    hooks.escape(data['title']),
+                    hooks.escape(data['url'])
                 ))
             if old_data['milestone_id'] != data['milestone_id']:
                 messages.append('{{b}}Issue milestone on {} updated:{{/b}} {} - {{u}}{}{{/u}}'.format(
-                    message['project']['name'],
-                    data['title'],
-                    data['url']
+                    hooks.escape(message['project']['name']),
+                    hooks.escape(data['title']),
+                    hooks.escape(data['url'])
                 ))
-            if old_data != data and not messages:
+            if old_data['digest'] != new_data['digest'] and not messages:
                 messages = ['{{b}}Issue on {} updated:{{/b}} {} - {{u}}{}{{/u}}'.format(
-                    message['project']['name'],
-                    data['title'],
-                    data['url']
+                    hooks.escape(message['project']['name']),
+                    hooks.escape(data['title']),
+                    hooks.escape(data['url'])
                 )]
 
-
-        data = {
-            'project': repo,
-            'issue_id': data['iid'],
-            'data': json.dumps(data),
-            'time': datetime.datetime.utcnow()
-        }
-        if entry:
-            db.in_('hooks_gitlab_issues').where('id', entry['id']).update(data)
-        else:
-            db.to('hooks_gitlab_issues').add(data)
+        put_snapshot(repo, data['iid'], new_data)
     # Pushed commits.
     elif message['object_kind'] == 'push':
         for commit in sorted(message['commits'], key=operator.itemgetter('timestamp')):
-            messages.append('{{b}}Commit on {} by {}:{{/b}} {} - {{u}}{}{{/u}}'.format(
-                message['project']['name'],
-                commit['author']['name'],
-                commit['message'].strip(),
-                commit['url']
-            ))
+            messages.append(('commit', '{{b}}Commit on {} by {}:{{/b}} {} - {{u}}{}{{/u}}'.format(
+                hooks.escape(message['project']['name']),
+                hooks.escape(commit['author']['name']),
+                hooks.escape(commit['message'].strip()),
+                hooks.escape(commit['url'])
+            )))
     # Comments.
     elif message['object_kind'] == 'note':
         data = message['object_attributes']
         if data['created_at'] == data['updated_at']:
             heading = 'New {} comment on {}'.format(
-                data['noteable_type'].lower(),
-                message['project']['name']
+                hooks.escape(data['noteable_type'].lower()),
+                hooks.escape(message['project']['name'])
             )
         else:
             heading = '{} comment on {} updated'.format(
-                data['noteable_type'],
-                message['project']['name']
+                hooks.escape(data['noteable_type']),
+                hooks.escape(message['project']['name'])
             )
 
         data['note'] = data['note'].replace('\n', ' ').strip()
@@ -132,17 +224,29 @@ def handler(config, request):
             data['note'] = data['note'][:400] + '...'
         messages = ['{{b}}{}:{{/b}} <{}> {} - {{u}}{}{{/u}}'.format(
             heading,
-            message['user']['name'],
-            data['note'], data['url']
+            hooks.escape(message['user']['name']),
+            hooks.escape(data['note']),
+            hooks.escape(data['url'])
         )]
 
     return (repo, messages)
 
 def load():
+    global FLUSHER
     from michiru.modules import hooks
     hooks.register('gitlab', 'gitlab', handler)
+
+    loop = asyncio.get_event_loop()
+    FLUSHER = asyncio.ensure_future(flusher(loop), loop=loop)
     return True
 
 def unload():
+    global FLUSHER
     from michiru.modules import hooks
     hooks.unregister('gitlab', 'gitlab', handler)
+
+    if FLUSHER:
+        FLUSHER.cancel()
+        FLUSHER = None
+    flush()
+    SNAPSHOTS.clear()
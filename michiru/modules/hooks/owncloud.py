@@ -19,6 +19,7 @@ config.item('hooks.services.owncloud', {
 
 
 def handler(config, request):
+    from michiru.modules import hooks
     messages = []
     message = request.get_json(force=True)
     ident = None
@@ -35,19 +36,19 @@ def handler(config, request):
         mime = message.get('mimeType')
         if mime == 'httpd/unix-directory':
             messages = ['{{b}}{} folder on ownCloud:{{/b}} {}'.format(
-                message['action'].capitalize(),
-                path
+                hooks.escape(message['action'].capitalize()),
+                hooks.escape(path)
             )]
         elif mime:
             messages = ['{{b}}{} file on ownCloud:{{/b}} {} (type: {})'.format(
-                message['action'].capitalize(),
-                path,
-                mime
+                hooks.escape(message['action'].capitalize()),
+                hooks.escape(path),
+                hooks.escape(mime)
             )]
         else:
             messages = ['{{b}}{} file on ownCloud:{{/b}} {}'.format(
-                message['action'].capitalize(),
-                path
+                hooks.escape(message['action'].capitalize()),
+                hooks.escape(path)
             )]
 
     return (ident, messages)
@@ -1,10 +1,12 @@
 # Know-it-all module.
+import time
 import random
 import heapq
+import collections
 import asyncio
 
-from michiru import personalities
-from michiru.modules import command
+from michiru import config, db, personalities, workers
+from michiru.modules import command, restricted
 _ = personalities.localize
 
 
@@ -18,6 +20,23 @@ __desc__ = 'Knows things better than you.'
 
 ## Configuration.
 
+config.item('knowitall.fanout', True)
+config.item('knowitall.timeout', 10)
+config.item('knowitall.threads', 4)
+config.item('knowitall.request_timeout', 8)
+config.item('knowitall.cache.size', 512)
+config.item('knowitall.cache.ttl', {})
+config.item('knowitall.cache.negative_ttl', 600)
+config.item('knowitall.cache.persist', False)
+
+db.table('knowitall_cache', {
+    'id': db.ID,
+    'source': db.STRING,
+    'query': (db.STRING, db.INDEX),
+    'definition': db.STRING,
+    'expires': db.INT
+})
+
 personalities.messages('tsun', {
     'Me.':
         'Michiru でーす！',
@@ -51,6 +70,125 @@ def whatis(bot, server, target, source, message, parsed, private, admin):
     definition = yield from get_definition(bot, wanted, source=source, server=server, channel=target)
     yield from bot.message(target, _(bot, '{factoid}: {definition}', source=source, factoid=wanted, definition=definition))
 
+@command(r'definition cache(?: for (.+?))?\??$')
+@restricted
+def cache_info(bot, server, target, source, message, parsed, private, admin):
+    wanted = parsed.group(1)
+    if wanted:
+        entries = cached_for(wanted)
+        if not entries:
+            yield from bot.message(target, _(bot, 'Nothing cached for {query}.', query=wanted))
+            return
+        for name, definition, ttl in entries:
+            yield from bot.message(target, _(bot, '[{source}] {definition} (expires in {ttl}s)',
+                source=name, definition=definition if definition is not None else _(bot, 'no definition'), ttl=round(ttl)))
+    else:
+        info = cache_stats()
+        yield from bot.message(target, _(bot, 'Definition cache: {size} entries ({negative} negative), {hits} hits, {misses} misses.', **info))
+
+@command(r'flush definition cache(?: for (.+?))?\.?$')
+@restricted
+def cache_flush(bot, server, target, source, message, parsed, private, admin):
+    name = parsed.group(1)
+    flush(name)
+    if name:
+        yield from bot.message(target, _(bot, 'Definition cache for {source} flushed.', source=name))
+    else:
+        yield from bot.message(target, _(bot, 'Definition cache flushed.'))
+
+
+## Cache.
+
+# (source name, normalized query) -> (definition or None, expiry timestamp), in least recently used order.
+CACHE = collections.OrderedDict()
+CACHE_HITS = 0
+CACHE_MISSES = 0
+
+def normalize(query):
+    """ Normalize query for cache lookup. """
+    return ' '.join(query.casefold().split())
+
+def cache_ttl(name, positive):
+    """ Get amount of seconds to cache result from source for. """
+    if not positive:
+        return config.get('knowitall.cache.negative_ttl')
+    return config.get('knowitall.cache.ttl').get(name, TTLS.get(name, 0))
+
+def cache_get(name, query):
+    """ Look up cached result. Returns (found, definition). """
+    global CACHE_HITS, CACHE_MISSES
+    key = (name, normalize(query))
+    now = time.time()
+
+    if key in CACHE:
+        definition, expires = CACHE[key]
+        if expires > now:
+            CACHE.move_to_end(key)
+            CACHE_HITS += 1
+            return True, definition
+        del CACHE[key]
+
+    if config.get('knowitall.cache.persist'):
+        row = db.from_('knowitall_cache').where('query', key[1]).and_('source', name).single('definition', 'expires')
+        if row and row['expires'] > now:
+            cache_store(key, row['definition'], row['expires'])
+            CACHE_HITS += 1
+            return True, row['definition']
+        elif row:
+            db.from_('knowitall_cache').where('query', key[1]).and_('source', name).delete()
+
+    CACHE_MISSES += 1
+    return False, None
+
+def cache_store(key, definition, expires):
+    """ Store entry in the memory cache, evicting the least recently used entries if needed. """
+    CACHE[key] = (definition, expires)
+    CACHE.move_to_end(key)
+    while len(CACHE) > config.get('knowitall.cache.size'):
+        CACHE.popitem(last=False)
+
+def cache_put(name, query, definition, ttl):
+    """ Cache result for source. """
+    key = (name, normalize(query))
+    expires = int(time.time() + ttl)
+    cache_store(key, definition, expires)
+
+    if config.get('knowitall.cache.persist'):
+        with db.mutex:
+            db.from_('knowitall_cache').where('query', key[1]).and_('source', name).delete()
+            db.to('knowitall_cache').add({
+                'source': name,
+                'query': key[1],
+                'definition': definition,
+                'expires': expires
+            })
+
+def cached_for(query):
+    """ List (source, definition, seconds left) cached for query. """
+    now = time.time()
+    wanted = normalize(query)
+    return [(name, definition, expires - now) for (name, q), (definition, expires) in CACHE.items() if q == wanted and expires > now]
+
+def cache_stats():
+    """ Return cache statistics. """
+    return {
+        'size': len(CACHE),
+        'negative': sum(1 for definition, expires in CACHE.values() if definition is None),
+        'hits': CACHE_HITS,
+        'misses': CACHE_MISSES
+    }
+
+def flush(name=None):
+    """ Flush cached results for source, or for all sources. """
+    if name is None:
+        CACHE.clear()
+        db.from_('knowitall_cache').delete()
+        return
+
+    for key in [key for key in CACHE if key[0] == name]:
+        del CACHE[key]
+    db.from_('knowitall_cache').where('source', name).delete()
+
 
 ## Utility functions.
 
@@ -61,20 +199,101 @@ def define_builtin(definition, bot, source, server, channel):
     elif wanted == source:
         return _(bot, 'You.')
 
+def executor():
+    """ Get the executor for blocking source requests. """
+    return workers.threads('knowitall', config.get('knowitall.threads'))
+
 @asyncio.coroutine
-def get_definition(bot, wanted, sources=None, source=None, server=None, channel=None):
-    """ Try to define something through several sources. """
-    definition = None
+def run_blocking(bot, func, *args, server=None, channel=None):
+    """ Run blocking source request on the knowitall executor, giving up after the request timeout. """
+    future = bot.loop.run_in_executor(executor(), func, *args)
+    res = yield from asyncio.wait_for(future, config.get('knowitall.request_timeout', server, channel), loop=bot.loop)
+    return res
 
-    for prio, name, f in SOURCES:
-        if sources and name not in sources:
-            continue
+def source_result(task):
+    """ Get definition from a finished source task, or None if it failed. """
+    if task.cancelled() or task.exception():
+        return None
+    return task.result()
+
+@asyncio.coroutine
+def ask(entry, wanted, bot, source, server, channel):
+    """ Ask source for definition, going through the cache for network sources. """
+    prio, name, f, network = entry
+    if not network:
+        definition = yield from f(wanted, bot, source, server, channel)
+        return definition
+
+    found, definition = cache_get(name, wanted)
+    if found:
+        return definition
+
+    definition = yield from f(wanted, bot, source, server, channel)
+    cache_put(name, wanted, definition or None, cache_ttl(name, bool(definition)))
+    return definition
+
+@asyncio.coroutine
+def query_sources(bot, wanted, candidates, source, server, channel):
+    """ Ask sources one after another in priority order. """
+    for entry in candidates:
         try:
-            definition = yield from f(wanted, bot, source, server, channel)
+            definition = yield from ask(entry, wanted, bot, source, server, channel)
         except:
             continue
         if definition:
-            break
+            return definition
+    return None
+
+@asyncio.coroutine
+def fan_out(bot, wanted, candidates, source, server, channel):
+    """ Ask sources concurrently, but still answer with the highest-priority definition. """
+    # Local sources in front of the network sources are cheap: no point doing requests for things we know.
+    local = []
+    while candidates and not candidates[0][3]:
+        local.append(candidates.pop(0))
+    definition = yield from query_sources(bot, wanted, local, source, server, channel)
+    if definition or not candidates:
+        return definition
+
+    deadline = bot.loop.time() + config.get('knowitall.timeout', server, channel)
+    tasks = [asyncio.ensure_future(ask(entry, wanted, bot, source, server, channel), loop=bot.loop) for entry in candidates]
+
+    try:
+        # Wait for sources in priority order: once one answers, nothing before it can win anymore.
+        for task in tasks:
+            remaining = deadline - bot.loop.time()
+            if remaining <= 0:
+                break
+            yield from asyncio.wait([task], timeout=remaining, loop=bot.loop)
+            if not task.done():
+                break
+            definition = source_result(task)
+            if definition:
+                return definition
+
+        # Out of time: settle for the best answer that did come in.
+        for task in tasks:
+            if task.done():
+                definition = source_result(task)
+                if definition:
+                    return definition
+        return None
+    finally:
+        for task in tasks:
+            if task.done():
+                source_result(task)
+            else:
+                task.cancel()
+
+@asyncio.coroutine
+def get_definition(bot, wanted, sources=None, source=None, server=None, channel=None):
+    """ Try to define something through several sources. """
+    candidates = [entry for entry in sorted(SOURCES) if not sources or entry[1] in sources]
+
+    if config.get('knowitall.fanout', server, channel):
+        definition = yield from fan_out(bot, wanted, candidates, source, server, channel)
+    else:
+        definition = yield from query_sources(bot, wanted, candidates, source, server, channel)
 
     # Dummy texts.
     if not definition:
@@ -90,18 +309,25 @@ def get_definition(bot, wanted, sources=None, source=None, server=None, channel=
 
 ## Boilerplate.
 
+# Definition sources: (priority, name, function, does network requests).
 SOURCES = [
-    (0, 'builtin', define_builtin)
+    (0, 'builtin', define_builtin, False)
 ]
+# Default cache TTLs for network sources: name -> seconds.
+TTLS = {}
 
 def load():
     return True
 
-def register(prio, name, func):
-    heapq.heappush(SOURCES, (prio, name, func))
+def register(prio, name, func, network=False, ttl=3600):
+    heapq.heappush(SOURCES, (prio, name, func, network))
+    if network:
+        TTLS[name] = ttl
 
 def unload():
-    pass
+    workers.stop_threads('knowitall')
 
 def unregister(prio, name, func):
-    SOURCES.remove((prio, name, func))
+    SOURCES[:] = [entry for entry in SOURCES if entry[:3] != (prio, name, func)]
+    heapq.heapify(SOURCES)
+    TTLS.pop(name, None)
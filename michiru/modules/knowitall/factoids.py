@@ -1,9 +1,12 @@
 # Know-it-all factoids module.
 import re
+import heapq
+import difflib
+import collections
 from datetime import datetime
 import asyncio
 
-from michiru import db, personalities
+from michiru import config, db, personalities
 from michiru.modules import command
 _ = personalities.localize
 
@@ -16,6 +19,12 @@ __license__ = 'WTFPL'
 __desc__ = 'Get knowledge from stored factoids.'
 __deps__ = ['knowitall']
 
+
+## Configuration.
+
+config.item('knowitall.fuzzy.threshold', 0.75)
+config.item('knowitall.fuzzy.candidates', 20)
+
 db.table('factoids', {
     'id': db.INT,
     'server': (db.STRING, db.INDEX),
@@ -49,37 +58,164 @@ def define(bot, server, target, source, message, parsed, private, admin):
     if source == factoid:
         yield from bot.message(target, _(bot, 'You can\'t define yourself.', factoid=factoid))
 
-    db.from_('factoids').where('factoid', factoid).and_('server', server).delete()
-    db.to('factoids').add({
-        'server': server,
-        'factoid': factoid,
-        'definition': definition,
-        'author': source,
-        'time': datetime.now()
-    })
-
+    store(server, factoid, definition, source)
     yield from bot.message(target, _(bot, '{factoid} defined.', source=source, factoid=factoid, definition=definition))
 
 @command(r'forget about (\S+)$')
 def undefine(bot, server, target, source, message, parsed, private, admin):
     factoid = parsed.group(1)
 
-    if db.from_('factoids').where('factoid', factoid).and_('server', server).delete():
+    if forget(server, factoid):
         yield from bot.message(target, _(bot, '{factoid} deleted.', source=source, factoid=factoid))
     else:
         yield from bot.message(target, _(bot, 'Unknown definition: {factoid}', source=source, factoid=factoid))
 
 @asyncio.coroutine
 def define_factoid(definition, bot, source, server, channel):
-    query = db.from_('factoids').where('factoid', definition).and_('server', server).single('definition')
-    if query:
-        return query['definition']
+    known = factoids(server)
+    if definition in known:
+        return known[definition]
+
+    name = INDICES[server].folded(definition)
+    if name:
+        return known[name]
+
+@asyncio.coroutine
+def define_fuzzy_factoid(definition, bot, source, server, channel):
+    known = factoids(server)
+    index = INDICES[server]
+
+    name = index.fuzzy(definition, config.get('knowitall.fuzzy.threshold', server, channel), config.get('knowitall.fuzzy.candidates', server, channel))
+    if name:
+        return known[name]
+
+
+## Factoid index.
+
+def trigrams(text):
+    """ Get set of trigrams in text, padded so word boundaries count. """
+    text = '  ' + text + ' '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class Index:
+    """ Case-folded and trigram index over the factoids of a single server. """
+    def __init__(self, names=()):
+        # Case-folded factoid -> set of factoids.
+        self.names = {}
+        # Trigram -> set of case-folded factoids.
+        self.grams = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        """ Add factoid to index. """
+        key = name.casefold()
+        if key not in self.names:
+            self.names[key] = set()
+            for gram in trigrams(key):
+                self.grams.setdefault(gram, set()).add(key)
+        self.names[key].add(name)
+
+    def remove(self, name):
+        """ Remove factoid from index. """
+        key = name.casefold()
+        names = self.names.get(key)
+        if names is None:
+            return
+        names.discard(name)
+        if names:
+            return
+
+        del self.names[key]
+        for gram in trigrams(key):
+            keys = self.grams[gram]
+            keys.discard(key)
+            if not keys:
+                del self.grams[gram]
+
+    def pick(self, key):
+        """ Pick a factoid for case-folded key. """
+        return min(self.names[key])
+
+    def folded(self, query):
+        """ Find factoid case-insensitively. """
+        key = query.casefold()
+        if key in self.names:
+            return self.pick(key)
+        return None
+
+    def fuzzy(self, query, threshold, candidates):
+        """
+        Find most similar factoid. The `candidates` factoids with the most trigrams in common are
+        picked through the index, and only those are compared to the query in full.
+        """
+        key = query.casefold()
+        if len(key) < 3:
+            return None
+
+        grams = trigrams(key)
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self.grams.get(gram, ()))
+
+        # Rank by (approximate) trigram set similarity, so long factoids don't win just by having more trigrams.
+        ranked = heapq.nlargest(candidates, shared.items(), key=lambda x: x[1] / (len(grams) + len(x[0]) + 2 - x[1]))
+
+        best = None
+        best_score = threshold
+        for candidate, count in ranked:
+            score = difflib.SequenceMatcher(None, key, candidate).ratio()
+            if score >= best_score:
+                best = candidate
+                best_score = score
+        return self.pick(best) if best else None
+
+
+## Factoid storage.
+
+# Server -> {factoid: definition}, loaded lazily from the database and written through to it.
+FACTOIDS = {}
+# Server -> factoid index.
+INDICES = {}
+
+def factoids(server):
+    """ Get factoids for server, loading them if needed. """
+    if server not in FACTOIDS:
+        FACTOIDS[server] = {row['factoid']: row['definition'] for row in db.from_('factoids').where('server', server).get('factoid', 'definition')}
+        INDICES[server] = Index(FACTOIDS[server])
+    return FACTOIDS[server]
+
+def store(server, factoid, definition, author):
+    """ Define factoid for server. """
+    values = {
+        'definition': definition,
+        'author': author,
+        'time': datetime.now()
+    }
+
+    with db.mutex:
+        if not db.on('factoids').where('factoid', factoid).and_('server', server).update(values):
+            values.update(server=server, factoid=factoid)
+            db.to('factoids').add(values)
+    factoids(server)[factoid] = definition
+    INDICES[server].add(factoid)
+
+def forget(server, factoid):
+    """ Remove factoid for server. Returns whether it existed. """
+    known = factoids(server).pop(factoid, None) is not None
+    INDICES[server].remove(factoid)
+    deleted = db.from_('factoids').where('factoid', factoid).and_('server', server).delete()
+    return known or bool(deleted)
 
 def load():
     from michiru.modules import knowitall
     knowitall.register(1, 'factoids', define_factoid)
+    knowitall.register(2, 'similar factoids', define_fuzzy_factoid)
     return True
 
 def unload():
     from michiru.modules import knowitall
     knowitall.unregister(1, 'factoids', define_factoid)
+    knowitall.unregister(2, 'similar factoids', define_fuzzy_factoid)
+    FACTOIDS.clear()
+    INDICES.clear()
@@ -17,7 +17,8 @@ __deps__ = ['knowitall']
 
 @asyncio.coroutine
 def define_urbandict(definition, bot, source, server, channel):
-    res = yield from bot.loop.run_in_executor(None, urbandict.define, definition)
+    from michiru.modules import knowitall
+    res = yield from knowitall.run_blocking(bot, urbandict.define, definition, server=server, channel=channel)
     if res:
         definition = res['definitions'][0]['definition']
         # Remove annoying formatting we can't do anything with.
@@ -29,7 +30,7 @@ def define_urbandict(definition, bot, source, server, channel):
 
 def load():
     from michiru.modules import knowitall
-    knowitall.register(5, 'Urban Dictionary', define_urbandict)
+    knowitall.register(5, 'Urban Dictionary', define_urbandict, network=True, ttl=24 * 60 * 60)
     return True
 
 def unload():
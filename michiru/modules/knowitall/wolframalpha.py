@@ -1,7 +1,10 @@
 # Know-it-all Wolfram|Alpha module.
 import re
 import asyncio
-import wolframalpha
+import collections
+import xml.etree.ElementTree as etree
+import requests
+import requests.adapters
 
 from michiru import config, personalities
 from michiru.modules import command
@@ -19,7 +22,52 @@ __deps__ = ['knowitall']
 
 ## Configuration.
 
-config.item('api.wolframalpha', None)
+config.item('api.wolframalpha.appid', None)
+
+
+## Client.
+
+Pod = collections.namedtuple('Pod', ('title', 'text'))
+
+def parse_pods(data):
+    """ Parse pods with their main plaintext from a Wolfram|Alpha XML response. """
+    root = etree.fromstring(data)
+    if root.get('error') == 'true':
+        error = root.find('error/msg')
+        raise EnvironmentError(error.text if error is not None else 'Wolfram|Alpha returned an error.')
+
+    pods = []
+    for pod in root.iter('pod'):
+        text = pod.find('subpod/plaintext')
+        pods.append(Pod(pod.get('title'), text.text if text is not None else None))
+    return pods
+
+class Client:
+    """ Long-lived Wolfram|Alpha client for a single app ID, keeping its HTTP connections alive. """
+    URL = 'https://api.wolframalpha.com/v2/query'
+
+    def __init__(self, appid, pool_size):
+        self.appid = appid
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def query(self, input, timeout):
+        """ Query Wolfram|Alpha for result pods. Blocks. """
+        response = self.session.get(self.URL, params={'input': input, 'appid': self.appid, 'format': 'plaintext'}, timeout=timeout)
+        response.raise_for_status()
+        return parse_pods(response.content)
+
+    def close(self):
+        self.session.close()
+
+# App ID -> client.
+CLIENTS = {}
+
+def client(appid):
+    """ Get client for app ID. """
+    if appid not in CLIENTS:
+        CLIENTS[appid] = Client(appid, config.get('knowitall.threads'))
+    return CLIENTS[appid]
 
 
 ## Module.
@@ -34,11 +82,14 @@ def calculate(bot, server, target, source, message, parsed, private, admin):
 
 @asyncio.coroutine
 def define_wolframalpha(definition, bot, source, server, channel):
-    client = wolframalpha.Client(config.get('api.wolframalpha.appid', server, channel))
-    res = yield from bot.loop.run_in_executor(None, client.query, definition)
+    from michiru.modules import knowitall
+
+    c = client(config.get('api.wolframalpha.appid', server, channel))
+    timeout = config.get('knowitall.request_timeout', server, channel)
+    pods = yield from knowitall.run_blocking(bot, c.query, definition, timeout, server=server, channel=channel)
 
     defs = []
-    for pod in res.pods:
+    for pod in pods:
         if pod.title in ('Input', 'Input interpretation'):
             continue
 
@@ -64,9 +115,12 @@ def define_wolframalpha(definition, bot, source, server, channel):
 
 def load():
     from michiru.modules import knowitall
-    knowitall.register(10, 'Wolfram|Alpha', define_wolframalpha)
+    knowitall.register(10, 'Wolfram|Alpha', define_wolframalpha, network=True, ttl=6 * 60 * 60)
     return True
 
 def unload():
     from michiru.modules import knowitall
     knowitall.unregister(10, 'Wolfram|Alpha', define_wolframalpha)
+    for c in CLIENTS.values():
+        c.close()
+    CLIENTS.clear()
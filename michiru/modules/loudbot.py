@@ -1,8 +1,10 @@
 # Loudbot module.
 from datetime import datetime
 import random
+import array
+import hashlib
 
-from michiru import config, db, personalities
+from michiru import config, db, maintenance, personalities
 from michiru.modules import command
 _ = personalities.localize
 
@@ -19,16 +21,69 @@ __desc__ = 'LOUDER'
 config.item('loudbot.cutoff_length', 8)
 config.item('loudbot.response_chance', 0.2)
 
+def shout_hash(shout):
+    """ Get content hash for shout. """
+    if isinstance(shout, str):
+        shout = shout.encode('utf-8')
+    return hashlib.sha1(shout).hexdigest()
+
+SHOUT_INDEX = db.index('server', 'channel', 'hash')
+
+def hash_shouts(table):
+    """ Add content hashes to shouts stored before deduplication. """
+    for rows in db.batches(table, 'shout'):
+        db.query_many(table, 'UPDATE `shouts` SET `hash` = ? WHERE `id` = ?', ((shout_hash(row['shout']), row['id']) for row in rows))
+        yield len(rows)
+
+def merge_shouts(table):
+    """ Keep the first occurrence of every shout, with the count and last shouter of all its repeats. """
+    groups = db.query(table, '''
+        SELECT MIN(`id`) AS `first`, MAX(`id`) AS `latest`, SUM(`count`) AS `count`, `server`, `channel`, `hash`
+        FROM `shouts` GROUP BY `server`, `channel`, `hash` HAVING COUNT(*) > 1
+    ''')
+    for i in range(0, len(groups), 1000):
+        batch = groups[i:i + 1000]
+        db.query_many(table, '''
+            UPDATE `shouts` SET
+                `count` = ?,
+                `last_shouter` = (SELECT s.`shouter` FROM `shouts` AS s WHERE s.`id` = ?),
+                `last_time` = (SELECT s.`time` FROM `shouts` AS s WHERE s.`id` = ?)
+            WHERE `id` = ?
+        ''', ((group['count'], group['latest'], group['latest'], group['first']) for group in batch))
+        db.query_many(table, '''
+            DELETE FROM `shouts` WHERE `server` = ? AND `channel` = ? AND `hash` = ? AND `id` != ?
+        ''', ((group['server'], group['channel'], group['hash'], group['first']) for group in batch))
+        yield len(batch)
+
 db.table('shouts', {
     'id': db.ID,
-    'server': (db.STRING, db.INDEX),
-    'channel': (db.STRING, db.INDEX),
+    'server': db.STRING,
+    'channel': db.STRING,
+    'hash': db.STRING,
+    'count': (db.INT, db.DEFAULT(1)),
     'shouter': db.STRING,
     'shout': db.BINARY,
-    'time': db.DATETIME
-})
+    'time': db.DATETIME,
+    'last_shouter': db.STRING,
+    'last_time': db.DATETIME
+}, indices=[
+    # Covers both random selection per channel and lookups by content.
+    SHOUT_INDEX
+], migrations=[
+    # Deduplication of shouts.
+    db.add_column('hash', db.STRING),
+    db.add_column('count', db.INT, db.DEFAULT(1)),
+    db.add_column('last_shouter', db.STRING),
+    db.add_column('last_time', db.DATETIME),
+    hash_shouts,
+    db.add_index(SHOUT_INDEX),
+    merge_shouts
+])
+maintenance.register('shouts', max_rows=50000, key=('server', 'channel'))
 
 last_shouts = {}
+# (server, channel) -> array of shout IDs, loaded lazily.
+shout_ids = {}
 
 
 ## Personalities.
@@ -70,8 +125,7 @@ def shout(bot, server, target, source, message, parsed, private, admin):
     # Respond with another shout.
     if random.random() <= config.get('loudbot.response_chance'):
         # Fetch random shout.
-        to_shout = db.from_('shouts').where('server', server).and_('channel', target) \
-                                     .random().limit(1).single('id', 'shout')
+        to_shout = random_shout(server, target)
 
         if to_shout:
             id, to_shout = to_shout
@@ -83,14 +137,32 @@ def shout(bot, server, target, source, message, parsed, private, admin):
             # Shout it.
             yield from bot.message(target, to_shout)
 
-    # Add shout to database.
-    db.to('shouts').add({
-        'server': server,
-        'channel': target,
-        'shouter': source,
-        'shout': shout.encode('utf-8'),
-        'time': datetime.now()
-    })
+    # Add shout to database, or count it again if we've seen it before.
+    digest = shout_hash(shout)
+    now = datetime.now()
+    with db.mutex:
+        seen = db.from_('shouts').where('hash', digest).and_('server', server).and_('channel', target).single('id', 'count')
+        if seen:
+            db.on('shouts').where('id', seen['id']).update({
+                'count': seen['count'] + 1,
+                'last_shouter': source,
+                'last_time': now
+            })
+            return
+
+        id = db.to('shouts').add({
+            'server': server,
+            'channel': target,
+            'hash': digest,
+            'count': 1,
+            'shouter': source,
+            'shout': shout.encode('utf-8'),
+            'time': now,
+            'last_shouter': source,
+            'last_time': now
+        })
+    if (server, target) in shout_ids:
+        shout_ids[server, target].append(id)
 
 @command('who (.+)')
 def who_shouted(bot, server, target, source, message, parsed, private, admin):
@@ -106,7 +178,7 @@ def who_shouted(bot, server, target, source, message, parsed, private, admin):
             return
         query.where('id', last_shouts[server, target])
     else:
-        query.where('shout', wanted.encode('utf-8'))
+        query.where('hash', shout_hash(wanted)).and_('server', server).and_('channel', target)
 
     # Look it up.
     shout = query.limit(1).single('shouter', 'time')
@@ -122,10 +194,38 @@ def who_shouted(bot, server, target, source, message, parsed, private, admin):
         yield from bot.message(target, _(bot, '{nick} taught me that on {date}.', nick=bot.highlight(shouter), date=time))
 
 
+## Utility functions.
+
+def channel_shouts(server, channel):
+    """ Get IDs of all shouts for channel, loading them if needed. """
+    if (server, channel) not in shout_ids:
+        rows = db.from_('shouts').where('server', server).and_('channel', channel).get('id')
+        shout_ids[server, channel] = array.array('q', (row['id'] for row in rows))
+    return shout_ids[server, channel]
+
+def random_shout(server, channel, attempts=3):
+    """ Pick a random shout for channel. """
+    ids = channel_shouts(server, channel)
+
+    for _ in range(attempts):
+        if not ids:
+            break
+        i = random.randrange(len(ids))
+        row = db.from_('shouts').where('id', ids[i]).single('id', 'shout')
+        if row:
+            return row
+
+        # Shout got removed behind our back: forget about it.
+        ids[i] = ids[-1]
+        ids.pop()
+
+    return None
+
+
 ## Boilerplate.
 
 def load():
     return True
 
 def unload():
-    pass
+    shout_ids.clear()
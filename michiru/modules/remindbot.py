@@ -21,13 +21,19 @@ __desc__ = 'Reminds you of stuff you had long forgotten about.'
 
 db.table('reminders', {
     'id': db.ID,
-    'server': (db.STRING, db.INDEX),
-    'channel': (db.STRING, db.INDEX),
+    'server': db.STRING,
+    'channel': db.STRING,
     'from': db.STRING,
-    'to': (db.STRING, db.INDEX),
+    'to': db.STRING,
     'message': db.STRING,
     'time': db.DATETIME
-})
+}, indices=[
+    # Untimed reminders get checked on every message.
+    db.index('server', 'to', 'channel', where='`time` IS NULL', covering=('from', 'message'))
+])
+
+# Reminder ID -> timer task.
+TIMERS = {}
 
 personalities.messages('tsun', {
     'Reminder added.':
@@ -76,9 +82,13 @@ def remind(bot, server, target, source, message, parsed, private, admin):
     yield from bot.message(target, _(bot, 'Reminder added.', to=bot.highlight(targ), when=fwhen))
 
     if when:
-        timeout = (when - datetime.now()).total_seconds()
-        yield from asyncio.sleep(timeout)
-        yield from do_remind(bot, id)
+        arm(bot, id, when)
+
+@hook('chat.connect')
+def connect(bot, server):
+    # Timers don't survive restarts, the reminders do.
+    for reminder in db.from_('reminders').where('server', server).and_('time', ('IS NOT', None)).get('id', 'time'):
+        arm(bot, reminder['id'], datetime.strptime(reminder['time'], db.DATETIME_FORMAT))
 
 @hook('chat.join')
 def join(bot, server, channel, who):
@@ -149,6 +159,22 @@ def check_reminders(bot, server, channel, who):
         # ... and remove reminder.
         db.from_('reminders').where('id', reminder['id']).delete()
 
+def arm(bot, id, when):
+    """ Set timer for reminder with given ID, unless it already has one. Overdue reminders go out right away. """
+    if id not in TIMERS:
+        TIMERS[id] = asyncio.ensure_future(remind_at(bot, id, when), loop=bot.loop)
+
+@asyncio.coroutine
+def remind_at(bot, id, when):
+    """ Remind user with reminder with given ID at `when`. """
+    try:
+        timeout = (when - datetime.now()).total_seconds()
+        if timeout > 0:
+            yield from asyncio.sleep(timeout, loop=bot.loop)
+        yield from do_remind(bot, id)
+    finally:
+        TIMERS.pop(id, None)
+
 @asyncio.coroutine
 def do_remind(bot, id):
     """ Reminder callback. Remind user with reminder with given ID. """
@@ -158,8 +184,8 @@ def do_remind(bot, id):
         # Already reminded?
         return
 
-    # Tell user.
-    yield from bot.message(reminder['channel'], _(bot, '{targ}: <{src}> {msg}', targ=bot.highlight(reminder['to']), src=bot.highlight(reminder['from']), msg=reminder['message']))
+    # Tell user, privately if that's where they asked.
+    yield from bot.message(reminder['channel'] or reminder['to'], _(bot, '{targ}: <{src}> {msg}', targ=bot.highlight(reminder['to']), src=bot.highlight(reminder['from']), msg=reminder['message']))
     # Remove reminder.
     db.from_('reminders').where('id', id).delete()
 
@@ -170,4 +196,6 @@ def load():
     return True
 
 def unload():
-    pass
+    for timer in TIMERS.values():
+        timer.cancel()
+    TIMERS.clear()
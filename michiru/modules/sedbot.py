@@ -1,7 +1,11 @@
 # sed search/replacement bot.
 import re
+import time
+import functools
+import collections
+import asyncio
 
-from michiru import config, personalities
+from michiru import config, personalities, workers
 from michiru.modules import command, hook
 _ = personalities.localize
 
@@ -16,8 +20,17 @@ __desc__ = 's/foo/bar/'
 ## Configuration and globals.
 config.item('sedbot.verbose_errors', False)
 config.item('sedbot.log_limit', 5)
+config.item('sedbot.max_tracked', 10000)
+config.item('sedbot.max_idle', 6 * 60 * 60)
+config.item('sedbot.timeout', 1)
+config.item('sedbot.workers', 1)
 
-last_messages = {}
+# (server, channel, nick) -> [last activity, deque of messages], in least recently active order.
+last_messages = collections.OrderedDict()
+# (server, channel) -> log limit, and (maximum idle time, maximum tracked logs), valid for configuration generation `limits_generation`.
+limits = {}
+prune_limits = None
+limits_generation = None
 
 
 ## Commands.
@@ -35,7 +48,7 @@ def sed(bot, server, target, source, message, matched, private, admin):
         delimiter, pattern, replacement, flags = matched.group(1, 2, 3, 4)
 
     # Do we have anything on the source?
-    if not (server, target, targ) in last_messages.keys():
+    if not (server, target, targ) in last_messages:
         if config.get('sedbot.verbose_errors', server, target):
             raise EnvironmentError(_(bot, 'No messages to match.'))
         return
@@ -51,9 +64,9 @@ def sed(bot, server, target, source, message, matched, private, admin):
     pattern = pattern.replace('\\' + delimiter, delimiter)
     replacement = replacement.replace('\\' + delimiter, delimiter)
 
-    # Compile regexp.
+    # Compile regexp, mostly to see if it's valid before bothering a worker with it.
     try:
-        expr = re.compile(pattern, re_flags)
+        expr = compile_pattern(pattern, re_flags)
         if not expr:
             if config.get('sedbot.verbose_errors', server, target):
                 raise ValueError(_(bot, 'Invalid regular expression.'))
@@ -64,16 +77,20 @@ def sed(bot, server, target, source, message, matched, private, admin):
             raise ValueError(_(bot, 'Invalid regular expression.'))
         return
 
-    # Start matching.
-    matched_message = None
-    msg = None
-    for message in reversed(last_messages[server, target, targ]):
-        msg = expr.sub(_(bot, '{b}{repl}{/b}', repl=replacement), message, count=0 if 'g' in flags else 1)
-        if msg != message:
-            matched_message = message
-            break
-        else:
-            msg = None
+    # Start matching. User-supplied expressions can take forever, so do it in a sandbox we can kill.
+    messages = list(last_messages[server, target, targ][1])
+    box = workers.sandbox('sedbot', config.get('sedbot.workers'))
+    try:
+        matched_message, msg = yield from box.run(bot.loop, config.get('sedbot.timeout', server, target),
+            substitute, pattern, re_flags, _(bot, '{b}{repl}{/b}', repl=replacement), messages, 0 if 'g' in flags else 1)
+    except asyncio.TimeoutError:
+        if config.get('sedbot.verbose_errors', server, target):
+            raise ValueError(_(bot, 'Regular expression took too long.'))
+        return
+    except:
+        if config.get('sedbot.verbose_errors', server, target):
+            raise ValueError(_(bot, 'Invalid regular expression.'))
+        return
 
     # No message matched?
     if not msg:
@@ -87,15 +104,69 @@ def sed(bot, server, target, source, message, matched, private, admin):
 @hook('chat.message')
 def log(bot, server, target, who, message, private, admin):
     global last_messages
+    key = server, target, who
+    now = time.monotonic()
+    limit = log_limit(server, target)
 
     # Add message to log.
-    if not (server, target, who) in last_messages:
-        last_messages[server, target, who] = []
-    last_messages[server, target, who].append(message)
+    entry = last_messages.get(key)
+    if entry is None:
+        entry = last_messages[key] = [now, collections.deque(maxlen=limit)]
+    elif entry[1].maxlen != limit:
+        entry[1] = collections.deque(entry[1], maxlen=limit)
+    entry[0] = now
+    entry[1].append(message)
+    last_messages.move_to_end(key)
+
+    # Prune idle and least recently active logs.
+    max_idle, max_tracked = pruning()
+    while last_messages:
+        oldest, (stamp, _messages) = next(iter(last_messages.items()))
+        if len(last_messages) <= max_tracked and now - stamp <= max_idle:
+            break
+        del last_messages[oldest]
+
+
+## Utility functions.
+
+@functools.lru_cache(maxsize=128)
+def compile_pattern(pattern, flags):
+    """ Compile regular expression, reusing recently compiled ones. """
+    return re.compile(pattern, flags)
+
+def substitute(pattern, flags, replacement, messages, count):
+    """ Substitute in the most recent matching message. Runs in a sandbox worker. """
+    expr = compile_pattern(pattern, flags)
+    for message in reversed(messages):
+        msg = expr.sub(replacement, message, count=count)
+        if msg != message:
+            return message, msg
+    return None, None
+
+def refresh_limits():
+    """ Forget cached limits if the configuration changed. """
+    global prune_limits, limits_generation
+
+    if limits_generation != config.generation:
+        limits.clear()
+        prune_limits = None
+        limits_generation = config.generation
+
+def log_limit(server, channel):
+    """ Get log limit for channel, only looking at the configuration again when it changed. """
+    refresh_limits()
+    if (server, channel) not in limits:
+        limits[server, channel] = config.get('sedbot.log_limit', server, channel)
+    return limits[server, channel]
+
+def pruning():
+    """ Get maximum idle time and number of tracked logs, only looking at the configuration again when it changed. """
+    global prune_limits
 
-    # Prune.
-    while len(last_messages[server, target, who]) > config.get('sedbot.log_limit', server, target):
-        last_messages[server, target, who].pop(0)
+    refresh_limits()
+    if prune_limits is None:
+        prune_limits = config.get('sedbot.max_idle'), config.get('sedbot.max_tracked')
+    return prune_limits
 
 
 ## Boilerplate.
@@ -104,4 +175,8 @@ def load():
     return True
 
 def unload():
-    pass
+    global prune_limits
+    workers.stop_sandbox('sedbot')
+    last_messages.clear()
+    limits.clear()
+    prune_limits = None
@@ -2,7 +2,7 @@
 from datetime import datetime
 import json
 
-from michiru import db, personalities
+from michiru import db, maintenance, personalities
 from michiru.modules import command, hook
 _ = personalities.localize
 
@@ -18,12 +18,16 @@ __desc__ = 'Tells when someone was last seen.'
 
 db.table('seen', {
     'id': db.ID,
-    'server': (db.STRING, db.INDEX),
-    'nickname': (db.STRING, db.INDEX),
+    'server': db.STRING,
+    'nickname': db.STRING,
     'action': db.INT,
     'data': db.STRING,
     'time': db.DATETIME
-})
+}, indices=[
+    db.index('server', 'nickname')
+])
+# Nobody cares about who was around a year ago.
+maintenance.register('seen', max_age=365 * 24 * 60 * 60)
 
 # The action values. Fake enum.
 class Actions:
@@ -120,6 +124,9 @@ def seen(bot, server, target, source, message, parsed, private, admin):
     elif nick == bot.nickname:
         yield from bot.message(target, _(bot, "I'm right here.", serv=server, nick=nick))
         return
+    elif not private and bot.presence.present(nick, target):
+        yield from bot.message(target, _(bot, '{nick} is right here.', serv=server, nick=bot.highlight(nick)))
+        return
 
     # Do we have an entry for this nick?
     entry = db.from_('seen').where('nickname', nick.lower()).and_('server', server).single('action', 'data', 'time')
@@ -10,7 +10,7 @@ import requests
 import bs4
 import aniso8601
 
-from michiru import config, personalities, version
+from michiru import config, personalities, version, workers
 from michiru.modules import command
 _ = personalities.localize
 
@@ -37,11 +37,15 @@ URI_REGEXP = re.compile(r"""(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-
 
 ## URI handlers.
 
+def is_html(headers):
+    """ Check if response headers indicate a document we can get a title from. """
+    content_type = headers.get('content-type', 'text/html')
+    content_type = content_type.split(';')[0].strip().lower()
+    return content_type in ('text/html', 'text/xml', 'text/xhtml', 'application/xml', 'application/xhtml+xml')
+
 def uri_title(bot, response, matches):
     """ Extract a regular URL title. """
-    content_type = response.headers.get('content-type', 'text/html')
-    content_type = content_type.split(';')[0].strip().lower()
-    if content_type not in ('text/html', 'text/xml', 'text/xhtml', 'application/xml', 'application/xhtml+xml'):
+    if not is_html(response.headers):
         return None
 
     html = bs4.BeautifulSoup(response.text)
@@ -61,6 +65,63 @@ def uri_title(bot, response, matches):
 URI_HANDLERS = {}
 
 
+## Worker process support.
+# Handlers can declare themselves CPU-bound, in which case they get run in a worker process
+# with the stand-ins below instead of the bot, response and match objects.
+
+class Formatter:
+    """ Stand-in for the bot: only provides format codes. """
+    def __init__(self, format_codes):
+        self.FORMAT_CODES = format_codes
+
+class Payload:
+    """ Stand-in for the response: raw content and lowercased headers. """
+    def __init__(self, content, encoding, headers):
+        self.content = content
+        self.encoding = encoding
+        self.headers = headers
+
+    @property
+    def apparent_encoding(self):
+        """ Guess encoding from the content, like requests does. """
+        from requests.compat import chardet
+        return chardet.detect(self.content)['encoding']
+
+    @property
+    def text(self):
+        encoding = self.encoding or self.apparent_encoding or 'utf-8'
+        try:
+            return self.content.decode(encoding, 'replace')
+        except LookupError:
+            return self.content.decode('utf-8', 'replace')
+
+class Groups:
+    """ Stand-in for the URI match: only provides its groups. """
+    def __init__(self, groups):
+        self.groups_ = groups
+
+    def group(self, *indices):
+        groups = [self.groups_[i] for i in (indices or (0,))]
+        return groups[0] if len(groups) == 1 else tuple(groups)
+
+def parse(handler, format_codes, content, encoding, headers, groups):
+    """ Run referenced handler on raw response data. Runs in a worker process. """
+    func = workers.resolve(*handler)
+    matches = Groups(groups) if groups is not None else None
+    return func(Formatter(format_codes), Payload(content, encoding, headers), matches)
+
+@asyncio.coroutine
+def offload(bot, handler, response, matches):
+    """ Run handler in a worker process. """
+    # Reading a streamed response body blocks, so do that outside of the loop as well.
+    content = yield from bot.loop.run_in_executor(None, lambda: response.content)
+    headers = {k.lower(): v for k, v in response.headers.items()}
+    groups = (matches.group(0),) + matches.groups() if matches else None
+    res = yield from workers.offload(bot.loop, parse,
+        workers.reference(handler), bot.FORMAT_CODES, content, response.encoding, headers, groups)
+    return res
+
+
 ## Commands.
 
 @command(r'(?:^|.*\s)https?://', bare=True)
@@ -86,6 +147,7 @@ def uri(bot, server, target, source, message, parsed, private, admin):
 
         # Stock handler: extract the URI.
         handler = uri_title
+        cpu_bound = True
         headers = {}
 
         # See if we want a custom handler.
@@ -101,6 +163,7 @@ def uri(bot, server, target, source, message, parsed, private, admin):
                 if 'headers' in details:
                     headers.update(details['headers'])
                 handler = details['handler']
+                cpu_bound = details.get('cpu_bound', False)
                 break
 
 
@@ -118,9 +181,16 @@ def uri(bot, server, target, source, message, parsed, private, admin):
                 yield from bot.message(target, _(bot, 'Couldn\'t load URL! Response code: {}'.format(response.status_code)))
             continue
 
+        # Don't bother downloading things we can't get a title from.
+        if handler is uri_title and not is_html(response.headers):
+            continue
+
         # Parse response.
         try:
-            res = handler(bot, response, matches)
+            if cpu_bound:
+                res = yield from offload(bot, handler, response, matches)
+            else:
+                res = handler(bot, response, matches)
             if not res:
                 continue
         except:
@@ -148,7 +218,9 @@ def load():
         URI_HANDLERS[re.compile(match)] = value
         del URI_HANDLERS[match]
 
+    # Start workers early so they're warm by the time the first URL comes in.
+    workers.processes()
     return True
 
 def unload():
-    pass
+    workers.stop_processes()
@@ -79,6 +79,7 @@ def load():
     from michiru.modules import uribot
     uribot.URI_HANDLERS[URI_REGEXP] = {
         'handler': uri_4chan,
+        'cpu_bound': True,
         'replacement': r'https://api.4chan.org/\1/res/\2.json'
     }
 
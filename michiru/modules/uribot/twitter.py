@@ -70,6 +70,7 @@ def load():
     from michiru.modules import uribot
     uribot.URI_HANDLERS[URI_REGEXP] = {
         'handler': uri_twitter,
+        'cpu_bound': True
     }
 
 def unload():
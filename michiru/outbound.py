@@ -0,0 +1,217 @@
+# Outbound message scheduling and flood control.
+import time
+import collections
+import traceback
+import asyncio
+
+
+class TokenBucket:
+    """ Token bucket allowing `burst` sends at once, refilling at `rate` tokens per second. A rate of 0 or less means no throttling. """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def refill(self):
+        """ Add tokens for the time passed since the last refill. """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * max(self.rate, 0))
+        self.stamp = now
+
+    def delay(self):
+        """ Return the amount of seconds until a token is available. """
+        if self.rate <= 0:
+            return 0
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """ Take a token. """
+        self.refill()
+        self.tokens -= 1
+
+
+def split(line, limit, measure=len):
+    """ Split `line` into chunks no longer than `limit` according to `measure`, preferably at whitespace. """
+    chunks = []
+
+    while measure(line) > limit:
+        # Find the longest prefix that still fits.
+        size = 0
+        cut = 0
+        for i, c in enumerate(line):
+            size += measure(c)
+            if size > limit:
+                break
+            cut = i + 1
+        cut = max(cut, 1)
+
+        # Try not to split in the middle of a word, unless that wastes half the line.
+        space = line.rfind(' ', 0, cut + 1)
+        if space > 0 and space >= cut // 2:
+            cut = space
+
+        chunks.append(line[:cut].rstrip())
+        line = line[cut:].lstrip()
+
+    if line or not chunks:
+        chunks.append(line)
+    return chunks
+
+
+class OutboundQueue:
+    """
+    Outbound message scheduler for a single server.
+    Messages are queued per target and sent in round-robin order, throttled by a token bucket.
+    Urgent messages, where timing matters, skip the line and the wait for a token.
+    They still use up tokens, so regular messages make up for them afterwards.
+    """
+    def __init__(self, loop, send, rate, burst, limit, separator=None, encoding=None):
+        self.loop = loop
+        self.send = send
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = limit
+        self.separator = separator
+        self.encoding = encoding
+        self.targets = collections.OrderedDict()
+        # Urgent (target, line, stamp, future) entries.
+        self.urgent = collections.deque()
+        self.wake = asyncio.Event(loop=loop)
+        self.task = None
+
+        # Statistics.
+        self.sent = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def measure(self, line):
+        """ Return length of line as counted by the protocol. """
+        if self.encoding:
+            return len(line.encode(self.encoding, 'replace'))
+        return len(line)
+
+    def put(self, target, message, urgent=False, track=False):
+        """
+        Queue message for target and make sure it will be sent.
+        If it is urgent or `track` is set, returns a future that resolves once the message has been sent.
+        """
+        # Protocols that can't merge lines can't send newlines either.
+        if self.separator is None:
+            lines = message.splitlines() or ['']
+        else:
+            lines = [message]
+
+        stamp = time.monotonic()
+        chunks = [chunk for line in lines for chunk in split(line, self.limit, self.measure)]
+
+        future = asyncio.Future(loop=self.loop) if urgent or track else None
+        # Only the last chunk carries the future: lines for a target go out in order.
+        entries = [(chunk, stamp, future if i == len(chunks) - 1 else None) for i, chunk in enumerate(chunks)]
+        if urgent:
+            self.urgent.extend((target,) + entry for entry in entries)
+            self.wake.set()
+        else:
+            self.targets.setdefault(target, collections.deque()).extend(entries)
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run(), loop=self.loop)
+        return future
+
+    def discard(self, target):
+        """ Drop urgent messages still queued for target. """
+        kept = collections.deque()
+        for entry in self.urgent:
+            if entry[0] != target:
+                kept.append(entry)
+            elif entry[3] is not None:
+                entry[3].cancel()
+        self.urgent = kept
+
+    def clear(self):
+        """ Drop all queued messages. """
+        for queue in self.targets.values():
+            for entry in queue:
+                if entry[2] is not None:
+                    entry[2].cancel()
+        self.targets.clear()
+        for entry in self.urgent:
+            if entry[3] is not None:
+                entry[3].cancel()
+        self.urgent.clear()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def depth(self):
+        """ Return the amount of lines waiting to be sent. """
+        return len(self.urgent) + sum(len(queue) for queue in self.targets.values())
+
+    def stats(self):
+        """ Return queue statistics. """
+        return {
+            'depth': self.depth(),
+            'targets': len(self.targets),
+            'sent': self.sent,
+            'latency': self.latency,
+            'max_latency': self.max_latency
+        }
+
+    def next(self):
+        """ Pop the next line to send in round-robin order, merging short lines for its target where possible. """
+        target, queue = self.targets.popitem(last=False)
+        line, stamp, future = queue.popleft()
+        futures = [future]
+
+        if self.separator is not None:
+            while queue:
+                merged = line + self.separator + queue[0][0]
+                if self.measure(merged) > self.limit:
+                    break
+                line = merged
+                futures.append(queue.popleft()[2])
+
+        # Move target to the back of the line.
+        if queue:
+            self.targets[target] = queue
+        return target, line, stamp, [f for f in futures if f is not None]
+
+    @asyncio.coroutine
+    def run(self):
+        """ Send queued lines until the queue is empty. """
+        while self.urgent or self.targets:
+            if self.urgent:
+                target, line, stamp, future = self.urgent.popleft()
+                futures = [future] if future is not None else []
+            else:
+                delay = self.bucket.delay()
+                if delay:
+                    # Wait for a token, unless something urgent comes in.
+                    self.wake.clear()
+                    try:
+                        yield from asyncio.wait_for(self.wake.wait(), delay, loop=self.loop)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                target, line, stamp, futures = self.next()
+
+            self.bucket.take()
+            try:
+                yield from self.send(target, line)
+            except Exception as e:
+                traceback.print_exc()
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+
+            # Keep track of an exponential moving average of queue latency.
+            latency = time.monotonic() - stamp
+            self.latency = latency if not self.sent else 0.9 * self.latency + 0.1 * latency
+            self.max_latency = max(self.max_latency, latency)
+            self.sent += 1
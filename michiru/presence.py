@@ -0,0 +1,138 @@
+# Per-server user and channel presence cache.
+
+
+class Presence:
+    """
+    Membership cache for a single server: who is in which channel, and what we know about them.
+    Kept up to date by the transport from join/part/quit/nick/kick events and WHO replies.
+    """
+    def __init__(self, normalize=None):
+        self.normalize = normalize or (lambda x: x)
+        # Normalized channel -> set of normalized nicknames.
+        self.channels = {}
+        # Normalized nickname -> user info.
+        self.users = {}
+
+    def user(self, nick):
+        """ Get or create info for user. """
+        key = self.normalize(nick)
+        if key not in self.users:
+            self.users[key] = {
+                'nickname': nick,
+                'account': None,
+                'identified': None,
+                'channels': set()
+            }
+        return self.users[key]
+
+    def forget(self, nick):
+        """ Remove user from all channels and the cache. """
+        key = self.normalize(nick)
+        info = self.users.pop(key, None)
+        if info:
+            for chan in info['channels']:
+                self.channels.get(chan, set()).discard(key)
+
+    def join(self, channel, nick, **info):
+        """ Register user as present in channel. """
+        chan = self.normalize(channel)
+        user = self.user(nick)
+        user.update(info)
+        user['channels'].add(chan)
+        self.channels.setdefault(chan, set()).add(self.normalize(nick))
+
+    def part(self, channel, nick):
+        """ Register user as gone from channel. """
+        chan = self.normalize(channel)
+        key = self.normalize(nick)
+        self.channels.get(chan, set()).discard(key)
+
+        # Only keep track of users we share a channel with.
+        info = self.users.get(key)
+        if info:
+            info['channels'].discard(chan)
+            if not info['channels']:
+                del self.users[key]
+
+    def kick(self, channel, nick):
+        """ Register user as kicked from channel. """
+        self.part(channel, nick)
+
+    def quit(self, nick):
+        """ Register user as disconnected. """
+        self.forget(nick)
+
+    def rename(self, old, new, keep_account=False):
+        """
+        Register nickname change. Account information is forgotten,
+        unless `keep_account` says the server tells us about every account change.
+        """
+        old_key = self.normalize(old)
+        new_key = self.normalize(new)
+        info = self.users.pop(old_key, None)
+        if not info:
+            return
+
+        info['nickname'] = new
+        if not keep_account:
+            info['account'] = None
+            info['identified'] = None
+        self.users[new_key] = info
+        for chan in info['channels']:
+            members = self.channels.get(chan)
+            if members is not None:
+                members.discard(old_key)
+                members.add(new_key)
+
+    def update(self, nick, **info):
+        """ Update information for a user we know about. """
+        key = self.normalize(nick)
+        if key in self.users:
+            self.users[key].update(info)
+
+    def clear(self, channel=None):
+        """ Forget everything about channel, or about everything. """
+        if channel is None:
+            self.channels.clear()
+            self.users.clear()
+            return
+
+        chan = self.normalize(channel)
+        for key in self.channels.pop(chan, set()):
+            info = self.users.get(key)
+            if info:
+                info['channels'].discard(chan)
+                if not info['channels']:
+                    del self.users[key]
+
+
+    ## Queries.
+
+    def known(self, nick):
+        """ Check if we share a channel with user. """
+        return self.normalize(nick) in self.users
+
+    def present(self, nick, channel):
+        """ Check if user is in channel. """
+        return self.normalize(nick) in self.channels.get(self.normalize(channel), ())
+
+    def members(self, channel):
+        """ List nicknames of users in channel. """
+        return [self.users[key]['nickname'] for key in self.channels.get(self.normalize(channel), ()) if key in self.users]
+
+    def channels_of(self, nick):
+        """ List channels user is in, as far as we can see. """
+        info = self.users.get(self.normalize(nick))
+        return list(info['channels']) if info else []
+
+    def account(self, nick):
+        """ Get account name for user, or None. """
+        info = self.users.get(self.normalize(nick))
+        return info['account'] if info else None
+
+    def identified(self, nick):
+        """ Check if user is known to be identified. Returns None if we don't know. """
+        info = self.users.get(self.normalize(nick))
+        if not info:
+            return None
+        return info['identified']
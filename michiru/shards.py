@@ -0,0 +1,130 @@
+# Multi-process sharding of servers.
+import zlib
+import traceback
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+
+
+# Index and amount of shards, and the connection to the supervisor, if we are a shard.
+index = None
+count = None
+connection = None
+# Event loop that owns the connection.
+loop = None
+# Fanned out action handlers: name -> function.
+actions = {}
+
+
+## Shard information.
+
+def active():
+    """ Check if we are running as a shard. """
+    return connection is not None
+
+def primary():
+    """ Check if we are the primary shard. Services that can only run once should only run here. """
+    return not active() or index == 0
+
+def owner(tag):
+    """ Get index of the shard responsible for server `tag`. """
+    return zlib.crc32(tag.encode('utf-8')) % count
+
+def owns(tag):
+    """ Check if server `tag` should be run by us. """
+    return not active() or owner(tag) == index
+
+
+## Action fan-out.
+
+def action(name):
+    """ Decorator to register a handler for a fanned out action. """
+    def inner(func):
+        actions[name] = func
+        return func
+    return inner
+
+def broadcast(name, *args, **kwargs):
+    """ Ask all other shards to perform action `name`. Does nothing if we're not sharded. """
+    if not active():
+        return
+    # Connections aren't thread-safe, so leave the sending to the loop.
+    if loop is not None:
+        loop.call_soon_threadsafe(connection.send, (name, args, kwargs))
+    else:
+        connection.send((name, args, kwargs))
+
+def receive(loop):
+    """ Perform all actions the supervisor relayed to us. """
+    while connection.poll():
+        try:
+            name, args, kwargs = connection.recv()
+        except EOFError:
+            # Supervisor is gone, so are we.
+            loop.remove_reader(connection.fileno())
+            loop.stop()
+            return
+
+        if name not in actions:
+            print('unknown shard action: {}'.format(name))
+            continue
+
+        try:
+            res = actions[name](*args, **kwargs)
+            if asyncio.iscoroutine(res):
+                asyncio.ensure_future(res, loop=loop)
+        except:
+            traceback.print_exc()
+
+def attach(event_loop):
+    """ Start listening for relayed actions on `event_loop`. """
+    global loop
+    if active():
+        loop = event_loop
+        loop.add_reader(connection.fileno(), receive, loop)
+
+
+## Process management.
+
+def worker(i, n, conn, main):
+    """ Shard entry point. """
+    global index, count, connection
+    index = i
+    count = n
+    connection = conn
+    main()
+
+def supervise(n, main):
+    """ Run `main` in `n` shard processes and relay actions between them until all of them exit. """
+    # Shards inherit the loaded configuration, so we need to fork.
+    context = multiprocessing.get_context('fork')
+    connections = {}
+    processes = []
+
+    for i in range(n):
+        parent, child = context.Pipe()
+        process = context.Process(target=worker, args=(i, n, child, main), name='michiru-shard-{}'.format(i))
+        process.start()
+        child.close()
+
+        connections[parent] = i
+        processes.append(process)
+
+    while connections:
+        for conn in multiprocessing.connection.wait(list(connections)):
+            try:
+                message = conn.recv()
+            except EOFError:
+                print('shard {} exited'.format(connections.pop(conn)))
+                continue
+
+            for other in connections:
+                if other is conn:
+                    continue
+                try:
+                    other.send(message)
+                except (EOFError, OSError):
+                    pass
+
+    for process in processes:
+        process.join()
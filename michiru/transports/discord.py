@@ -1,4 +1,5 @@
 import random
+import collections
 import asyncio
 import discord
 
@@ -22,12 +23,21 @@ class DiscordPool:
         return transport
 
 class DiscordClient(discord.Client):
+    # Maximum amount of unknown member names to remember per server.
+    MEMBER_MISS_LIMIT = 1024
+
     def __init__(self, loop):
         super().__init__(loop=loop)
         self.michiru_server_info = {}
+        # Tag -> server, and reverse indexes: server name -> tag, server ID -> tag.
         self.michiru_server_mapping = {}
+        self.michiru_server_names = {}
+        self.michiru_server_tags = {}
+        # Tag -> name -> channel/member.
         self.michiru_channel_mapping = {}
-        self.michiru_user_mapping = {}
+        self.michiru_member_mapping = {}
+        # Tag -> names known not to belong to any member, in least recently used order.
+        self.michiru_member_misses = {}
         self.michiru_transports = {}
         self.michiru_routing = {}
         self.michiru_connected = False
@@ -38,13 +48,22 @@ class DiscordClient(discord.Client):
     def register_server(self, tag, info, transport):
         self.michiru_server_info[tag] = info
         self.michiru_server_mapping[tag] = None
+        self.michiru_server_names[info['name']] = tag
         self.michiru_channel_mapping[tag] = {}
+        self.michiru_member_mapping[tag] = {}
+        self.michiru_member_misses[tag] = collections.OrderedDict()
         self.michiru_transports[tag] = transport
 
     def deregister_server(self, tag):
+        server = self.michiru_server_mapping[tag]
+        if server is not None:
+            del self.michiru_server_tags[server.id]
+        del self.michiru_server_names[self.michiru_server_info[tag]['name']]
         del self.michiru_server_info[tag]
         del self.michiru_server_mapping[tag]
         del self.michiru_channel_mapping[tag]
+        del self.michiru_member_mapping[tag]
+        del self.michiru_member_misses[tag]
         del self.michiru_transports[tag]
 
     @asyncio.coroutine
@@ -54,44 +73,77 @@ class DiscordClient(discord.Client):
 
     @asyncio.coroutine
     def on_ready(self):
-        for tag in self.michiru_server_info:
-            yield from self.michiru_sync_server(tag)
+        for server in self.servers:
+            tag = self.michiru_server_names.get(server.name)
+            if tag:
+                yield from self.michiru_sync_server(tag, server)
+
+        for tag, server in self.michiru_server_mapping.items():
+            if server is None:
+                print('no such server: {}'.format(tag))
 
     @asyncio.coroutine
     def on_server_join(self, server):
-        yield from self.michiru_sync_server(self.michiru_get_tag(server))
+        tag = self.michiru_server_names.get(server.name)
+        if tag:
+            yield from self.michiru_sync_server(tag, server)
 
     def michiru_get_tag(self, server):
-        for tag, s in self.michiru_server_mapping.items():
-            if server == s:
-                return tag
-        return None
+        if server is None:
+            return None
+        return self.michiru_server_tags.get(server.id)
+
+    def michiru_get_member(self, tag, name):
+        """ Get member of server by name, indexing it if we haven't seen it yet. """
+        members = self.michiru_member_mapping[tag]
+        if name in members:
+            return members[name]
+
+        # Don't scan the member list again for names we know nobody has.
+        misses = self.michiru_member_misses[tag]
+        if name in misses:
+            misses.move_to_end(name)
+            return None
+
+        server = self.michiru_server_mapping[tag]
+        member = server.get_member_named(name) if server else None
+        if member is None:
+            misses[name] = True
+            if len(misses) > self.MEMBER_MISS_LIMIT:
+                misses.popitem(last=False)
+            return None
+
+        members[name] = member
+        return member
+
+    def michiru_forget_misses(self, tag, member):
+        """ Forget we couldn't find the names `member` goes by. """
+        misses = self.michiru_member_misses[tag]
+        for name in (member.name, member.nick, str(member)):
+            misses.pop(name, None)
 
     @asyncio.coroutine
-    def michiru_sync_server(self, tag):
-        new = tag not in self.michiru_server_mapping
-        for s in self.servers:
-            if s.name == self.michiru_server_info[tag]['name']:
-                self.michiru_server_mapping[tag] = s
-                break
-        else:
-            print('no such server: {}'.format(tag))
-            return
+    def michiru_sync_server(self, tag, server):
+        new = self.michiru_server_mapping[tag] is None
+        self.michiru_server_mapping[tag] = server
+        self.michiru_server_tags[server.id] = tag
 
         transport = self.michiru_transports[tag]
-        server    = self.michiru_server_mapping[tag]
         if new:
-            yield from events.emit('chat.connect', transport, tag)
+            yield from events.emit('chat.connect', transport, tag, _server=tag)
 
-        for user in server.members:
-            self.michiru_user_mapping[user.name] = user
+        # Members are indexed lazily as they show up, so syncing only costs as much as the channel list.
+        self.michiru_member_mapping[tag].clear()
+        self.michiru_member_misses[tag].clear()
 
+        channels = self.michiru_channel_mapping[tag]
+        channels.clear()
         for channel in server.channels:
-            self.michiru_channel_mapping[tag][channel.name] = channel
+            channels[channel.name] = channel
             if channel.type in (discord.ChannelType.voice, discord.ChannelType.private):
                 continue
             if new:
-                yield from events.emit('chat.join', transport, server, channel.name, server.me.name)
+                yield from events.emit('chat.join', transport, tag, channel.name, server.me.name, _server=tag, _channel=channel.name)
 
     @asyncio.coroutine
     def on_message(self, message):
@@ -104,8 +156,12 @@ class DiscordClient(discord.Client):
         if not server or target.type == discord.ChannelType.private:
             private = True
         if not server:
-            self.michiru_routing.setdefault(message.user.name, random.choice(self.michiru_server_mapping.values()))
-            server = self.michiru_routing[message.user.name]
+            tag = self.michiru_routing.setdefault(source.id, random.choice(list(self.michiru_server_info)))
+            server = self.michiru_server_mapping[tag]
+        if tag is None or server is None:
+            return
+        if not private:
+            self.michiru_member_mapping[tag][source.name] = source
 
         contents = parsed_contents = message.content
         highlight = False
@@ -126,43 +182,70 @@ class DiscordClient(discord.Client):
         admin = yield from self.michiru_transports[tag].is_admin(source.name, chan=None if private else target.name)
         if source != server.me:
             yield from self.michiru_transports[tag].run_commands(target.name, source.name, ccontents, parsed_contents, highlight, private)
-        yield from events.emit('chat.message', self.michiru_transports[tag], tag, target.name, source.name, ccontents, private, admin)
+        yield from events.emit('chat.message', self.michiru_transports[tag], tag, target.name, source.name, ccontents, private, admin, _server=tag, _channel=None if private else target.name)
 
     @asyncio.coroutine
     def on_member_join(self, member):
         server = member.server
         tag = self.michiru_get_tag(server)
+        if tag is None:
+            return
         transport = self.michiru_transports[tag]
+        self.michiru_member_mapping[tag][member.name] = member
+        # Names we couldn't find before might match the new member.
+        self.michiru_forget_misses(tag, member)
 
         for chan in self.michiru_channel_mapping[tag].values():
             if chan.type in (discord.ChannelType.voice, discord.ChannelType.private):
                 continue
             if chan.type == discord.ChannelType.text or (chan.type == discord.ChannelType.group and member in chan.recipients):
-                yield from events.emit('chat.join', transport, tag, chan.name, member.name)
+                transport.presence.join(chan.name, member.name)
+                yield from events.emit('chat.join', transport, tag, chan.name, member.name, _server=tag, _channel=chan.name)
+
+    @asyncio.coroutine
+    def on_member_remove(self, member):
+        server = member.server
+        tag = self.michiru_get_tag(server)
+        if tag is None:
+            return
+        transport = self.michiru_transports[tag]
+
+        self.michiru_member_mapping[tag].pop(member.name, None)
+        transport.presence.quit(member.name)
 
     @asyncio.coroutine
     def on_group_join(self, channel, user):
         server = channel.server
         tag = self.michiru_get_tag(server)
+        if tag is None:
+            return
         transport = self.michiru_transports[tag]
 
-        yield from events.emit('chat.join', transport, tag, channel.name, user.name)
+        transport.presence.join(channel.name, user.name)
+        yield from events.emit('chat.join', transport, tag, channel.name, user.name, _server=tag, _channel=channel.name)
 
     @asyncio.coroutine
     def on_group_remove(self, channel, user):
         server = channel.server
         tag = self.michiru_get_tag(server)
+        if tag is None:
+            return
         transport = self.michiru_transports[tag]
 
-        yield from events.emit('chat.part', transport, tag, channel.name, user.name, None)
+        transport.presence.part(channel.name, user.name)
+        yield from events.emit('chat.part', transport, tag, channel.name, user.name, None, _server=tag, _channel=channel.name)
 
     @asyncio.coroutine
     def on_member_ban(self, member):
         server = member.server
         tag = self.michiru_get_tag(server)
+        if tag is None:
+            return
         transport = self.michiru_transports[tag]
 
-        yield from events.emit('chat.disconnect', transport, tag, member.name, 'Banned')
+        self.michiru_member_mapping[tag].pop(member.name, None)
+        transport.presence.quit(member.name)
+        yield from events.emit('chat.disconnect', transport, tag, member.name, 'Banned', _server=tag)
 
     @asyncio.coroutine
     def on_member_unban(self, member):
@@ -172,37 +255,70 @@ class DiscordClient(discord.Client):
     def on_member_update(self, before, after):
         server = after.server
         tag = self.michiru_get_tag(server)
+        if tag is None:
+            return
         transport = self.michiru_transports[tag]
+        members = self.michiru_member_mapping[tag]
+
+        # Most updates are about status or roles: just keep members we already know about current.
+        if before.name == after.name and before.nick == after.nick:
+            if after.name in members and members[after.name].id == after.id:
+                members[after.name] = after
+            return
+
+        # They might be known under their old name or nickname, which someone else can take now.
+        known = [name for name, member in members.items() if member.id == after.id]
+        for name in known:
+            del members[name]
+        if known:
+            members[after.name] = after
+        # Names we couldn't find before might match the new name or nickname.
+        self.michiru_forget_misses(tag, after)
+        if before.name != after.name:
+            transport.presence.rename(before.name, after.name)
 
     @asyncio.coroutine
     def on_channel_create(self, channel):
         server = channel.server
         tag = self.michiru_get_tag(server)
+        if tag is None:
+            return
         transport = self.michiru_transports[tag]
+        self.michiru_channel_mapping[tag][channel.name] = channel
 
-        yield from events.emit('chat.join', transport, tag, channel.name, server.me.name)
+        if channel.type in (discord.ChannelType.voice, discord.ChannelType.private):
+            return
+        yield from events.emit('chat.join', transport, tag, channel.name, server.me.name, _server=tag, _channel=channel.name)
 
     @asyncio.coroutine
     def on_channel_delete(self, channel):
         server = channel.server
         tag = self.michiru_get_tag(server)
+        if tag is None:
+            return
         transport = self.michiru_transports[tag]
+        self.michiru_channel_mapping[tag].pop(channel.name, None)
+        transport.presence.clear(channel.name)
 
-        yield from events.emit('chat.join', transport, tag, channel.name, server.me.name, 'Channel deleted')
+        if channel.type in (discord.ChannelType.voice, discord.ChannelType.private):
+            return
+        yield from events.emit('chat.part', transport, tag, channel.name, server.me.name, 'Channel deleted', _server=tag, _channel=channel.name)
 
     @asyncio.coroutine
     def on_channel_update(self, before, after):
         server = after.server
         tag = self.michiru_get_tag(server)
+        if tag is None:
+            return
         transport = self.michiru_transports[tag]
 
         if before.name != after.name:
-            self.michiru_channel_mapping[tag][after.name] = after
-            del self.michiru_channel_mapping[tag][before.name]
-            yield from events.emit('chat.channelchange', transport, tag, before.name, after.name)
+            self.michiru_channel_mapping[tag].pop(before.name, None)
+            yield from events.emit('chat.channelchange', transport, tag, before.name, after.name, _server=tag, _channel=after.name)
+        self.michiru_channel_mapping[tag][after.name] = after
 
         if before.topic != after.topic:
-            yield from events.emit('chat.topicchange', transport, tag, after.name, None, after.topic)
+            yield from events.emit('chat.topicchange', transport, tag, after.name, None, after.topic, _server=tag, _channel=after.name)
 
 
 
@@ -217,6 +333,11 @@ class DiscordTransport(chat.Transport):
         'spoiler': '`',
         '/spoiler': '`'
     }
+    # Discord allows 5 messages per 5 seconds per channel, and multi-line messages.
+    FLOOD_RATE = 1.0
+    FLOOD_BURST = 5
+    MESSAGE_LIMIT = 2000
+    MESSAGE_SEPARATOR = '\n'
 
     def __init__(self, tag, info, loop):
         super().__init__(loop, tag, info)
@@ -239,6 +360,10 @@ class DiscordTransport(chat.Transport):
     def nickname(self):
         return self.discord_server.me.name
 
+    @property
+    def connected(self):
+        return not self.client.is_closed and self.client.michiru_server_mapping.get(self.server) is not None
+
     @property
     def discord_server(self):
         return self.client.michiru_server_mapping[self.server]
@@ -249,16 +374,17 @@ class DiscordTransport(chat.Transport):
 
     @property
     def discord_users(self):
-        return self.client.michiru_user_mapping
+        return self.client.michiru_member_mapping[self.server]
+
+    def discord_user(self, name):
+        return self.client.michiru_get_member(self.server, name)
 
     @asyncio.coroutine
-    def message(self, target, message):
+    def send(self, target, message):
         if target in self.discord_channels:
             target = self.discord_channels[target]
-        elif target in self.discord_users:
-            target = self.discord_users[target]
         else:
-            target = self.discord_server.get_member_named(target)
+            target = self.discord_user(target)
 
         if target is not None:
             yield from self.client.send_message(target, message)
@@ -268,12 +394,14 @@ class DiscordTransport(chat.Transport):
         yield from self.client.change_nickname(self.discord_server.me, new)
 
     @asyncio.coroutine
-    def quit(self):
+    def quit(self, reason=None):
+        self.outbound.clear()
         self.client.deregister_server(self.server)
 
     def highlight(self, nickname):
-        if nickname in self.discord_users:
-            return self.discord_users[nickname].mention
+        user = self.discord_user(nickname)
+        if user is not None:
+            return user.mention
         return nickname
 
 def new_pool(loop):
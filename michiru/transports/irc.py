@@ -4,6 +4,11 @@ import pydle
 
 from .. import version as michiru, config, chat, events, personalities
 
+# Services accounts of administrators, besides those named after an administrator's nickname.
+config.item('irc.admin_accounts', [])
+
+# Token used to recognize our own WHOX replies.
+WHOX_TOKEN = '462'
 
 class IRCPool:
     def __init__(self, loop):
@@ -33,6 +38,155 @@ class IRCClient(pydle.Client):
         self.michiru_transport = transport
         self.michiru_config = config
         self.michiru_message_pattern = None
+        self.michiru_whox = False
+        self.michiru_who_pending = []
+        self.michiru_who_task = None
+        self.michiru_caps = set()
+
+
+    ## IRCv3 capabilities.
+
+    def michiru_cap_enabled(self, name):
+        """ Mark capability as enabled and pass it on to pydle. """
+        self.michiru_caps.add(name)
+        handler = getattr(super(), 'on_capability_{}_enabled'.format(name.replace('-', '_')), None)
+        if handler:
+            return handler()
+
+    def michiru_accounts_reliable(self):
+        """ Check if we are told when users log in or out, so a missing account actually means something. """
+        return 'account-notify' in self.michiru_caps
+
+    def on_capability_account_notify_available(self, value):
+        return True
+
+    def on_capability_account_notify_enabled(self):
+        return self.michiru_cap_enabled('account-notify')
+
+    def on_capability_extended_join_available(self, value):
+        return True
+
+    def on_capability_extended_join_enabled(self):
+        return self.michiru_cap_enabled('extended-join')
+
+    def on_capability_account_tag_available(self, value):
+        return True
+
+    def on_capability_account_tag_enabled(self):
+        return self.michiru_cap_enabled('account-tag')
+
+    @asyncio.coroutine
+    def on_raw_account(self, message):
+        """ account-notify: :<nick>!<user>@<host> ACCOUNT <account|*> """
+        nick = message.source.split('!', 1)[0]
+        account = message.params[0]
+        if account == '*':
+            self.michiru_transport.presence.update(nick, account=None, identified=False)
+        else:
+            self.michiru_transport.presence.update(nick, account=account, identified=True)
+
+        handler = getattr(super(), 'on_raw_account', None)
+        if handler:
+            yield from handler(message)
+
+    @asyncio.coroutine
+    def on_raw_join(self, message):
+        """ extended-join: :<nick>!<user>@<host> JOIN <channel> <account|*> :<realname> """
+        if 'extended-join' in self.michiru_caps and len(message.params) >= 2:
+            nick = message.source.split('!', 1)[0]
+            channel, account = message.params[0], message.params[1]
+            if account == '*':
+                if self.michiru_accounts_reliable():
+                    self.michiru_transport.presence.join(channel, nick, account=None, identified=False)
+            else:
+                self.michiru_transport.presence.join(channel, nick, account=account, identified=True)
+
+        yield from super().on_raw_join(message)
+
+    def michiru_account_tag(self, message):
+        """ account-tag: take account information from message tags. """
+        if 'account-tag' not in self.michiru_caps:
+            return
+
+        nick = message.source.split('!', 1)[0]
+        tags = getattr(message, 'tags', None) or {}
+        if tags.get('account'):
+            self.michiru_transport.presence.update(nick, account=tags['account'], identified=True)
+        else:
+            self.michiru_transport.presence.update(nick, account=None, identified=False)
+
+    @asyncio.coroutine
+    def on_raw_privmsg(self, message):
+        self.michiru_account_tag(message)
+        yield from super().on_raw_privmsg(message)
+
+    @asyncio.coroutine
+    def on_raw_notice(self, message):
+        self.michiru_account_tag(message)
+        yield from super().on_raw_notice(message)
+
+
+    ## Presence tracking.
+
+    def michiru_refresh(self, channel):
+        """ Schedule a WHO refresh of everyone in channel. """
+        if channel not in self.michiru_who_pending:
+            self.michiru_who_pending.append(channel)
+        if self.michiru_who_task is None or self.michiru_who_task.done():
+            self.michiru_who_task = asyncio.ensure_future(self.michiru_flush_who(), loop=self.michiru_transport.loop)
+
+    @asyncio.coroutine
+    def michiru_flush_who(self):
+        """ Send pending WHO requests, one channel at a time, so we don't flood ourselves off. """
+        while self.michiru_who_pending:
+            channel = self.michiru_who_pending.pop(0)
+            if not self.in_channel(channel):
+                continue
+            if self.michiru_whox:
+                yield from self.rawmsg('WHO', channel, '%tcnfa,{}'.format(WHOX_TOKEN))
+            else:
+                yield from self.rawmsg('WHO', channel)
+            yield from asyncio.sleep(2)
+
+    @asyncio.coroutine
+    def on_isupport_whox(self, value):
+        handler = getattr(super(), 'on_isupport_whox', None)
+        if handler:
+            yield from handler(value)
+        self.michiru_whox = True
+
+    @asyncio.coroutine
+    def on_raw_352(self, message):
+        """ WHO reply: <me> <channel> <user> <host> <server> <nick> <flags> :<hops> <realname> """
+        handler = getattr(super(), 'on_raw_352', None)
+        if handler:
+            yield from handler(message)
+
+        channel, nick, flags = message.params[1], message.params[5], message.params[6]
+        presence = self.michiru_transport.presence
+        if self.in_channel(channel):
+            presence.join(channel, nick)
+        # Most servers mark users with a registered nickname with 'r'.
+        if 'r' in flags:
+            presence.update(nick, identified=True)
+
+    @asyncio.coroutine
+    def on_raw_354(self, message):
+        """ WHOX reply: <me> <token> <channel> <nick> <flags> <account> """
+        handler = getattr(super(), 'on_raw_354', None)
+        if handler:
+            yield from handler(message)
+
+        if len(message.params) < 6 or message.params[1] != WHOX_TOKEN:
+            return
+        channel, nick, flags, account = message.params[2:6]
+        presence = self.michiru_transport.presence
+        if self.in_channel(channel):
+            presence.join(channel, nick)
+        if account != '0':
+            presence.update(nick, account=account, identified=True)
+        elif self.michiru_accounts_reliable():
+            presence.update(nick, account=None, identified=False)
 
 
     ## Event handlers.
@@ -59,43 +213,61 @@ class IRCClient(pydle.Client):
 
         # Execute hook.
         personalities.set_current(self.michiru_transport.server, None)
-        yield from events.emit('chat.connect', self.michiru_transport, self.michiru_transport.server)
+        yield from events.emit('chat.connect', self.michiru_transport, self.michiru_transport.server, _server=self.michiru_transport.server)
+
+    @asyncio.coroutine
+    def on_disconnect(self, expected):
+        yield from super().on_disconnect(expected)
+        self.michiru_transport.presence.clear()
 
     @asyncio.coroutine
     def on_join(self, channel, user):
         yield from super().on_join(channel, user)
+        if self.is_same_nick(self.nickname, user):
+            self.michiru_transport.presence.clear(channel)
+            self.michiru_refresh(channel)
+        self.michiru_transport.presence.join(channel, user)
         if self.michiru_transport.ignored(user, channel):
             return
         # Execute hook.
         personalities.set_current(self.michiru_transport.server, channel)
-        yield from events.emit('chat.join', self.michiru_transport, self.michiru_transport.server, channel, user)
+        yield from events.emit('chat.join', self.michiru_transport, self.michiru_transport.server, channel, user, _server=self.michiru_transport.server, _channel=channel)
 
     @asyncio.coroutine
     def on_part(self, channel, user, reason=None):
         yield from super().on_part(channel, user, reason)
+        if self.is_same_nick(self.nickname, user):
+            self.michiru_transport.presence.clear(channel)
+        else:
+            self.michiru_transport.presence.part(channel, user)
         if self.michiru_transport.ignored(user, channel):
             return
         # Execute hook.
         personalities.set_current(self.michiru_transport.server, channel)
-        yield from events.emit('chat.part', self.michiru_transport, self.michiru_transport.server, channel, user, reason)
+        yield from events.emit('chat.part', self.michiru_transport, self.michiru_transport.server, channel, user, reason, _server=self.michiru_transport.server, _channel=channel)
 
     @asyncio.coroutine
     def on_quit(self, user, reason=None):
         yield from super().on_quit(user, reason)
+        self.michiru_transport.presence.quit(user)
         if self.michiru_transport.ignored(user):
             return
         # Execute hook.
         personalities.set_current(self.michiru_transport.server, None)
-        yield from events.emit('chat.disconnect', self.michiru_transport, self.michiru_transport.server, user, reason)
+        yield from events.emit('chat.disconnect', self.michiru_transport, self.michiru_transport.server, user, reason, _server=self.michiru_transport.server)
 
     @asyncio.coroutine
     def on_kick(self, channel, target, by, reason):
         yield from super().on_kick(channel, target, by, reason)
+        if self.is_same_nick(self.nickname, target):
+            self.michiru_transport.presence.clear(channel)
+        else:
+            self.michiru_transport.presence.kick(channel, target)
         if self.michiru_transport.ignored(target, channel) or self.michiru_transport.ignored(by, channel):
             return
         # Execute hook.
         personalities.set_current(self.michiru_transport.server, channel)
-        yield from events.emit('chat.kick', self.michiru_transport, self.michiru_transport.server, channel, target, by, reason)
+        yield from events.emit('chat.kick', self.michiru_transport, self.michiru_transport.server, channel, target, by, reason, _server=self.michiru_transport.server, _channel=channel)
 
     @asyncio.coroutine
     def on_invite(self, channel, by):
@@ -104,11 +276,12 @@ class IRCClient(pydle.Client):
             return
         # Execute hook.
         personalities.set_current(self.michiru_transport.server, None)
-        yield from events.emit('chat.invite', self.michiru_transport, self.michiru_transport.server, channel, by)
+        yield from events.emit('chat.invite', self.michiru_transport, self.michiru_transport.server, channel, by, _server=self.michiru_transport.server)
 
     @asyncio.coroutine
     def on_nick_change(self, old, new):
         yield from super().on_nick_change(old, new)
+        self.michiru_transport.presence.rename(old, new, keep_account=self.michiru_accounts_reliable())
         if self.michiru_transport.ignored(old):
             self.michiru_transport.unignore(old)
             self.michiru_transport.ignore(new)
@@ -121,7 +294,7 @@ class IRCClient(pydle.Client):
 
         # Execute hook.
         personalities.set_current(self.michiru_transport.server, None)
-        yield from events.emit('chat.nickchange', self.michiru_transport, self.michiru_transport.server, old, new)
+        yield from events.emit('chat.nickchange', self.michiru_transport, self.michiru_transport.server, old, new, _server=self.michiru_transport.server)
 
     @asyncio.coroutine
     def on_notice(self, target, by, message):
@@ -132,7 +305,7 @@ class IRCClient(pydle.Client):
         admin = yield from self.michiru_transport.is_admin(by)
         # Execute hook.
         personalities.set_current(self.michiru_transport.server, None if private else target)
-        yield from events.emit('chat.notice', self.michiru_transport, self.michiru_transport.server, target, by, message, private, admin)
+        yield from events.emit('chat.notice', self.michiru_transport, self.michiru_transport.server, target, by, message, private, admin, _server=self.michiru_transport.server, _channel=None if private else target)
 
     @asyncio.coroutine
     def on_topic_change(self, channel, topic, setter):
@@ -141,7 +314,7 @@ class IRCClient(pydle.Client):
             return
         # Execute hook.
         personalities.set_current(self.michiru_transport.server, channel)
-        yield from events.emit('chat.topicchange', self.michiru_transport, self.michiru_transport.server, channel, setter, topic)
+        yield from events.emit('chat.topicchange', self.michiru_transport, self.michiru_transport.server, channel, setter, topic, _server=self.michiru_transport.server, _channel=channel)
 
     @pydle.coroutine
     def on_message(self, target, by, message):
@@ -170,7 +343,7 @@ class IRCClient(pydle.Client):
             yield from self.michiru_transport.run_commands(target, by, message, parsed_message, bool(highlight), private)
 
         # And execute hooks.
-        yield from events.emit('chat.message', self.michiru_transport, server, target, by, message, private, admin)
+        yield from events.emit('chat.message', self.michiru_transport, server, target, by, message, private, admin, _server=server, _channel=None if private else target)
 
     @pydle.coroutine
     def on_ctcp_version(self, by, target, contents):
@@ -196,7 +369,7 @@ class IRCClient(pydle.Client):
         if self.michiru_transport.ignored(by, target):
             return
         personalities.set_current(self.michiru_transport.server, None)
-        yield from events.emit('irc.ctcp', self.michiru_transport, self.michiru_transport.server, target, by, contents)
+        yield from events.emit('irc.ctcp', self.michiru_transport, self.michiru_transport.server, target, by, contents, _server=self.michiru_transport.server)
 
 class IRCTransport(chat.Transport):
     FORMAT_CODES = {
@@ -232,6 +405,12 @@ class IRCTransport(chat.Transport):
         'spoiler': chr(0x2) + chr(0x3) + '01,01',
         '/spoiler': chr(0x3) + chr(0x2)
     }
+    # Most servers start penalizing at more than one line every two seconds after a small burst.
+    FLOOD_RATE = 0.5
+    FLOOD_BURST = 4
+    # 512 bytes minus prefix, command and target.
+    MESSAGE_LIMIT = 400
+    ENCODING = 'UTF-8'
 
     def __init__(self, tag, info, loop, *args, **kwargs):
         super().__init__(loop, tag, info)
@@ -239,21 +418,44 @@ class IRCTransport(chat.Transport):
         self.connect_args = ()
         self.connect_kwargs = {}
 
+    def admin_account(self, account, chan=None):
+        """ Check if services account `account` belongs to an admin or channel admin. """
+        accounts = config.get('irc.admin_accounts', server=self.server, channel=chan) + self.admins(chan)
+        return self.normalize(account) in {self.normalize(a) for a in accounts}
+
     @asyncio.coroutine
     def is_admin(self, nick, chan=None):
         """ Check if given nickname is admin or channel admin. """
-        # Basic check.
-        if nick not in self.admins(chan):
+        # Being identified is not enough: anyone logged in to some account could take an absent admin's nickname.
+        # The account is what counts, so admins can use grouped or alternate nicknames too.
+        # Check what we already know before asking the server.
+        # With IRCv3 account tracking this should cover nearly everyone we share a channel with.
+        account = self.presence.account(nick)
+        if account:
+            return self.admin_account(account, chan)
+        if self.presence.identified(nick) is False:
             return False
+        user = self.client.users.get(nick, {})
+        if user.get('identified') and user.get('account'):
+            return self.admin_account(user['account'], chan)
 
-        if self.client.users.get(nick, {}).get('identified'):
-            return True
+        info = yield from self.whois(nick)
+        if not info or not info.get('identified'):
+            return False
+        self.presence.update(nick, identified=True, account=info.get('account'))
+        if info.get('account'):
+            return self.admin_account(info['account'], chan)
+
+        # Some networks only tell us someone is identified for the nickname they're using now.
+        return nick in self.admins(chan)
 
+    @asyncio.coroutine
+    def whois(self, nick):
         info = yield from self.client.whois(nick)
-        if info and info['identified']:
-            return True
+        return info
 
-        return False
+    def normalize(self, name):
+        return self.client.normalize(name)
 
     @asyncio.coroutine
     def run(self):
@@ -263,8 +465,12 @@ class IRCTransport(chat.Transport):
     def nickname(self):
         return self.client.nickname
 
+    @property
+    def connected(self):
+        return self.client.connected
+
     @asyncio.coroutine
-    def message(self, target, message):
+    def send(self, target, message):
         yield from self.client.message(target, message)
 
     @asyncio.coroutine
@@ -272,8 +478,18 @@ class IRCTransport(chat.Transport):
         yield from self.client.nick(new)
 
     @asyncio.coroutine
-    def quit(self):
-        self.client.disconnect()
+    def join(self, channel, password=None):
+        yield from self.client.join(channel, password)
+
+    @asyncio.coroutine
+    def part(self, channel, reason=None):
+        yield from self.client.part(channel, reason)
+
+    @asyncio.coroutine
+    def quit(self, reason=None):
+        self.outbound.clear()
+        self.presence.clear()
+        yield from self.client.quit(reason)
 
 
 def new_pool(loop):
@@ -0,0 +1,177 @@
+# Worker processes for CPU-heavy work that shouldn't block the event loop.
+import os
+import sys
+import importlib
+import asyncio
+import multiprocessing
+import concurrent.futures
+
+from . import config
+
+config.item('workers.processes', 2)
+
+pool = None
+# Dedicated thread pools: name -> executor.
+thread_pools = {}
+# Killable process pools for untrusted work: name -> sandbox.
+sandboxes = {}
+
+
+## Function references.
+
+def reference(func):
+    """ Get a picklable reference to module-level function `func`. """
+    return func.__module__, func.__qualname__
+
+def resolve(module, name):
+    """ Get function from reference. Michiru modules name themselves relative to michiru.modules. """
+    for fullname in ('michiru.modules.' + module, module):
+        if fullname in sys.modules:
+            mod = sys.modules[fullname]
+            break
+    else:
+        try:
+            mod = importlib.import_module('michiru.modules.' + module)
+        except ImportError:
+            mod = importlib.import_module(module)
+
+    obj = mod
+    for part in name.split('.'):
+        obj = getattr(obj, part)
+    return obj
+
+def invoke(ref, args):
+    """ Call referenced function. Runs in the worker process. """
+    return resolve(*ref)(*args)
+
+
+## Pool management.
+
+def processes():
+    """ Get the process pool, starting and warming it up if needed. """
+    global pool
+
+    if pool is None:
+        size = config.get('workers.processes')
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=size)
+        # Make sure the workers are started now, instead of on the first request.
+        for _ in range(size):
+            pool.submit(os.getpid)
+
+    return pool
+
+def threads(name, size):
+    """ Get dedicated thread pool `name` for blocking work, so it can't starve the default executor. """
+    if name not in thread_pools:
+        thread_pools[name] = concurrent.futures.ThreadPoolExecutor(max_workers=size)
+    return thread_pools[name]
+
+def sandbox(name, size):
+    """ Get sandbox pool `name`. """
+    if name not in sandboxes:
+        sandboxes[name] = Sandbox(size)
+    return sandboxes[name]
+
+def stop_processes():
+    """ Stop the process pool. It gets started again when needed. """
+    global pool
+
+    if pool is not None:
+        pool.shutdown(wait=False)
+        pool = None
+
+def stop_threads(name):
+    """ Stop thread pool `name`. """
+    executor = thread_pools.pop(name, None)
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+def stop_sandbox(name):
+    """ Kill sandbox pool `name`. """
+    box = sandboxes.pop(name, None)
+    if box is not None:
+        box.kill()
+
+def shutdown():
+    """ Stop the process pool, thread pools and sandboxes. """
+    stop_processes()
+    for name in list(thread_pools):
+        stop_threads(name)
+    for name in list(sandboxes):
+        stop_sandbox(name)
+
+@asyncio.coroutine
+def offload(loop, func, *args):
+    """
+    Run module-level function `func` in a worker process and return its result.
+    Arguments and return value have to be picklable, so keep them to plain data.
+    """
+    res = yield from loop.run_in_executor(processes(), invoke, reference(func), args)
+    return res
+
+
+## Sandboxes.
+
+class Sandbox:
+    """
+    Process pool for untrusted work, like user-supplied regular expressions.
+    Unlike the regular pool, its workers get killed and replaced when a job takes too long.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.pool = None
+        self.pending = set()
+
+    def start(self):
+        """ Start worker processes if needed. """
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.size)
+        return self.pool
+
+    def fail_pending(self):
+        """ Fail every job still running. """
+        for future in list(self.pending):
+            if not future.done():
+                future.set_exception(asyncio.TimeoutError())
+        self.pending.clear()
+
+    def kill(self):
+        """ Kill worker processes, failing every job still running on them. Blocks. """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        self.fail_pending()
+
+    @asyncio.coroutine
+    def restart(self, loop):
+        """ Kill worker processes without blocking the loop, failing every job still running on them, and start new ones. """
+        pool = self.pool
+        self.pool = None
+        self.fail_pending()
+        if pool is not None:
+            # Terminating joins the workers, which can take a while.
+            yield from loop.run_in_executor(None, pool.terminate)
+        self.start()
+
+    @asyncio.coroutine
+    def run(self, loop, timeout, func, *args):
+        """ Run module-level function `func` in a worker and return its result, killing the workers after `timeout` seconds. """
+        future = asyncio.Future(loop=loop)
+
+        def settle(method, value):
+            if not future.done():
+                method(value)
+
+        self.pending.add(future)
+        self.start().apply_async(invoke, (reference(func), args),
+            callback=lambda res: loop.call_soon_threadsafe(settle, future.set_result, res),
+            error_callback=lambda exc: loop.call_soon_threadsafe(settle, future.set_exception, exc))
+
+        try:
+            res = yield from asyncio.wait_for(future, timeout, loop=loop)
+        except asyncio.TimeoutError:
+            yield from self.restart(loop)
+            raise
+        finally:
+            self.pending.discard(future)
+        return res
@@ -0,0 +1,18 @@
+# Tests.
+import os
+import tempfile
+
+from michiru import config
+
+def configure():
+    """ Load an empty configuration and a fresh database from a temporary directory. """
+    if config.current is not None:
+        return
+
+    dir = tempfile.mkdtemp(prefix='michiru-tests-')
+    with open(os.path.join(dir, config.CONFIG_FILE), 'w') as f:
+        f.write('{}')
+    config.load(dir)
+
+    from michiru import db
+    db.connect()
@@ -0,0 +1,59 @@
+# Database schema tests.
+import unittest
+
+from tests import configure
+configure()
+
+from michiru import db
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.steps = []
+        self.name = 'migrate_test_{}'.format(id(self))
+
+    def step(self, table):
+        self.steps.append(table)
+
+    def test_new_table_skips_migrations(self):
+        db.table(self.name, {'id': db.ID}, migrations=[self.step])
+        self.assertEqual(self.steps, [])
+        self.assertEqual(db.version(self.name), 1)
+
+    def test_migrated_elsewhere(self):
+        db.table(self.name, {'id': db.ID})
+        # Another shard got there first.
+        db.set_version(self.name, 1)
+        db.table(self.name, {'id': db.ID}, migrations=[self.step])
+        self.assertEqual(self.steps, [])
+
+    def test_pending(self):
+        db.table(self.name, {'id': db.ID})
+        db.table(self.name, {'id': db.ID, 'value': db.INT}, migrations=[db.add_column('value', db.INT), self.step])
+        self.assertEqual(self.steps, [self.name])
+        self.assertEqual(db.version(self.name), 2)
+        self.assertEqual(db.schema_depth, 0)
+
+    def test_add_column_twice(self):
+        db.table(self.name, {'id': db.ID})
+        step = db.add_column('value', db.INT)
+        step(self.name)
+        step(self.name)
+        self.assertIn('value', [row['name'] for row in db.query(self.name, 'PRAGMA table_info(`{}`)'.format(self.name))])
+
+
+class QueryManyTest(unittest.TestCase):
+    def setUp(self):
+        self.name = 'query_many_test_{}'.format(id(self))
+        db.table(self.name, {'id': db.ID, 'value': (db.INT, db.UNIQUE)})
+
+    def test_all_or_nothing(self):
+        with self.assertRaises(db.sqlite3.IntegrityError):
+            db.query_many(self.name, 'INSERT INTO `{}` (`value`) VALUES (?)'.format(self.name), [(1,), (2,), (1,)])
+        # Another commit must not pick up the rows that did get inserted.
+        db.query(self.name, 'INSERT INTO `{}` (`value`) VALUES (?)'.format(self.name), 3)
+        self.assertEqual([row['value'] for row in db.query(self.name, 'SELECT `value` FROM `{}`'.format(self.name))], [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
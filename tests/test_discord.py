@@ -0,0 +1,97 @@
+# Discord transport tests.
+import unittest
+import asyncio
+import collections
+
+from tests import configure
+configure()
+
+try:
+    from michiru.transports import discord
+except ImportError:
+    discord = None
+from michiru.presence import Presence
+
+
+class Member:
+    def __init__(self, id, name, nick=None):
+        self.id = id
+        self.name = name
+        self.nick = nick
+        self.server = 'server'
+
+    def __str__(self):
+        return '{}#0001'.format(self.name)
+
+
+class Server:
+    def __init__(self, members):
+        self.members = members
+        self.lookups = 0
+
+    def get_member_named(self, name):
+        self.lookups += 1
+        for member in self.members:
+            if name in (member.name, member.nick, str(member)):
+                return member
+        return None
+
+
+class Transport:
+    def __init__(self):
+        self.presence = Presence(str.lower)
+
+
+@unittest.skipIf(discord is None, 'discord.py not installed')
+class MemberTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server([Member(1, 'alice'), Member(2, 'bob')])
+        # Skip connecting, and logging out when done.
+        client = type('Client', (discord.DiscordClient,), {'__del__': lambda self: None})
+        self.client = client.__new__(client)
+        self.client.michiru_server_mapping = {'test': self.server}
+        self.client.michiru_server_tags = {}
+        self.client.michiru_member_mapping = {'test': {}}
+        self.client.michiru_member_misses = {'test': collections.OrderedDict()}
+        self.client.michiru_transports = {'test': Transport()}
+        self.client.michiru_get_tag = lambda server: 'test'
+
+    def update(self, before, after):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.client.on_member_update(before, after))
+        finally:
+            loop.close()
+
+    def test_miss_cached(self):
+        self.assertIsNone(self.client.michiru_get_member('test', 'carol'))
+        self.assertIsNone(self.client.michiru_get_member('test', 'carol'))
+        self.assertEqual(self.server.lookups, 1)
+
+    def test_status_update(self):
+        self.assertIsNone(self.client.michiru_get_member('test', 'carol'))
+        bob = self.server.members[1]
+        self.update(Member(2, 'bob'), bob)
+        # Not indexed because of an update, and misses are kept.
+        self.assertNotIn('bob', self.client.michiru_member_mapping['test'])
+        self.assertIn('carol', self.client.michiru_member_misses['test'])
+
+    def test_rename(self):
+        self.assertIsNone(self.client.michiru_get_member('test', 'carol'))
+        self.assertIsNone(self.client.michiru_get_member('test', 'dave'))
+        alice = self.client.michiru_get_member('test', 'alice')
+        alice.nick = 'carol'
+        self.update(Member(1, 'alice'), alice)
+        self.assertNotIn('carol', self.client.michiru_member_misses['test'])
+        self.assertIn('dave', self.client.michiru_member_misses['test'])
+        self.assertIs(self.client.michiru_get_member('test', 'carol'), alice)
+
+        bob = self.client.michiru_get_member('test', 'bob')
+        bob.name = 'robert'
+        self.update(Member(2, 'bob'), bob)
+        self.assertNotIn('bob', self.client.michiru_member_mapping['test'])
+        self.assertIs(self.client.michiru_member_mapping['test']['robert'], bob)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# Factoid lookup tests.
+import time
+import random
+import string
+import unittest
+import asyncio
+import importlib
+
+from tests import configure
+configure()
+
+from michiru import db
+
+# Modules rename themselves, so import them the way the module loader does.
+importlib.import_module('michiru.modules.knowitall')
+factoids = importlib.import_module('michiru.modules.knowitall.factoids')
+
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = factoids.Index(['category', 'Python', 'cats and dogs'])
+
+    def test_folded(self):
+        self.assertEqual(self.index.folded('PYTHON'), 'Python')
+        self.assertIsNone(self.index.folded('cat'))
+
+    def test_fuzzy_typo(self):
+        self.assertEqual(self.index.fuzzy('pyhton', 0.75, 20), 'Python')
+
+    def test_prefix_only_does_not_match(self):
+        self.assertIsNone(self.index.fuzzy('cat', 0.75, 20))
+
+    def test_remove(self):
+        self.index.remove('Python')
+        self.assertIsNone(self.index.folded('python'))
+        self.assertIsNone(self.index.fuzzy('pyhton', 0.75, 20))
+
+
+class SourceTest(unittest.TestCase):
+    def setUp(self):
+        self.server = 'test-{}'.format(id(self))
+        factoids.FACTOIDS[self.server] = {'category': 'A kind of thing.'}
+        factoids.INDICES[self.server] = factoids.Index(factoids.FACTOIDS[self.server])
+
+    def tearDown(self):
+        factoids.FACTOIDS.pop(self.server, None)
+        factoids.INDICES.pop(self.server, None)
+
+    def define(self, source, query):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(source(query, None, 'someone', self.server, '#chan'))
+        finally:
+            loop.close()
+
+    def test_prefix_only_does_not_answer(self):
+        self.assertIsNone(self.define(factoids.define_factoid, 'cat'))
+        self.assertIsNone(self.define(factoids.define_fuzzy_factoid, 'cat'))
+
+    def test_similar_answers(self):
+        self.assertEqual(self.define(factoids.define_fuzzy_factoid, 'catgeory'), 'A kind of thing.')
+
+
+class BenchmarkTest(unittest.TestCase):
+    """ Lookup latency with a seeded table of 100k factoids. """
+    FACTOIDS = 100000
+    LOOKUPS = 200
+    # Generous, so slow machines do not fail; lookups normally take a few milliseconds at most.
+    MAX_LOOKUP = 0.02
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = 'benchmark'
+        rng = random.Random(1337)
+        names = set()
+        while len(names) < cls.FACTOIDS:
+            names.add(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 12))))
+        cls.names = sorted(names)
+        db.query_many('factoids', 'INSERT INTO `factoids` (`server`, `factoid`, `definition`) VALUES (?, ?, ?)',
+            ((cls.server, name, 'Definition of {}.'.format(name)) for name in cls.names))
+
+        start = time.perf_counter()
+        factoids.factoids(cls.server)
+        print('factoids: loaded and indexed {} factoids in {:.2f}s'.format(cls.FACTOIDS, time.perf_counter() - start))
+
+        cls.queries = rng.sample(cls.names, cls.LOOKUPS)
+        # Swap two letters, like people do.
+        cls.typos = []
+        for name in cls.queries:
+            i = rng.randrange(len(name) - 1)
+            cls.typos.append(name[:i] + name[i + 1] + name[i] + name[i + 2:])
+
+    @classmethod
+    def tearDownClass(cls):
+        db.query('factoids', 'DELETE FROM `factoids` WHERE `server` = ?', cls.server)
+        factoids.FACTOIDS.pop(cls.server, None)
+        factoids.INDICES.pop(cls.server, None)
+
+    def measure(self, kind, source, queries):
+        loop = asyncio.new_event_loop()
+        try:
+            results = []
+            start = time.perf_counter()
+            for query in queries:
+                results.append(loop.run_until_complete(source(query, None, 'someone', self.server, '#chan')))
+            latency = (time.perf_counter() - start) / len(queries)
+        finally:
+            loop.close()
+
+        print('factoids: {} lookup in {:.3f}ms'.format(kind, latency * 1000))
+        self.assertLess(latency, self.MAX_LOOKUP)
+        return results
+
+    def test_exact(self):
+        results = self.measure('exact', factoids.define_factoid, self.queries)
+        self.assertTrue(all(results))
+
+    def test_folded(self):
+        results = self.measure('case-folded', factoids.define_factoid, [query.upper() for query in self.queries])
+        self.assertTrue(all(results))
+
+    def test_fuzzy(self):
+        results = self.measure('fuzzy', factoids.define_fuzzy_factoid, self.typos)
+        # Short factoids with a typo can fall below the threshold, but most should be found.
+        self.assertGreater(sum(1 for result in results if result), len(results) // 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
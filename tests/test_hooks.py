@@ -0,0 +1,202 @@
+# Web hook HTTP server tests.
+import unittest
+import asyncio
+import importlib
+
+from tests import configure
+configure()
+
+from michiru import chat, config, db, outbound
+
+# Modules rename themselves, so import them the way the module loader does.
+hooks = importlib.import_module('michiru.modules.hooks')
+owncloud = importlib.import_module('michiru.modules.hooks.owncloud')
+
+
+class Writer:
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+
+class ReadRequestTest(unittest.TestCase):
+    def read(self, data):
+        loop = asyncio.new_event_loop()
+        try:
+            reader = asyncio.StreamReader(loop=loop)
+            reader.feed_data(data)
+            reader.feed_eof()
+            writer = Writer()
+            try:
+                return loop.run_until_complete(hooks.read_request(reader, writer, '127.0.0.1')), writer.data
+            except hooks.HTTPError as e:
+                return e.status, writer.data
+        finally:
+            loop.close()
+
+    def test_oversized_body_refused_before_continue(self):
+        status, sent = self.read(
+            'POST /owncloud HTTP/1.1\r\nExpect: 100-continue\r\nContent-Length: {}\r\n\r\n'.format(hooks.config.get('hooks.max_body_size') + 1).encode('latin-1')
+        )
+        self.assertEqual(status, 413)
+        self.assertNotIn(b'100 Continue', sent)
+
+    def test_continue(self):
+        request, sent = self.read(b'POST /owncloud HTTP/1.1\r\nExpect: 100-continue\r\nContent-Length: 2\r\n\r\n{}')
+        self.assertEqual(request.data, b'{}')
+        self.assertIn(b'100 Continue', sent)
+
+    def test_trailers_bounded(self):
+        trailers = b''.join('X-Trailer-{}: 1\r\n'.format(i).encode('latin-1') for i in range(hooks.config.get('hooks.max_headers') + 1))
+        status, _ = self.read(b'POST /owncloud HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n2\r\n{}\r\n0\r\n' + trailers + b'\r\n')
+        self.assertEqual(status, 431)
+
+
+class HeadersTest(unittest.TestCase):
+    def test_missing_header(self):
+        request = hooks.Request('POST', '/owncloud', 'HTTP/1.1', hooks.Headers(), b'{}', '127.0.0.1')
+        with self.assertRaises(hooks.HTTPError) as cm:
+            owncloud.handler({}, request)
+        self.assertEqual(cm.exception.status, 400)
+
+
+class Bot:
+    FORMAT_CODES = {'b': '', '/b': '', 'u': '', '/u': ''}
+    connected = True
+    message = chat.Transport.message
+
+    def __init__(self, loop):
+        self.lines = []
+        self.outbound = outbound.OutboundQueue(loop, self.send, 0, 1, 400)
+
+    @asyncio.coroutine
+    def send(self, target, line):
+        self.lines.append((target, line))
+
+
+class DeliverTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.bot = Bot(self.loop)
+        chat.bots['test'] = self.bot
+        config.current['servers'] = {'test': {}}
+        db.query('hooks_queue', 'DELETE FROM `hooks_queue`')
+
+    def tearDown(self):
+        chat.bots.pop('test', None)
+        config.current.pop('servers', None)
+        hooks.PENDING.clear()
+        self.loop.close()
+
+    def queue(self, channel, message):
+        db.query('hooks_queue', 'INSERT INTO `hooks_queue` (`service`, `ident`, `server`, `channel`, `kind`, `message`, `time`) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            'gitlab', 'repo', 'test', channel, None, message, int(hooks.time.time()))
+
+    def remaining(self):
+        return [row['message'] for row in db.query('hooks_queue', 'SELECT `message` FROM `hooks_queue`')]
+
+    def test_bad_group_does_not_block(self):
+        self.queue('#a', 'broken {message')
+        self.queue('#b', 'fine')
+        self.loop.run_until_complete(hooks.deliver())
+        self.loop.run_until_complete(self.bot.outbound.task)
+        self.assertEqual(self.bot.lines, [('#b', 'fine')])
+        self.assertEqual(self.remaining(), [])
+
+    def test_removed_once_sent(self):
+        self.queue('#a', 'hello')
+        self.loop.run_until_complete(hooks.deliver())
+        self.assertEqual(self.remaining(), ['hello'])
+        # Not sent yet, so not queued again either.
+        self.loop.run_until_complete(hooks.deliver())
+        self.loop.run_until_complete(self.bot.outbound.task)
+        self.assertEqual(self.bot.lines, [('#a', 'hello')])
+        self.assertEqual(self.remaining(), [])
+
+    def test_kept_while_offline(self):
+        chat.bots.pop('test')
+        self.queue('#a', 'hello')
+        self.loop.run_until_complete(hooks.deliver())
+        self.assertEqual(self.remaining(), ['hello'])
+
+    def test_escape(self):
+        self.assertEqual(hooks.escape('{b}').format(), '{b}')
+
+
+class LoadTest(unittest.TestCase):
+    """ Push a few thousand deliveries through the server over pipelined keep-alive connections. """
+    CONNECTIONS = 4
+    REQUESTS = 750
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        config.set('hooks.services.loadtest', {'targets': {'load': {'test': ['#chan']}}})
+        hooks.register('loadtest', 'loadtest', self.handler)
+        db.query('hooks_queue', 'DELETE FROM `hooks_queue`')
+
+    def tearDown(self):
+        hooks.unregister('loadtest', 'loadtest', self.handler)
+        db.query('hooks_queue', 'DELETE FROM `hooks_queue`')
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def handler(self, cfg, request):
+        return 'load', [request.get_json()['message']]
+
+    @asyncio.coroutine
+    def serve(self, reader, writer):
+        try:
+            yield from hooks.serve(reader, writer)
+        finally:
+            self.served += 1
+
+    @asyncio.coroutine
+    def client(self, port, number):
+        reader, writer = yield from asyncio.open_connection('127.0.0.1', port)
+        for i in range(self.REQUESTS):
+            body = hooks.json.dumps({'message': '{}-{}'.format(number, i)}).encode('utf-8')
+            writer.write(b'POST /loadtest HTTP/1.1\r\nContent-Type: application/json\r\nContent-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body)
+
+        statuses = []
+        while len(statuses) < self.REQUESTS:
+            line = yield from reader.readline()
+            if not line:
+                break
+            if line.startswith(b'HTTP/1.1 '):
+                statuses.append(int(line.split()[1]))
+        writer.close()
+        return statuses
+
+    @asyncio.coroutine
+    def run_load(self):
+        self.served = 0
+        server = yield from asyncio.start_server(self.serve, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            results = yield from asyncio.gather(*[self.client(port, n) for n in range(self.CONNECTIONS)])
+            # Let the server notice the clients are done.
+            while self.served < self.CONNECTIONS:
+                yield from asyncio.sleep(0.01)
+        finally:
+            server.close()
+        return results
+
+    def test_load(self):
+        results = self.loop.run_until_complete(self.run_load())
+        for statuses in results:
+            self.assertEqual(statuses, [204] * self.REQUESTS)
+
+        messages = [row['message'] for row in db.query('hooks_queue', 'SELECT `message` FROM `hooks_queue` ORDER BY `id`')]
+        self.assertEqual(len(messages), self.CONNECTIONS * self.REQUESTS)
+        self.assertEqual(set(messages), {'{}-{}'.format(n, i) for n in range(self.CONNECTIONS) for i in range(self.REQUESTS)})
+        # Pipelined requests are handled in order.
+        for n in range(self.CONNECTIONS):
+            own = [m for m in messages if m.startswith('{}-'.format(n))]
+            self.assertEqual(own, ['{}-{}'.format(n, i) for i in range(self.REQUESTS)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# IRC transport tests.
+import unittest
+import asyncio
+
+from tests import configure
+configure()
+
+from michiru import config
+
+try:
+    from michiru.transports import irc
+except ImportError:
+    irc = None
+from michiru.presence import Presence
+
+
+class Client:
+    """ Just enough of a pydle client for admin checks. """
+    def __init__(self, whois=None):
+        self.users = {}
+        self.whois_info = whois
+
+    def normalize(self, name):
+        return name.lower()
+
+    @asyncio.coroutine
+    def whois(self, nick):
+        return self.whois_info
+
+
+@unittest.skipIf(irc is None, 'pydle not installed')
+class AdminTest(unittest.TestCase):
+    def transport(self, whois=None):
+        transport = irc.IRCTransport.__new__(irc.IRCTransport)
+        transport.server = 'test'
+        transport.client = Client(whois)
+        transport.presence = Presence(transport.normalize)
+        transport.admins = lambda chan=None: ['Admin']
+        return transport
+
+    def is_admin(self, transport, nick):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(transport.is_admin(nick))
+        finally:
+            loop.close()
+
+    def test_identified_admin(self):
+        transport = self.transport()
+        transport.presence.join('#chan', 'Admin', account='admin', identified=True)
+        self.assertTrue(self.is_admin(transport, 'Admin'))
+
+    def test_renamed_non_admin(self):
+        transport = self.transport(whois={'identified': True, 'account': 'mallory'})
+        transport.presence.join('#chan', 'Mallory', account='mallory', identified=True)
+        transport.presence.rename('Mallory', 'Admin', keep_account=True)
+        self.assertFalse(self.is_admin(transport, 'Admin'))
+
+        transport.presence.rename('Admin', 'Mallory', keep_account=True)
+        transport.presence.rename('Mallory', 'Admin')
+        self.assertFalse(self.is_admin(transport, 'Admin'))
+
+    def test_grouped_nick(self):
+        transport = self.transport()
+        transport.presence.join('#chan', 'Admin|away', account='admin', identified=True)
+        self.assertTrue(self.is_admin(transport, 'Admin|away'))
+
+    def test_configured_account(self):
+        transport = self.transport()
+        transport.presence.join('#chan', 'Someone', account='ops', identified=True)
+        self.assertFalse(self.is_admin(transport, 'Someone'))
+        config.set('irc.admin_accounts', ['ops'])
+        try:
+            self.assertTrue(self.is_admin(transport, 'Someone'))
+        finally:
+            config.set('irc.admin_accounts', [])
+
+    def test_identified_without_account(self):
+        # Networks that only tell us someone is identified for their current nickname.
+        transport = self.transport(whois={'identified': True, 'account': None})
+        self.assertTrue(self.is_admin(transport, 'Admin'))
+        self.assertFalse(self.is_admin(transport, 'Mallory'))
+
+    def test_stale_identification(self):
+        transport = self.transport(whois={'identified': False, 'account': None})
+        transport.client.users['Admin'] = {'identified': True, 'account': None}
+        self.assertFalse(self.is_admin(transport, 'Admin'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# Loudbot tests.
+import time
+import random
+import unittest
+import importlib
+
+from tests import configure
+configure()
+
+from michiru import db
+
+# Modules rename themselves, so import them the way the module loader does.
+loudbot = importlib.import_module('michiru.modules.loudbot')
+
+
+class BenchmarkTest(unittest.TestCase):
+    """ Random shout latency with a seeded table of 1M shouts. """
+    SHOUTS = 1000000
+    CHANNELS = 10
+    LOOKUPS = 1000
+    # Generous, so slow machines do not fail; lookups normally take well under a millisecond.
+    MAX_LOOKUP = 0.01
+    MAX_LOAD = 10
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = 'benchmark'
+        cls.channels = ['#chan{}'.format(n) for n in range(cls.CHANNELS)]
+        now = loudbot.datetime.now()
+
+        def shouts():
+            for i in range(cls.SHOUTS):
+                shout = 'SHOUT NUMBER {}'.format(i).encode('utf-8')
+                yield (cls.server, cls.channels[i % cls.CHANNELS], loudbot.shout_hash(shout), 'someone', shout, now, 'someone', now)
+
+        start = time.perf_counter()
+        db.query_many('shouts', '''
+            INSERT INTO `shouts` (`server`, `channel`, `hash`, `shouter`, `shout`, `time`, `last_shouter`, `last_time`)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', shouts())
+        print('loudbot: seeded {} shouts in {:.2f}s'.format(cls.SHOUTS, time.perf_counter() - start))
+
+    @classmethod
+    def tearDownClass(cls):
+        db.query('shouts', 'DELETE FROM `shouts` WHERE `server` = ?', cls.server)
+        loudbot.shout_ids.clear()
+
+    def setUp(self):
+        loudbot.shout_ids.clear()
+
+    def test_channel_load(self):
+        start = time.perf_counter()
+        for channel in self.channels:
+            ids = loudbot.channel_shouts(self.server, channel)
+            self.assertEqual(len(ids), self.SHOUTS // self.CHANNELS)
+        elapsed = time.perf_counter() - start
+
+        print('loudbot: loaded shout IDs for {} channels in {:.2f}s'.format(self.CHANNELS, elapsed))
+        self.assertLess(elapsed, self.MAX_LOAD)
+
+    def test_random_shout(self):
+        random.seed(1337)
+        # Load the IDs up front: that only happens once per channel.
+        for channel in self.channels:
+            loudbot.channel_shouts(self.server, channel)
+
+        start = time.perf_counter()
+        for i in range(self.LOOKUPS):
+            channel = self.channels[i % self.CHANNELS]
+            id, shout = loudbot.random_shout(self.server, channel)
+            self.assertEqual(int(shout.decode('utf-8').split()[-1]) % self.CHANNELS, i % self.CHANNELS)
+        latency = (time.perf_counter() - start) / self.LOOKUPS
+
+        print('loudbot: random shout in {:.3f}ms'.format(latency * 1000))
+        self.assertLess(latency, self.MAX_LOOKUP)
+
+    def test_by_hash(self):
+        random.seed(1337)
+        start = time.perf_counter()
+        for _ in range(self.LOOKUPS):
+            i = random.randrange(self.SHOUTS)
+            digest = loudbot.shout_hash('SHOUT NUMBER {}'.format(i))
+            seen = db.from_('shouts').where('hash', digest).and_('server', self.server).and_('channel', self.channels[i % self.CHANNELS]).single('id', 'count')
+            self.assertTrue(seen)
+        latency = (time.perf_counter() - start) / self.LOOKUPS
+
+        print('loudbot: shout lookup by content in {:.3f}ms'.format(latency * 1000))
+        self.assertLess(latency, self.MAX_LOOKUP)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# Maintenance scheduling tests.
+import time
+import unittest
+
+from tests import configure
+configure()
+
+from michiru import config, events, maintenance
+
+
+class IdleTest(unittest.TestCase):
+    def setUp(self):
+        self.last_event = events.last_event
+        events.last_event = time.monotonic() - config.get('maintenance.idle_time') - 1
+        maintenance.activity.clear()
+
+    def tearDown(self):
+        events.last_event = self.last_event
+        maintenance.activity.clear()
+
+    def test_idle(self):
+        self.assertTrue(maintenance.idle())
+
+    def test_other_shard_busy(self):
+        maintenance.receive_activity(1, 0, False)
+        self.assertFalse(maintenance.idle())
+
+    def test_other_shard_queued(self):
+        maintenance.receive_activity(1, config.get('maintenance.idle_time'), True)
+        self.assertFalse(maintenance.idle())
+
+    def test_other_shard_stale(self):
+        maintenance.activity[1] = (time.monotonic() - 3 * config.get('maintenance.report_interval'), 0, False)
+        self.assertTrue(maintenance.idle())
+
+
+class CompactTest(unittest.TestCase):
+    def test_new_database_incremental(self):
+        self.assertTrue(maintenance.incremental())
+        maintenance.compact()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# Query plan tests: lookups that run on every message should never scan a whole table.
+import unittest
+import importlib
+
+from tests import configure
+configure()
+
+from michiru import db
+
+# Modules rename themselves, so import them the way the module loader does.
+for name in ('remindbot', 'seenbot', 'loudbot'):
+    importlib.import_module('michiru.modules.' + name)
+
+
+class PlanTest(unittest.TestCase):
+    def assertIndexed(self, query, *fields):
+        plan = db.explain(query, *fields)
+        for step in plan:
+            if step.startswith('SCAN'):
+                self.assertIn('INDEX', step)
+
+    def test_remindbot_untimed(self):
+        self.assertIndexed(db.from_('reminders').where('server', 'test').and_('channel', '#chan').and_('to', 'someone').and_('time', None), 'id', 'from', 'message')
+        self.assertIndexed(db.from_('reminders').where('server', 'test').and_('channel', None).and_('to', 'someone').and_('time', None), 'id', 'from', 'message')
+
+    def test_remindbot_by_id(self):
+        self.assertIndexed(db.from_('reminders').where('id', 1), 'channel', 'from', 'to', 'message')
+
+    def test_seenbot(self):
+        self.assertIndexed(db.from_('seen').where('nickname', 'someone').and_('server', 'test'), 'action', 'data', 'time')
+
+    def test_loudbot_by_hash(self):
+        self.assertIndexed(db.from_('shouts').where('hash', 'abc').and_('server', 'test').and_('channel', '#chan').limit(1), 'id', 'count')
+
+    def test_loudbot_channel(self):
+        self.assertIndexed(db.from_('shouts').where('server', 'test').and_('channel', '#chan'), 'id')
+
+    def test_loudbot_by_id(self):
+        self.assertIndexed(db.from_('shouts').where('id', 1), 'id', 'shout')
+
+
+if __name__ == '__main__':
+    unittest.main()
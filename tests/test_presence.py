@@ -0,0 +1,25 @@
+# Presence cache tests.
+import unittest
+
+from michiru.presence import Presence
+
+
+class RenameTest(unittest.TestCase):
+    def setUp(self):
+        self.presence = Presence(str.lower)
+        self.presence.join('#chan', 'Mallory', account='mallory', identified=True)
+
+    def test_rename_forgets_account(self):
+        self.presence.rename('Mallory', 'Admin')
+        self.assertIsNone(self.presence.account('Admin'))
+        self.assertIsNone(self.presence.identified('Admin'))
+        self.assertTrue(self.presence.present('Admin', '#chan'))
+
+    def test_rename_keeps_reliable_account(self):
+        self.presence.rename('Mallory', 'Admin', keep_account=True)
+        self.assertEqual(self.presence.account('Admin'), 'mallory')
+        self.assertTrue(self.presence.identified('Admin'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# Reminder tests.
+import unittest
+import asyncio
+import importlib
+from datetime import datetime, timedelta
+
+from tests import configure
+configure()
+
+from michiru import db
+
+# Modules rename themselves, so import them the way the module loader does.
+remindbot = importlib.import_module('michiru.modules.remindbot')
+
+
+class Bot:
+    FORMAT_CODES = {'b': '', '/b': ''}
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.lines = []
+
+    def highlight(self, nick):
+        return nick
+
+    @asyncio.coroutine
+    def message(self, target, message):
+        self.lines.append((target, message))
+
+
+class TimerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.bot = Bot(self.loop)
+        db.query('reminders', 'DELETE FROM `reminders`')
+
+    def tearDown(self):
+        remindbot.unload()
+        self.loop.close()
+
+    def add(self, when, channel='#chan'):
+        return db.to('reminders').add({
+            'server': 'test',
+            'channel': channel,
+            'from': 'alice',
+            'to': 'bob',
+            'message': 'hello',
+            'time': when
+        })
+
+    def connect(self):
+        remindbot.connect(self.bot, 'test')
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_overdue_delivered_on_connect(self):
+        self.add(datetime.now() - timedelta(days=30))
+        self.add(datetime.now() - timedelta(hours=1), channel=None)
+        self.connect()
+        self.assertEqual(sorted(target for target, _ in self.bot.lines), ['#chan', 'bob'])
+        self.assertEqual(db.query('reminders', 'SELECT * FROM `reminders`'), [])
+
+    def test_pending_rearmed_once(self):
+        id = self.add(datetime.now() + timedelta(hours=1))
+        self.connect()
+        self.connect()
+        self.assertEqual(list(remindbot.TIMERS), [id])
+        self.assertEqual(self.bot.lines, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
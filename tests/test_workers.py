@@ -0,0 +1,35 @@
+# Worker process tests.
+import os
+import time
+import unittest
+import asyncio
+
+from tests import configure
+configure()
+
+from michiru import workers
+
+
+class SandboxTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.box = workers.Sandbox(1)
+
+    def tearDown(self):
+        self.box.kill()
+        self.loop.close()
+
+    def test_timeout_restarts(self):
+        old = self.box.start()
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(self.box.run(self.loop, 0.2, time.sleep, 30))
+
+        # Fresh workers are ready for the next job.
+        self.assertIsNotNone(self.box.pool)
+        self.assertIsNot(self.box.pool, old)
+        pid = self.loop.run_until_complete(self.box.run(self.loop, 5, os.getpid))
+        self.assertNotEqual(pid, os.getpid())
+
+
+if __name__ == '__main__':
+    unittest.main()